@@ -0,0 +1,53 @@
+# encoding: utf-8
+"""
+Benchmark phone number normalization: single cached calls, cold single
+calls, and the batch API, over numbers in the mix of formats Google
+Voice hands back.
+
+Invoke with `python benchmarks/e164.py [numbers] [distinct]`
+"""
+from __future__ import print_function
+
+import random
+import sys
+import time
+
+from googlevoice import e164
+
+FORMATS = ('+1%s%s%s', '(%s) %s-%s', '%s-%s-%s', '1 %s %s %s', '%s.%s.%s')
+
+
+def numbers(count, distinct, seed=0):
+    """ ``count`` numbers drawn from ``distinct`` different ones, each in
+        a random format.
+    """
+    rng = random.Random(seed)
+    pool = [('%03d' % rng.randrange(200, 1000), '%03d' % rng.randrange(1000),
+             '%04d' % rng.randrange(10000)) for _ in range(distinct)]
+    return [rng.choice(FORMATS) % rng.choice(pool) for _ in range(count)]
+
+
+def timed(label, func, count):
+    started = time.time()
+    func()
+    elapsed = time.time() - started
+    print('  %-22s %8.1f ms  %8.0f k numbers/s'
+          % (label, elapsed * 1e3, count / elapsed / 1e3))
+
+
+def main(count=1000000, distinct=20000):
+    count, distinct = int(count), int(distinct)
+    sample = numbers(count, distinct)
+    print('%s numbers (%s distinct):' % (count, distinct))
+    timed('uncached _normalize',
+          lambda: [e164._normalize(n) for n in sample], count)
+    e164.normalize_cached.cache_clear()
+    timed('normalize, cold cache',
+          lambda: [e164.normalize(n) for n in sample], count)
+    timed('normalize, warm cache',
+          lambda: [e164.normalize(n) for n in sample], count)
+    timed('normalize_many', lambda: e164.normalize_many(sample), count)
+
+
+if __name__ == '__main__':
+    main(*sys.argv[1:])
@@ -0,0 +1,71 @@
+# encoding: utf-8
+"""
+Benchmark the available JSON backends against synthetic Google Voice
+feed payloads, of the size returned by large ``all``/``search`` pages.
+
+Invoke with `python benchmarks/json_backends.py [messages-per-feed ...]`
+"""
+from __future__ import print_function
+
+import json
+import random
+import sys
+import timeit
+
+from googlevoice import settings
+from googlevoice.util import JSONDecoder
+
+
+def synthetic_feed(count, seed=0):
+    """ Build the JSON text of a feed holding ``count`` messages. """
+    rng = random.Random(seed)
+    start = 1546300800000
+    messages = {}
+    for idx in range(count):
+        msgid = '%040x' % rng.getrandbits(160)
+        stamp = start + idx * 60000
+        number = '+1%010d' % rng.randrange(10 ** 10)
+        messages[msgid] = {
+            'id': msgid,
+            'phoneNumber': number,
+            'displayNumber': number,
+            'startTime': str(stamp),
+            'displayStartDateTime': '1/1/19 12:%02d AM' % (idx % 60),
+            'displayStartTime': '12:%02d AM' % (idx % 60),
+            'relativeStartTime': '%d hours ago' % (idx // 60),
+            'note': '',
+            'isRead': rng.random() < 0.8,
+            'isSpam': False,
+            'isTrash': False,
+            'star': rng.random() < 0.1,
+            'messageText': 'x' * rng.randrange(20, 160),
+            'labels': ['inbox', 'all', rng.choice(['sms', 'voicemail'])],
+            'type': rng.choice(list(settings.TYPES)),
+            'children': '',
+        }
+    return json.dumps({
+        'messages': messages,
+        'totalSize': count,
+        'unreadCounts': {'all': count // 5, 'inbox': count // 5},
+        'resultsPerPage': count,
+    })
+
+
+def main(sizes=(10, 1000, 10000)):
+    for size in sizes:
+        payload = synthetic_feed(int(size))
+        print('%s messages, %.1f KiB:' % (size, len(payload) / 1024.))
+        for name in JSONDecoder.backends:
+            try:
+                decoder = JSONDecoder(name)
+            except ImportError:
+                print('  %-9s (not installed)' % name)
+                continue
+            timer = timeit.Timer(lambda: decoder(payload))
+            number, _ = timer.autorange()
+            best = min(timer.repeat(repeat=5, number=number)) / number
+            print('  %-9s %10.1f µs/decode' % (name, best * 1e6))
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:] or (10, 1000, 10000))
@@ -0,0 +1,54 @@
+# encoding: utf-8
+"""
+Benchmark ``MessageIndex`` build and query times over a large synthetic
+history, added page by page, newest first, as ``Voice.pages`` yields it.
+
+Invoke with `python benchmarks/query.py [messages]`
+"""
+from __future__ import print_function
+
+import json
+import sys
+import timeit
+from datetime import datetime
+
+from googlevoice.query import MessageIndex
+from googlevoice.util import Folder
+
+sys.path.insert(0, __file__.rsplit('/', 1)[0])
+from json_backends import synthetic_feed  # noqa: E402
+
+
+def main(count=100000, per_page=100):
+    count, per_page = int(count), int(per_page)
+    messages = sorted(json.loads(synthetic_feed(count))['messages'].items(),
+                      key=lambda item: -int(item[1]['startTime']))
+    pages = [Folder(None, 'all', dict(messages=dict(messages[i:i + per_page])))
+             for i in range(0, count, per_page)]
+
+    index = MessageIndex()
+    started = timeit.default_timer()
+    for page in pages:
+        index.add(page)
+    print('%s messages indexed in %.0f ms'
+          % (len(index), (timeit.default_timer() - started) * 1e3))
+
+    since = datetime(2019, 1, 2)
+    number = messages[0][1]['phoneNumber']
+    queries = (
+        ('unread voicemail since', dict(type='voicemail', isRead=False,
+                                        since=since)),
+        ('number', dict(number=number)),
+        ('starred sms, label', dict(type='sms', star=True, label='sms')),
+        ('last hour', dict(since=1546300800000 + (count - 60) * 60000)),
+    )
+    for name, filters in queries:
+        timer = timeit.Timer(lambda: index.ids(**filters))
+        number_, _ = timer.autorange()
+        best = min(timer.repeat(repeat=3, number=number_)) / number_
+        print('  %-24s %6d hits %10.3f ms'
+              % (name, len(index.ids(**filters)), best * 1e3))
+
+
+if __name__ == '__main__':
+    main(*sys.argv[1:])
@@ -0,0 +1,69 @@
+# encoding: utf-8
+"""
+Benchmark writing, loading and lazily opening a folder snapshot of a
+large synthetic history, against decoding the same messages from their
+feed JSON, in each snapshot encoding and compression available.
+
+Invoke with `python benchmarks/snapshot.py [messages]`
+"""
+from __future__ import print_function
+
+import json
+import os
+import sys
+import tempfile
+import timeit
+
+from googlevoice import snapshot
+from googlevoice.util import Folder
+
+sys.path.insert(0, __file__.rsplit('/', 1)[0])
+from json_backends import synthetic_feed  # noqa: E402
+
+
+def available(encoding, compress):
+    try:
+        if encoding == snapshot.MSGPACK:
+            import msgpack  # noqa: F401
+        if compress:
+            import zstandard  # noqa: F401
+    except ImportError:
+        return False
+    return True
+
+
+def best(function, repeat=3):
+    return min(timeit.repeat(function, repeat=repeat, number=1))
+
+
+def main(count=500000):
+    count = int(count)
+    feed = synthetic_feed(count)
+    folder = Folder(None, 'all', json.loads(feed))
+    print('%s messages; feed JSON decoded in %8.0f ms'
+          % (count, best(lambda: json.loads(feed)) * 1e3))
+    directory = tempfile.mkdtemp()
+    path = os.path.join(directory, 'all.gvsnap')
+    try:
+        for encoding, name in ((snapshot.PICKLE, 'pickle'),
+                               (snapshot.MSGPACK, 'msgpack')):
+            for compress in (False, True):
+                if not available(encoding, compress):
+                    continue
+                written = best(lambda: snapshot.dump(folder, path, compress,
+                                                     encoding))
+                loaded = best(lambda: snapshot.load(path))
+                opened = best(lambda: snapshot.load(path, lazy=True))
+                print('  %-8s %-5s %8.1f MB  dump %6.0f ms  load %6.0f ms'
+                      '  lazy %6.0f ms'
+                      % (name, 'zstd' if compress else '',
+                         os.path.getsize(path) / 1e6, written * 1e3,
+                         loaded * 1e3, opened * 1e3))
+    finally:
+        if os.path.exists(path):
+            os.unlink(path)
+        os.rmdir(directory)
+
+
+if __name__ == '__main__':
+    main(*sys.argv[1:])
@@ -0,0 +1,53 @@
+# encoding: utf-8
+"""
+Benchmark peak memory and time of parsing one large feed page whole,
+through ``XMLParser``, against streaming it through ``MessageStream``
+in 64 KiB chunks, keeping no message data in either case.
+
+Invoke with `python benchmarks/stream.py [messages]`
+"""
+from __future__ import print_function
+
+import sys
+import timeit
+import tracemalloc
+
+from googlevoice.util import MessageStream, XMLParser
+
+sys.path.insert(0, __file__.rsplit('/', 1)[0])
+from json_backends import synthetic_feed  # noqa: E402
+
+
+def whole(payload):
+    folder = XMLParser(None, 'all', lambda: payload)()
+    for msgid, data in folder['messages'].items():
+        pass
+
+
+def streamed(payload):
+    stream = MessageStream(None, 'all')
+    for i in range(0, len(payload), 65536):
+        for msgid, data in stream.feed(payload[i:i + 65536]):
+            pass
+    stream.feed(b'', True)
+
+
+def main(count=100000):
+    count = int(count)
+    payload = ('<?xml version="1.0" encoding="UTF-8"?><response><json>'
+               '<![CDATA[%s]]></json><html><![CDATA[<div/>]]></html>'
+               '</response>' % synthetic_feed(count)).encode('utf-8')
+    print('%s messages, %.1f MB of feed' % (count, len(payload) / 1e6))
+    for name, parse in (('whole', whole), ('streamed', streamed)):
+        tracemalloc.start()
+        started = timeit.default_timer()
+        parse(payload)
+        elapsed = timeit.default_timer() - started
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        print('  %-10s peak %8.1f MB  %8.0f ms'
+              % (name, peak / 1e6, elapsed * 1e3))
+
+
+if __name__ == '__main__':
+    main(*sys.argv[1:])
@@ -0,0 +1,57 @@
+# encoding: utf-8
+"""
+Microbenchmark of ``Message`` timestamp handling: the memoized
+``parse_display_datetime`` fast path against plain ``strptime``, on
+display strings that repeat the way they do in a real folder.
+
+Invoke with `python benchmarks/timestamps.py [messages]`
+"""
+from __future__ import print_function
+
+import sys
+import timeit
+from datetime import datetime, timedelta
+
+from googlevoice import util
+
+
+def display_strings(count, per_minute=4):
+    """ ``count`` display strings, ``per_minute`` messages to a minute. """
+    start = datetime(2019, 1, 1, 8, 0)
+    return [
+        (start + timedelta(minutes=idx // per_minute)).strftime(
+            '%m/%d/%y %I:%M %p').lstrip('0').replace('/0', '/')
+        for idx in range(count)]
+
+
+def main(count=10000):
+    strings = display_strings(int(count))
+    assert all(
+        util.parse_display_datetime(text)
+        == datetime.strptime(text, util.DISPLAY_FORMAT)
+        for text in strings)
+
+    def baseline():
+        for text in strings:
+            datetime.strptime(text, util.DISPLAY_FORMAT)
+
+    def cold():
+        util.parse_display_datetime.cache_clear()
+        for text in strings:
+            util.parse_display_datetime(text)
+
+    def warm():
+        for text in strings:
+            util.parse_display_datetime(text)
+
+    print('%s display strings (%s distinct):'
+          % (len(strings), len(set(strings))))
+    for name, func in (('strptime', baseline), ('fast, cold', cold),
+                       ('fast, warm', warm)):
+        best = min(timeit.repeat(func, repeat=5, number=1))
+        print('  %-10s %8.1f ms  %6.2f µs/message'
+              % (name, best * 1e3, best * 1e6 / len(strings)))
+
+
+if __name__ == '__main__':
+    main(*sys.argv[1:])
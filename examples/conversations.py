@@ -0,0 +1,21 @@
+from __future__ import print_function
+
+from googlevoice import Voice
+from googlevoice.conversations import Conversations
+
+
+def run():
+    voice = Voice()
+    voice.login()
+
+    conversations = Conversations()
+    for folder in voice.pages('sms'):
+        conversations.add(folder)
+
+    for thread in conversations.top(10):
+        print(thread.number, '(%s unread)' % thread.unread)
+        for message in thread:
+            print('\t', message.displayStartDateTime, message.messageText)
+
+
+__name__ == '__main__' and run()
@@ -3,11 +3,11 @@
 
 from __future__ import print_function
 
-import atexit, sys
+import atexit, shlex, sys
 from optparse import OptionParser
-from pprint import pprint
 from six.moves import input
 
+from googlevoice import batch, export, prefetch, profiling, render
 from googlevoice.voice import Voice
 from googlevoice.util import LoginError
 
@@ -23,8 +23,17 @@ parser = OptionParser(usage='''gvoice [options] commands
         cancel (cc) - cancel a particular call
         download (d) - download mp3 message given id hash
         send_sms (s) - send sms messages
+        export - stream feed history to JSONL, CSV or Parquet
+                 (see `gvoice export --help`)
+        batch - run commands from a file or stdin over one session,
+                printing JSON results (see `gvoice batch --help`)
+        list - stream a feed's messages as a table, JSON or TSV
+               (see `gvoice list --help`)
 
     Folder Views
+        (folders viewed often are prefetched while the prompt is idle;
+         add a trailing ! to force a refresh, e.g. `i!`; folder views take
+         the options of `gvoice list`, e.g. `i -n 50 -f tsv`)
         search (se)
         inbox (i)
         voicemail (v)
@@ -45,6 +54,20 @@ parser.add_option("-p", "--password", dest='passwd', default=None,
 parser.add_option(
     "-b", "--batch", dest='batch', default=False, action="store_true",
     help='Batch operations, asking for no interactive input')
+parser.add_option(
+    "--profile", dest='profile', default=None, metavar='PREFIX',
+    help='Profile the run, writing PREFIX.txt (cumulative-time report), '
+         'PREFIX.collapsed (flamegraph stacks) and PREFIX.prof')
+parser.add_option(
+    "--no-prefetch", dest='prefetch', default=True, action="store_false",
+    help='Fetch folders only when viewed in the interactive shell')
+parser.add_option(
+    "--prefetch-ttl", dest='prefetch_ttl', default=60., type='float',
+    metavar='SECONDS',
+    help='Show prefetched folders for up to SECONDS (default: 60)')
+
+#: Commands taking options of their own, after the command name
+SUBCOMMANDS = ('export', 'list', 'batch')
 
 
 YES   = ('', 'y')
@@ -52,7 +75,8 @@ TRUTH = (True, 'true')
 
 def login(voice, **kwargs):
     """ Login to a Voice instance, based on options, environment variable
-        values, and interactivity
+        values, and interactivity. Status lines go to standard error, so
+        standard output stays clean for command output.
     """
     import os
     
@@ -71,20 +95,20 @@ def login(voice, **kwargs):
     passwd = environ_override('passwd', 'GOOGLE_VOICE_PASS')
     batch  = environ_override('batch',  'GOOGLE_VOICE_BATCH') in TRUTH
     
-    print('Logging into voice…')
+    print('Logging into voice…', file=sys.stderr)
     if email:
-        print('» EMAIL: %s' % email)
+        print('» EMAIL: %s' % email, file=sys.stderr)
     if passwd:
-        print('» PASSWD: *********')
+        print('» PASSWD: *********', file=sys.stderr)
     if batch:
-        print('» BATCH: %s' % batch)
+        print('» BATCH: %s' % batch, file=sys.stderr)
     
     try:
         voice.login(email=email, passwd=passwd)
     except LoginError:
         if batch:
             # Batch mode exits immediately on failure:
-            print('Login failed.')
+            print('Login failed.', file=sys.stderr)
             return False
         if input('Login failed. Retry? [Y/n] ').lower() in YES:
             # Retrying forces an attempt with environment values:
@@ -100,21 +124,141 @@ def logout(voice):
     """ Callback delegate function to call `voice.logout()` at the
         program’s end, using `atexit.register`.
     """
-    print('Logging out of voice…')
+    print('Logging out of voice…', file=sys.stderr)
     voice.logout()
 
 
-def pprint_folder(voice, name):
-    """ Use `pprint.pprint` to print out the contents of a folder. """
-    folder = getattr(voice, name)()
-    print(folder)
-    pprint(folder.messages, indent=4)
+def report(profiler):
+    """ Callback delegate function to stop a `profiling.Profiler` at the
+        program’s end, and say where its report went.
+    """
+    paths = profiler.stop()
+    print('Profile written to %s' % ', '.join(sorted(paths.values())),
+          file=sys.stderr)
+
+
+def print_folder(voice, name, args=(), prefetcher=None, refresh=False,
+                 query=None):
+    """ Stream the messages of a folder out with `render.render`, as its
+        pages are fetched, taking `gvoice list` options from `args`. The
+        first page comes from a `prefetch.Prefetcher`, if given – and how
+        old it is goes to standard error.
+    """
+    try:
+        options, name = render.parse_args(list(args) + [name])
+    except SystemExit:
+        # Bad options, or --help; either way, back to the prompt:
+        return
+    first = None
+    if prefetcher is not None and query is None:
+        first = prefetcher.get(name, refresh=refresh)
+        print('%s (%s)' % (first, prefetch.staleness(prefetcher.age(name))),
+              file=sys.stderr)
+    render.render(voice, name, query or options.query, options.limit,
+                  options.everything, options.columns, options.format,
+                  first=first)
+
+
+def shell(voice, prefetcher=None):
+    """ The interactive main loop, reading commands until told to quit –
+        or until the end of input.
+    """
+    while 1:
+        if prefetcher is not None:
+            prefetcher.idle()
+        try:
+            line = input('gvoice> ').strip()
+        except (EOFError, KeyboardInterrupt):
+            sys.exit(1)
+        if prefetcher is not None:
+            prefetcher.busy()
+        action, _, rest = line.partition(' ')
+        try:
+            rest = shlex.split(rest)
+        except ValueError as exc:
+            print(exc)
+            continue
+        # A trailing “!” refreshes a folder, instead of using the cache:
+        action = action.lower()
+        refresh = action.endswith('!')
+        action = action.rstrip('!')
+        if not action:
+            continue
+        elif action in ('q', 'quit', 'exit'):
+            break
+        elif action in ('login', 'li'):
+            if login(voice) and prefetcher is not None:
+                prefetcher.resume()
+        elif action in ('logout', 'lo'):
+            # No more background fetches, nor their failures:
+            if prefetcher is not None:
+                prefetcher.pause()
+            voice.logout()
+        elif action in ('call', 'c'):
+            voice.call(
+                input('Outgoing number: '),
+                input('Forwarding number [optional]: ') or None,
+                int(
+                    input(
+                        'Phone type [1-Home, 2-Mobile, 3-Work, 7-Gizmo]:'
+                    ) or 2)
+            )
+            print('Calling...')
+        elif action in ('cancelcall', 'cc'):
+            voice.cancel()
+        elif action in ('sendsms', 's'):
+            voice.send_sms(input('Phone number: '), input('Message: '))
+            print('Message Sent')
+        elif action in ('search', 'se'):
+            print_folder(voice, 'search', rest,
+                         query=input('Search query: '))
+        elif action in ('download', 'd'):
+            print(
+                'MP3 downloaded to %s'
+                % voice.download(input('Message sha1: ')))
+        elif action in ('help', 'h', '?'):
+            print(parser.usage)
+        elif action in ('trash', 't'):
+            print_folder(voice, 'trash', rest, prefetcher, refresh)
+        elif action in ('spam', 'sp'):
+            print_folder(voice, 'spam', rest, prefetcher, refresh)
+        elif action in ('inbox', 'i'):
+            print_folder(voice, 'inbox', rest, prefetcher, refresh)
+        elif action in ('voicemail', 'v'):
+            print_folder(voice, 'voicemail', rest, prefetcher, refresh)
+        elif action in ('all', 'a'):
+            print_folder(voice, 'all', rest, prefetcher, refresh)
+        elif action in ('starred', 'st'):
+            print_folder(voice, 'starred', rest, prefetcher, refresh)
+        elif action in ('missed', 'm'):
+            print_folder(voice, 'missed', rest, prefetcher, refresh)
+        elif action in ('received', 're'):
+            print_folder(voice, 'received', rest, prefetcher, refresh)
+        elif action in ('recorded', 'r'):
+            print_folder(voice, 'recorded', rest, prefetcher, refresh)
+        elif action in ('sms', 'sm'):
+            print_folder(voice, 'sms', rest, prefetcher, refresh)
+
+
+def parse_args(args=None):
+    """ Parse global options from anywhere in `args` – except after one
+        of the `SUBCOMMANDS`, whose options are left to it.
+    """
+    args = sys.argv[1:] if args is None else list(args)
+    parser.disable_interspersed_args()
+    try:
+        options, rest = parser.parse_args(args)
+    finally:
+        parser.enable_interspersed_args()
+    if rest and rest[0] in SUBCOMMANDS:
+        return options, rest
+    return parser.parse_args(args)
 
 
 def main():
     """ The main entry point for the “googlevoice” package CLI app. """
     loggedin = False
-    options, args = parser.parse_args()
+    options, args = parse_args()
 
     try:
         action, args = args[0], args[1:]
@@ -125,9 +269,17 @@ def main():
         print(parser.usage)
         sys.exit(0)
 
+    # Batch mode reads commands from stdin, so never prompts:
+    if action == 'batch':
+        options.batch = True
+
+    # Profile everything from here on, stopping after logout:
+    if options.profile and profiling.active is None:
+        atexit.register(report, profiling.Profiler(options.profile).start())
+
     # Initialize the application invocations’ Voice instance:
     voice = Voice()
-    loggedin = login(voice)
+    loggedin = login(voice, **vars(options))
     
     if loggedin:
         atexit.register(logout, voice)
@@ -137,64 +289,27 @@ def main():
 
     # The interactive main loop:
     if action == 'interactive':
-        while 1:
-            try:
-                action = input('gvoice> ').lower().strip()
-            except (EOFError, KeyboardInterrupt):
-                sys.exit(1)
-            if not action:
-                continue
-            elif action in ('q', 'quit', 'exit'):
-                break
-            elif action in ('login', 'li'):
-                loggedin = login(voice)
-            elif action in ('logout', 'lo'):
-                voice.logout()
-            elif action in ('call', 'c'):
-                voice.call(
-                    input('Outgoing number: '),
-                    input('Forwarding number [optional]: ') or None,
-                    int(
-                        input(
-                            'Phone type [1-Home, 2-Mobile, 3-Work, 7-Gizmo]:'
-                        ) or 2)
-                )
-                print('Calling...')
-            elif action in ('cancelcall', 'cc'):
-                voice.cancel()
-            elif action in ('sendsms', 's'):
-                voice.send_sms(input('Phone number: '), input('Message: '))
-                print('Message Sent')
-            elif action in ('search', 'se'):
-                se = voice.search(input('Search query: '))
-                print(se)
-                pprint(se.messages)
-            elif action in ('download', 'd'):
-                print(
-                    'MP3 downloaded to %s'
-                    % voice.download(input('Message sha1: ')))
-            elif action in ('help', 'h', '?'):
-                print(parser.usage)
-            elif action in ('trash', 't'):
-                pprint_folder(voice, 'trash')
-            elif action in ('spam', 'sp'):
-                pprint_folder(voice, 'spam')
-            elif action in ('inbox', 'i'):
-                pprint_folder(voice, 'inbox')
-            elif action in ('voicemail', 'v'):
-                pprint_folder(voice, 'voicemail')
-            elif action in ('all', 'a'):
-                pprint_folder(voice, 'all')
-            elif action in ('starred', 'st'):
-                pprint_folder(voice, 'starred')
-            elif action in ('missed', 'm'):
-                pprint_folder(voice, 'missed')
-            elif action in ('received', 're'):
-                pprint_folder(voice, 'received')
-            elif action in ('recorded', 'r'):
-                pprint_folder(voice, 'recorded')
-            elif action in ('sms', 'sm'):
-                pprint_folder(voice, 'sms')
+        prefetcher = None
+        if options.prefetch:
+            prefetcher = prefetch.Prefetcher(voice, ttl=options.prefetch_ttl)
+        try:
+            shell(voice, prefetcher)
+        finally:
+            if prefetcher is not None:
+                prefetcher.close()
+    
+    # The “export” action streams feeds out to a file:
+    elif action == 'export':
+        export.main(voice, args)
+    
+    # The “list” action streams one feed’s messages out:
+    elif action == 'list':
+        render.main(voice, args)
+    
+    # The “batch” action runs many commands over this one session:
+    elif action == 'batch':
+        if batch.main(voice, args):
+            sys.exit(1)
     
     # The “send_sms” action logic:
     else:
@@ -0,0 +1,166 @@
+# encoding: utf-8
+""" Non-interactive batch mode: runs many commands over one logged-in
+    ``Voice`` instance, writing one JSON result per command.
+
+    Commands are read one per line, either shell-style::
+
+        send_sms 5555551212 running late
+        inbox
+
+    or as JSON objects::
+
+        {"action": "call", "args": ["5555551212"], "kwargs": {"phoneType": 2}}
+
+    Invoke as ``python -m googlevoice batch [-f FILE] [-j JOBS]``.
+"""
+from __future__ import print_function
+
+import calendar
+import collections
+import datetime
+import json
+import shlex
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+from optparse import OptionParser
+
+from . import settings
+from . import util
+
+#: Short command names, as accepted by the interactive shell
+ALIASES = {
+    'c': 'call', 'cc': 'cancel', 'cancelcall': 'cancel', 'd': 'download',
+    's': 'send_sms', 'sendsms': 'send_sms', 'se': 'search', 'i': 'inbox',
+    'v': 'voicemail', 'st': 'starred', 'a': 'all', 'sp': 'spam',
+    't': 'trash', 'sm': 'sms', 'r': 'recorded', 'p': 'placed',
+    're': 'received', 'm': 'missed',
+}
+ACTIONS = ('call', 'cancel', 'send_sms', 'download', 'search', 'archive',
+           'delete') + settings.FEEDS
+
+parser = OptionParser(usage='''gvoice [options] batch [batch-options]
+    Runs commands, one per line (shell-style or JSON), from a file or
+    standard input, writing one JSON result per line.''')
+parser.add_option("-f", "--file", dest="file", default='-',
+                  help="Command file (default: standard input)")
+parser.add_option("-j", "--jobs", dest="jobs", default=1, type="int",
+                  help="Number of commands to run at once (default: 1); "
+                       "only use with independent commands")
+
+
+class Command(object):
+
+    """ One parsed batch command: an ``action`` with its arguments. """
+
+    def __init__(self, line, action, args=(), kwargs=None):
+        self.line = line
+        self.action = ALIASES.get(action, action)
+        self.args = list(args)
+        self.kwargs = kwargs or {}
+        if self.action not in ACTIONS:
+            raise ValueError('Unknown command: %r' % action)
+
+    @classmethod
+    def parse(cls, line, text):
+        """ Parse a shell-style or JSON command from line ``line``;
+            returns ``None`` for blank lines and ``#`` comments.
+        """
+        text = text.strip()
+        if not text or text.startswith('#'):
+            return None
+        if text.startswith('{'):
+            data = json.loads(text)
+            return cls(line, data['action'], data.get('args', ()),
+                       data.get('kwargs'))
+        words = shlex.split(text)
+        command = cls(line, words[0], words[1:])
+        if command.action == 'send_sms' and len(command.args) > 2:
+            command.args[1:] = [' '.join(command.args[1:])]
+        return command
+
+    def __call__(self, voice):
+        """ Run against ``voice``, returning a result `dict`. """
+        started = time.time()
+        result = dict(line=self.line, action=self.action)
+        try:
+            value = getattr(voice, self.action)(*self.args, **self.kwargs)
+        except Exception as exc:
+            result.update(ok=False, error='%s: %s'
+                          % (type(exc).__name__, exc))
+        else:
+            if isinstance(value, util.Folder):
+                value = dict(value, name=value.name)
+            result.update(ok=True, result=value)
+        result['seconds'] = round(time.time() - started, 6)
+        return result
+
+
+def to_json(value):
+    """ ``json.dumps`` fallback for values returned by ``Voice`` calls. """
+    if isinstance(value, (datetime.datetime, datetime.date,
+                          datetime.time)):
+        return value.isoformat()
+    if isinstance(value, time.struct_time):
+        return calendar.timegm(value)
+    return str(value)
+
+
+def parse(lines):
+    """ Parse an iterable of command lines, yielding ``Command``
+        instances – or error result dicts, for lines that don’t parse.
+    """
+    for number, text in enumerate(lines, 1):
+        try:
+            command = Command.parse(number, text)
+        except Exception as exc:
+            yield dict(line=number, ok=False, error='%s: %s'
+                       % (type(exc).__name__, exc))
+            continue
+        if command is not None:
+            yield command
+
+
+def run(voice, commands, jobs=1):
+    """ Run ``commands`` (as yielded by ``parse``) against one ``Voice``
+        instance, yielding their result dicts in input order. With
+        ``jobs`` over 1, up to that many commands run concurrently – and
+        no more than twice that are read ahead of the results yielded,
+        so ``commands`` can be an endless stream.
+    """
+    def execute(command):
+        return command(voice) if callable(command) else command
+
+    if jobs <= 1:
+        for command in commands:
+            yield execute(command)
+        return
+    with ThreadPoolExecutor(max_workers=jobs) as executor:
+        pending = collections.deque()
+        for command in commands:
+            pending.append(executor.submit(execute, command))
+            if len(pending) >= jobs * 2:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+
+
+def main(voice, args, stdout=None):
+    """ Run the ``batch`` command with its command-line ``args``;
+        returns the number of failed commands.
+    """
+    options, extra = parser.parse_args(list(args))
+    if extra:
+        parser.error('Unexpected arguments: %s' % ' '.join(extra))
+    stdout = stdout or sys.stdout
+    source = sys.stdin if options.file == '-' else open(options.file)
+    failures = 0
+    try:
+        for result in run(voice, parse(source), options.jobs):
+            failures += not result['ok']
+            stdout.write(json.dumps(result, default=to_json) + '\n')
+            stdout.flush()
+    finally:
+        if source is not sys.stdin:
+            source.close()
+    return failures
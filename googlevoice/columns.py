@@ -0,0 +1,136 @@
+# encoding: utf-8
+""" Columnar views of folder message data, for analytics.
+
+    ``Columns`` are built straight from the decoded feed JSON – no
+    ``Message`` instances are constructed – into compact typed arrays,
+    which convert to NumPy, pandas or Arrow when those are installed.
+"""
+from __future__ import print_function
+
+from array import array
+
+from . import settings
+
+#: Category codes for the ``type`` column, in ``settings.TYPES`` order
+TYPE_CODES = tuple(sorted(settings.TYPES))
+#: Category labels for the ``type`` column, indexed by code
+TYPE_CATEGORIES = tuple(settings.TYPES[code] for code in TYPE_CODES)
+
+type_index = dict((code, idx) for idx, code in enumerate(TYPE_CODES))
+flags = ('isRead', 'star', 'isSpam', 'isTrash')
+
+try:
+    #: `array` (and NumPy) typecode of the ``startTime`` column
+    INT64 = array('q').typecode
+except ValueError:
+    # Python 2 has no 'q' arrays, and a 32-bit long on Windows:
+    INT64 = 'l' if array('l').itemsize == 8 else 'd'
+
+
+class Columns(object):
+
+    """ Typed column arrays for a set of messages.
+
+        Columns are:
+
+        * id: `list` of `str`
+        * startTime: `array` of int64 epoch milliseconds
+        * type: `array` of int8 indexes into ``TYPE_CATEGORIES``
+          (-1 for a type missing from ``settings.TYPES``)
+        * isRead, star, isSpam, isTrash: `array` of uint8 booleans
+        * phoneNumber: `list` of `str`
+    """
+
+    fields = ('id', 'startTime', 'type') + flags + ('phoneNumber',)
+    categories = TYPE_CATEGORIES
+
+    def __init__(self):
+        self.id = []
+        self.startTime = array(INT64)
+        self.type = array('b')
+        self.isRead = array('B')
+        self.star = array('B')
+        self.isSpam = array('B')
+        self.isTrash = array('B')
+        self.phoneNumber = []
+
+    @classmethod
+    def from_messages(cls, messages):
+        """ Build columns from a feed’s raw ``messages`` mapping. """
+        return cls().extend(messages)
+
+    def extend(self, messages):
+        """ Append a feed’s raw ``messages`` mapping (id → data) to these
+            columns, returning ``self``.
+        """
+        for msgid, data in messages.items():
+            self.id.append(msgid)
+            self.startTime.append(int(data['startTime']))
+            self.type.append(type_index.get(data.get('type'), -1))
+            self.isRead.append(bool(data.get('isRead')))
+            self.star.append(bool(data.get('star')))
+            self.isSpam.append(bool(data.get('isSpam')))
+            self.isTrash.append(bool(data.get('isTrash')))
+            self.phoneNumber.append(data.get('phoneNumber') or '')
+        return self
+
+    def __len__(self):
+        return len(self.id)
+
+    def __repr__(self):
+        return '<Columns (%s)>' % len(self)
+
+    def to_numpy(self):
+        """ Returns a NumPy structured array with one record per message;
+            ``type`` holds category codes (see ``TYPE_CATEGORIES``).
+        """
+        import numpy
+        ids = numpy.asarray(self.id, dtype=str)
+        numbers = numpy.asarray(self.phoneNumber, dtype=str)
+        dtype = [('id', ids.dtype), ('startTime', 'i8'), ('type', 'i1')]
+        dtype += [(name, '?') for name in flags]
+        dtype += [('phoneNumber', numbers.dtype)]
+        result = numpy.empty(len(self), dtype=dtype)
+        result['id'] = ids
+        result['phoneNumber'] = numbers
+        result['startTime'] = numpy.frombuffer(self.startTime, INT64)
+        result['type'] = numpy.frombuffer(self.type, 'i1')
+        for name in flags:
+            result[name] = numpy.frombuffer(getattr(self, name), '?')
+        return result
+
+    def to_pandas(self):
+        """ Returns a pandas ``DataFrame`` indexed by message id, with a
+            categorical ``type`` column.
+        """
+        import numpy
+        import pandas
+        frame = pandas.DataFrame({
+            'startTime': numpy.frombuffer(self.startTime, INT64),
+            'type': pandas.Categorical.from_codes(
+                numpy.frombuffer(self.type, 'i1'),
+                categories=list(self.categories)),
+            'phoneNumber': self.phoneNumber,
+        }, index=pandas.Index(self.id, name='id'))
+        for name in flags:
+            frame[name] = numpy.frombuffer(getattr(self, name), '?')
+        return frame[list(self.fields[1:])]
+
+    def to_arrow(self):
+        """ Returns a ``pyarrow.Table``, with ``type`` dictionary-encoded. """
+        import pyarrow
+        codes = pyarrow.array([code if code >= 0 else None
+                               for code in self.type], type=pyarrow.int8())
+        columns = {
+            'id': pyarrow.array(self.id, type=pyarrow.string()),
+            'startTime': pyarrow.array(self.startTime, type=pyarrow.int64()),
+            'type': pyarrow.DictionaryArray.from_arrays(
+                codes, pyarrow.array(self.categories)),
+            'phoneNumber': pyarrow.array(self.phoneNumber,
+                                         type=pyarrow.string()),
+        }
+        for name in flags:
+            columns[name] = pyarrow.array(getattr(self, name),
+                                          type=pyarrow.uint8()).cast('bool')
+        return pyarrow.table([columns[name] for name in self.fields],
+                             names=list(self.fields))
@@ -0,0 +1,106 @@
+# encoding: utf-8
+""" Cached, indexed access to the contacts feed.
+
+    The ``contacts`` feed carries the account’s contacts along with its
+    ``phones`` and ``settings``. ``Contacts`` fetches it lazily, keeps it
+    for ``ttl`` seconds (or until ``invalidate()``), and builds hash
+    indexes by contact id and by E.164-normalized phone number – as well as the
+    ``Phone`` and settings wrappers – once per fetch.
+"""
+from __future__ import print_function
+
+import threading
+import time
+
+from . import util
+from .e164 import normalize
+
+
+class Contacts(object):
+
+    """ TTL cache over the contacts feed, with constant-time lookups.
+
+        ``fetch`` is a callable returning the contacts ``Folder`` (the
+        ``XMLParser`` for the feed); ``voice`` is handed to the ``Phone``
+        wrappers.
+    """
+
+    ttl = 300
+
+    def __init__(self, fetch, voice=None, ttl=None):
+        self.fetch = fetch
+        self.voice = voice
+        if ttl is not None:
+            self.ttl = ttl
+        self.lock = threading.RLock()
+        self.fetched = None
+        self._folder = None
+
+    def invalidate(self):
+        """ Drop the cached feed; the next access refetches it. """
+        with self.lock:
+            self.fetched = None
+
+    @property
+    def stale(self):
+        return self.fetched is None or time.time() - self.fetched > self.ttl
+
+    def ensure(self):
+        """ Refetch the feed if the cache is stale; returns ``self``. """
+        with self.lock:
+            if self.stale:
+                self.refresh()
+        return self
+
+    @property
+    def folder(self):
+        """ The contacts ``Folder``, refetched once the cache is stale. """
+        return self.ensure()._folder
+
+    def refresh(self):
+        """ Fetch the feed and rebuild every index from it. """
+        with self.lock:
+            folder = self.fetch()
+            by_id, by_number = {}, {}
+            for contact_id, data in (folder.get('contacts') or {}).items():
+                contact = util.AttrDict(data)
+                by_id[contact.contactId or contact_id] = contact
+                numbers = [entry.get('phoneNumber')
+                           for entry in contact.numbers or ()]
+                for number in [contact.phoneNumber] + numbers:
+                    if number:
+                        by_number.setdefault(normalize(number), contact)
+            self.by_id, self.by_number = by_id, by_number
+            self._phones = [util.Phone(self.voice, data)
+                            for data in (folder.get('phones') or {}).values()]
+            self._settings = util.AttrDict(folder.get('settings') or {})
+            self._folder = folder
+            self.fetched = time.time()
+            return folder
+
+    def get(self, contact_id):
+        """ The contact with the given id, or ``None``. """
+        return self.ensure().by_id.get(contact_id)
+
+    def lookup(self, number):
+        """ The contact owning phone ``number`` (in any format), or
+            ``None``.
+        """
+        return self.ensure().by_number.get(normalize(number))
+
+    @property
+    def phones(self):
+        """ `list` of the account’s ``Phone`` instances. """
+        return list(self.ensure()._phones)
+
+    @property
+    def settings(self):
+        """ The account settings, as an ``AttrDict``. """
+        return self.ensure()._settings
+
+    def __len__(self):
+        return len(self.ensure().by_id)
+
+    def __repr__(self):
+        return '<Contacts (%s)>' % (
+            'unfetched' if self._folder is None else len(self.by_id))
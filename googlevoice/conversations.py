@@ -0,0 +1,186 @@
+# encoding: utf-8
+""" Conversation threads over SMS and call history.
+
+    ``Conversations`` groups messages by their counterpart’s normalized
+    phone number into time-ordered ``Thread`` instances, and keeps the
+    threads ordered by last activity – so the most recent conversations
+    can be listed without scanning the whole history. It is built up
+    incrementally, one fetched page at a time:
+
+        >>> conversations = Conversations()
+        >>> for folder in voice.pages('sms'):
+        ...     conversations.add(folder)
+        >>> for thread in conversations.top(10):
+        ...     print(thread.number, thread.unread, thread.last)
+
+    Adding a message costs O(log n) in the number of threads, and O(1)
+    amortized within its thread: threads keep their messages in arrival
+    order and sort them only when next iterated – cheap, as pages arrive
+    in runs already in time order.
+"""
+from __future__ import print_function
+
+import heapq
+from datetime import datetime
+
+from . import util
+from .e164 import normalize
+
+EPOCH = datetime(1970, 1, 1, tzinfo=util.timezone.utc)
+
+
+def sort_key(message):
+    """ Time-ordering key of a ``Message``: its start time, then its id. """
+    return message.startDateTime, message.id
+
+
+class Thread(object):
+
+    """ The messages exchanged with one phone ``number``, kept in time
+        order, along with the ids of those still unread.
+    """
+
+    def __init__(self, number):
+        self.number = number
+        self.keys = []
+        self.ordered = True
+        self.newest = None
+        self.messages = {}
+        self.unseen = set()
+
+    def add(self, message):
+        """ Add a ``Message``, or – for an id already in the thread –
+            replace it with this fresher copy.
+        """
+        if message.id not in self.messages:
+            key = sort_key(message)
+            if self.newest is None or key > self.newest:
+                self.newest = key
+            elif self.keys:
+                self.ordered = False
+            self.keys.append(key)
+        self.messages[message.id] = message
+        if message.isRead:
+            self.unseen.discard(message.id)
+        else:
+            self.unseen.add(message.id)
+
+    @property
+    def unread(self):
+        """ The number of messages in the thread still unread. """
+        return len(self.unseen)
+
+    @property
+    def last(self):
+        """ The thread’s most recent ``Message``. """
+        return self.messages[self.newest[1]]
+
+    @property
+    def last_activity(self):
+        return self.newest[0]
+
+    def __iter__(self):
+        """ Messages, oldest first. """
+        if not self.ordered:
+            self.keys.sort()
+            self.ordered = True
+        return (self.messages[msgid] for _, msgid in self.keys)
+
+    def __len__(self):
+        return len(self.keys)
+
+    def __contains__(self, msgid):
+        return msgid in self.messages
+
+    def __repr__(self):
+        return '<Thread %s (%s, %s unread)>' % (
+            self.number, len(self), self.unread)
+
+
+class Conversations(object):
+
+    """ Index of ``Thread`` instances by normalized counterpart number,
+        ordered by last activity.
+        
+        The order is a heap of ``(-last activity, number)`` entries. A
+        thread whose activity moves gets a new entry, and the one it
+        replaces is dropped lazily, once it reaches the top of the heap.
+    """
+
+    def __init__(self):
+        self.threads = {}
+        self.order = []
+        self.ranks = {}
+
+    def add(self, messages):
+        """ Add a ``Folder`` (or an iterable of ``Message`` instances). """
+        if isinstance(messages, util.Folder):
+            messages = messages.messages
+        for message in messages:
+            self.add_message(message)
+        return self
+
+    def add_message(self, message):
+        listeners = getattr(getattr(message.folder, 'voice', None),
+                            'listeners', None)
+        if listeners is not None:
+            listeners.add(self)
+        number = normalize(message.phoneNumber)
+        thread = self.threads.get(number)
+        if thread is None:
+            thread = self.threads[number] = Thread(number)
+        thread.add(message)
+        rank = (-(thread.last_activity - EPOCH).total_seconds(), number)
+        if self.ranks.get(number) != rank:
+            self.ranks[number] = rank
+            heapq.heappush(self.order, rank)
+            if len(self.order) > 2 * len(self.ranks) + 64:
+                # Too many superseded entries: rebuild from the live ones.
+                self.order = list(self.ranks.values())
+                heapq.heapify(self.order)
+        return thread
+
+    def applied(self, message, operation):
+        """ Recount a thread’s unread messages once one of them is marked
+            read or unread locally (see ``Message.apply``).
+        """
+        thread = self.threads.get(normalize(message.phoneNumber))
+        if thread is not None and message.id in thread:
+            thread.add(message)
+
+    def thread(self, number):
+        """ The ``Thread`` with ``number`` (in any format), or ``None``. """
+        return self.threads.get(normalize(number))
+
+    def top(self, count=None):
+        """ The ``count`` most recently active threads, newest first, in
+            O(count log n).
+        """
+        if count is None:
+            count = len(self.threads)
+        found = []
+        while self.order and len(found) < count:
+            rank = heapq.heappop(self.order)
+            # Superseded entries are dropped for good:
+            if self.ranks.get(rank[1]) == rank:
+                found.append(rank)
+        for rank in found:
+            heapq.heappush(self.order, rank)
+        return [self.threads[number] for _, number in found]
+
+    @property
+    def unread(self):
+        """ `dict` of unread counts by number, for threads with any. """
+        return dict((number, thread.unread)
+                    for number, thread in self.threads.items()
+                    if thread.unread)
+
+    def __iter__(self):
+        """ Threads, most recently active first. """
+        return iter(self.top())
+
+    def __len__(self):
+        return len(self.threads)
+
+    def __repr__(self):
+        return '<Conversations (%s)>' % len(self)
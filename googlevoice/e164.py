@@ -0,0 +1,130 @@
+# encoding: utf-8
+""" Phone number normalization to E.164 (``+15555550100``).
+
+    Numbers come back from Google Voice – and go into it – in a mix of
+    formats: ``+15555550100``, ``(555) 555-0100``, ``1-800-FLOWERS``,
+    ``011 44 20 7123 4567``. ``normalize`` canonicalizes any of them, so
+    they can be compared and used as keys; results are memoized in a
+    bounded cache, and ``normalize_many`` handles large batches.
+
+    Numbers without a country code are assumed to be in ``DEFAULT_COUNTRY``
+    (North America). Anything that can’t be an E.164 number – SMS short
+    codes, say – comes back as its bare digits, which still make a stable
+    key; labels with no digits at all, like ``Private`` or ``Unknown``,
+    come back unchanged rather than spelled out on the keypad.
+"""
+from __future__ import print_function
+
+import re
+import string
+
+import six
+
+from .util import memoize
+
+DEFAULT_COUNTRY = '1'
+#: International call prefixes, replaced by ``+``
+PREFIXES = ('011', '00')
+
+
+class Table(dict):
+    """ Text ``translate`` table mapping keypad letters to digits, keeping
+        digits and ``+``, and dropping everything else.
+    """
+    
+    def __missing__(self, key):
+        self[key] = None
+        return None
+
+
+table = Table((ord(char), six.text_type(char))
+              for char in string.digits + '+')
+table.update(zip(map(ord, string.ascii_letters),
+                 six.text_type('22233344455566677778889999' * 2)))
+#: Finds a digit – without one, there’s no number to normalize
+has_digit = re.compile(r'[0-9]').search
+#: Extensions and dialing pauses, dropped before normalizing
+extension = re.compile(r'\s*(?:[,;#]|(?:ext|x)\.?\s*(?=\d)).*$',
+                       re.IGNORECASE)
+
+
+def _normalize(number, country=DEFAULT_COUNTRY):
+    if not has_digit(number):
+        return number
+    if isinstance(number, bytes):
+        # A Python 2 str:
+        number = number.decode('utf-8', 'replace')
+    if 'x' in number or 'X' in number or '#' in number or ',' in number \
+            or ';' in number:
+        number = extension.sub('', number)
+    digits = number.translate(table)
+    international = digits.startswith('+')
+    if '+' in digits:
+        digits = digits.replace('+', '')
+    if not international:
+        for prefix in PREFIXES:
+            if digits.startswith(prefix) and len(digits) > len(prefix) + 7:
+                digits = digits[len(prefix):]
+                international = True
+                break
+    if not international:
+        if country == '1' and len(digits) == 11 and digits[0] == '1':
+            international = True
+        elif country == '1' and len(digits) == 10 \
+                or country != '1' and len(digits) > 6:
+            digits = country + digits.lstrip('0')
+            international = True
+    if international and 7 < len(digits) <= 15:
+        return '+' + digits
+    return digits
+
+
+@memoize(65536)
+def normalize_cached(key):
+    """ ``_normalize(number, country)`` for a ``(number, country)`` key. """
+    return _normalize(*key)
+
+
+def normalize(number, country=DEFAULT_COUNTRY):
+    """ Canonicalize ``number`` to E.164, assuming it belongs to the
+        ``country`` calling code if it doesn’t say otherwise:
+
+            >>> normalize('(555) 555-0100')
+            '+15555550100'
+            >>> normalize('1-800-FLOWERS')
+            '+18003569377'
+            >>> normalize('011 44 20 7123 4567 ext. 12')
+            '+442071234567'
+            >>> normalize('22000')
+            '22000'
+            >>> normalize('Private')
+            'Private'
+
+        Returns ``''`` for ``None`` or empty input.
+    """
+    if not number:
+        return ''
+    return normalize_cached((number, country))
+
+
+def normalize_many(numbers, country=DEFAULT_COUNTRY):
+    """ Normalize an iterable of numbers, returning a `list`. Repeats
+        within the batch are served from a local table, so the shared
+        cache isn’t churned by batches of millions of numbers.
+    """
+    seen = {}
+    result = []
+    append = result.append
+    for number in numbers:
+        try:
+            append(seen[number])
+        except KeyError:
+            value = seen[number] = _normalize(number, country) \
+                if number else ''
+            append(value)
+    return result
+
+
+def same_number(first, second, country=DEFAULT_COUNTRY):
+    """ Whether two numbers, in whatever formats, are the same number. """
+    return normalize(first, country) == normalize(second, country)
@@ -0,0 +1,242 @@
+# encoding: utf-8
+""" Streaming export of folder history to JSONL, CSV or Parquet.
+
+    Pages are fetched, written and dropped one at a time, so memory use
+    stays constant however many years of history are exported. Invoke
+    as ``python -m googlevoice export [options] [feed ...]``.
+"""
+from __future__ import print_function
+
+import calendar
+import csv
+import gzip
+import io
+import json
+import sys
+import time
+from datetime import datetime
+from optparse import OptionParser
+
+import six
+
+from . import settings
+
+FORMATS = ('jsonl', 'csv', 'parquet')
+COMPRESSIONS = ('gzip', 'zstd')
+
+#: Columns of the CSV and Parquet formats (JSONL keeps every key)
+FIELDS = ('feed', 'id', 'startTime', 'displayStartDateTime', 'type',
+          'phoneNumber', 'displayNumber', 'isRead', 'star', 'isSpam',
+          'isTrash', 'labels', 'messageText', 'note')
+
+parser = OptionParser(usage='''gvoice [options] export [export-options] [feed ...]
+    Streams every page of the given feeds (default: all) to a file.''')
+parser.add_option("-f", "--format", dest="format", default=None,
+                  choices=FORMATS,
+                  help="Output format: %s (default: from the output "
+                       "file name, else jsonl)" % ', '.join(FORMATS))
+parser.add_option("-o", "--output", dest="output", default='-',
+                  help="Output file (default: standard output)")
+parser.add_option("-s", "--since", dest="since", default=None,
+                  help="Only export messages since this UTC date "
+                       "(YYYY-MM-DD[THH:MM]) or epoch milliseconds")
+parser.add_option("-z", "--compress", dest="compression", default=None,
+                  choices=COMPRESSIONS,
+                  help="Compress output with gzip or zstd (default: "
+                       "from the output file name)")
+
+
+def parse_since(value):
+    """ Convert a ``--since`` value to epoch milliseconds. """
+    if value is None or value.isdigit():
+        return value and int(value)
+    for fmt in ('%Y-%m-%dT%H:%M', '%Y-%m-%d'):
+        try:
+            stamp = datetime.strptime(value, fmt)
+        except ValueError:
+            continue
+        return calendar.timegm(stamp.timetuple()) * 1000
+    raise ValueError('Invalid --since value: %r' % value)
+
+
+def record(feed, msgid, data):
+    """ Flatten a feed’s raw message data into an export record. """
+    result = dict(data, feed=feed, id=msgid)
+    result['startTime'] = int(data['startTime'])
+    return result
+
+
+def open_output(path, compression=None):
+    """ Open ``path`` (``'-'`` for standard output) for binary writing,
+        optionally through a gzip or zstd compressor.
+        
+        Returns the stream to write to, and the `list` of streams to
+        close, in order, when done.
+    """
+    if path == '-':
+        raw, owned = getattr(sys.stdout, 'buffer', None), []
+        if raw is None:
+            # Python 2:
+            raw = io.open(sys.stdout.fileno(), 'wb', closefd=False)
+            owned = [raw]
+    else:
+        raw = io.open(path, 'wb')
+        owned = [raw]
+    if compression == 'gzip':
+        stream = gzip.GzipFile(fileobj=raw, mode='wb')
+    elif compression == 'zstd':
+        import zstandard
+        stream = zstandard.ZstdCompressor().stream_writer(raw, closefd=False)
+    else:
+        return raw, owned
+    return stream, [stream] + owned
+
+
+class JSONLWriter(object):
+    """ Writes one JSON object per line. """
+
+    def __init__(self, stream):
+        self.stream = io.TextIOWrapper(stream, encoding='utf-8', newline='')
+
+    def write(self, records):
+        for item in records:
+            self.stream.write(six.text_type(json.dumps(item, sort_keys=True)))
+            self.stream.write(u'\n')
+
+    def close(self):
+        self.stream.flush()
+        self.stream.detach()
+
+
+class Decoded(object):
+    """ Decodes the UTF-8 byte strings Python 2's ``csv`` writes, for a
+        text ``stream``.
+    """
+
+    def __init__(self, stream):
+        self.stream = stream
+
+    def write(self, data):
+        self.stream.write(data.decode('utf-8'))
+
+
+class CSVWriter(JSONLWriter):
+    """ Writes a header row, then one row of ``FIELDS`` per record. """
+
+    def __init__(self, stream):
+        super(CSVWriter, self).__init__(stream)
+        self.writer = csv.DictWriter(
+            Decoded(self.stream) if six.PY2 else self.stream, FIELDS,
+            extrasaction='ignore')
+        self.writer.writeheader()
+
+    def write(self, records):
+        for item in records:
+            item = dict(item)
+            item['labels'] = ','.join(item.get('labels') or ())
+            if six.PY2:
+                item = dict((key, value.encode('utf-8')
+                             if isinstance(value, six.text_type) else value)
+                            for key, value in item.items())
+            self.writer.writerow(item)
+
+
+class ParquetWriter(object):
+    """ Writes one Parquet row group of ``FIELDS`` per page. """
+
+    def __init__(self, stream, compression=None):
+        import pyarrow
+        import pyarrow.parquet
+        string, flag = pyarrow.string(), pyarrow.bool_()
+        self.pyarrow = pyarrow
+        self.schema = pyarrow.schema([
+            ('feed', string), ('id', string), ('startTime', pyarrow.int64()),
+            ('displayStartDateTime', string), ('type', pyarrow.int16()),
+            ('phoneNumber', string), ('displayNumber', string),
+            ('isRead', flag), ('star', flag), ('isSpam', flag),
+            ('isTrash', flag), ('labels', pyarrow.list_(string)),
+            ('messageText', string), ('note', string)])
+        self.writer = pyarrow.parquet.ParquetWriter(
+            stream, self.schema, compression=compression or 'none')
+
+    def write(self, records):
+        records = list(records)
+        if records:
+            columns = dict((name, [item.get(name) for item in records])
+                           for name in FIELDS)
+            self.writer.write_table(self.pyarrow.Table.from_pydict(
+                columns, schema=self.schema))
+
+    def close(self):
+        self.writer.close()
+
+
+def infer(path, format=None, compression=None):
+    """ Fill in the format and compression implied by an output path
+        such as ``history.csv.gz``.
+    """
+    parts = path.lower().split('.')
+    if compression is None and parts[-1] in ('gz', 'zst'):
+        compression = 'gzip' if parts.pop() == 'gz' else 'zstd'
+    if format is None:
+        format = parts[-1] if parts[-1] in FORMATS else 'jsonl'
+    return format, compression
+
+
+def export(voice, feeds=('all',), output='-', format=None, since=None,
+           compression=None, report=None):
+    """ Stream every page of each of ``feeds`` to ``output``, skipping
+        messages older than ``since`` (epoch milliseconds), and stopping
+        each feed after the first page reaching back past that.
+
+        Calls ``report(count, seconds)`` when done, and returns the number
+        of records written.
+    """
+    format, compression = infer(output, format, compression)
+    if format == 'parquet':
+        stream, owned = open_output(output)
+        writer = ParquetWriter(stream, compression)
+    else:
+        stream, owned = open_output(output, compression)
+        writer = (CSVWriter if format == 'csv' else JSONLWriter)(stream)
+    count, started = 0, time.time()
+    try:
+        for feed in feeds:
+            for folder in voice.pages(feed):
+                messages = folder['messages'].items()
+                records = [
+                    record(feed, msgid, data) for msgid, data in messages
+                    if since is None or int(data['startTime']) >= since]
+                writer.write(records)
+                count += len(records)
+                # Pages run newest first, so the next is older still:
+                if len(records) < len(messages):
+                    break
+    finally:
+        writer.close()
+        for each in owned:
+            each.close()
+    if report is not None:
+        report(count, time.time() - started)
+    return count
+
+
+def print_report(count, seconds):
+    """ Print an export’s throughput to standard error. """
+    print('Exported %d records in %.1fs (%.0f records/s)'
+          % (count, seconds, count / max(seconds, 1e-9)), file=sys.stderr)
+
+
+def main(voice, args):
+    """ Run the ``export`` command with its command-line ``args``. """
+    options, feeds = parser.parse_args(list(args))
+    unknown = [feed for feed in feeds if feed not in settings.FEEDS]
+    if unknown:
+        parser.error('Unknown feed(s): %s' % ', '.join(unknown))
+    try:
+        since = parse_since(options.since)
+    except ValueError as exc:
+        parser.error(str(exc))
+    return export(voice, feeds or ('all',), options.output,
+                  options.format, since, options.compression,
+                  report=print_report)
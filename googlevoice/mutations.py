@@ -0,0 +1,158 @@
+# encoding: utf-8
+""" Write-behind queue for message operations.
+
+    With ``voice.write_behind()`` enabled, ``star``, ``mark``, ``archive``
+    and ``delete`` no longer post one request each. The change is applied
+    to the local ``Message`` at once, and queued by message id and
+    operation – so toggling a message back and forth before the queue is
+    flushed posts nothing at all:
+
+        >>> voice.write_behind(interval=2.)
+        >>> message.mark(1)
+        >>> message.mark(0)       # cancels out
+        >>> message.star()
+        >>> voice.mutations.flush()
+        0
+
+    Pending operations are posted in batches – one request per operation
+    and value, covering many messages – from a background thread.
+"""
+from __future__ import print_function
+
+import logging
+import threading
+import time
+from collections import defaultdict
+
+from . import util
+
+log = logging.getLogger(__name__)
+
+
+class MutationQueue(object):
+
+    """ Pending message operations of a ``Voice`` instance, keyed by
+        ``(message id, operation)``; see ``Voice.write_behind()``.
+    """
+
+    #: Most message ids posted in one request
+    batch_size = 100
+
+    def __init__(self, voice, interval=1., threshold=50, callback=None):
+        self.voice = voice
+        self.interval = interval
+        self.threshold = threshold
+        self.callback = callback
+        # (id, operation) -> [value, value before the first change, message]
+        self.pending = {}
+        self.since = None
+        self.condition = threading.Condition()
+        self.flushing = threading.Lock()
+        self.stopped = False
+        self.thread = threading.Thread(target=self.run,
+                                       name='googlevoice-mutations')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def add(self, operation, messages, value):
+        """ Queue ``operation`` at ``value`` for ``(id, Message)`` pairs –
+            where the ``Message`` may be ``None`` – applying it locally.
+        """
+        value = int(value)
+        with self.condition:
+            for msgid, message in messages:
+                key = msgid, operation
+                entry = self.pending.get(key)
+                if entry is None:
+                    original = None if message is None \
+                        else message.state(operation)
+                    entry = self.pending[key] = [value, original, message]
+                entry[0] = value
+                if message is not None:
+                    entry[2] = message
+                    message.apply(operation, value)
+                if entry[0] == entry[1]:
+                    # Back where the server has it, so nothing to post:
+                    del self.pending[key]
+            if self.pending and self.since is None:
+                self.since = time.time()
+                self.condition.notify()
+            elif not self.pending:
+                self.since = None
+            if len(self.pending) >= self.threshold:
+                self.condition.notify()
+
+    def __len__(self):
+        return len(self.pending)
+
+    def flush(self):
+        """ Post every pending operation now; returns the number of
+            requests that failed.
+        """
+        with self.flushing:
+            with self.condition:
+                pending, self.pending, self.since = self.pending, {}, None
+            batches = defaultdict(list)
+            for (msgid, operation), entry in pending.items():
+                batches[operation, entry[0]].append(msgid)
+            failures = 0
+            for (operation, value), ids in sorted(batches.items()):
+                for start in range(0, len(ids), self.batch_size):
+                    chunk = ids[start:start + self.batch_size]
+                    try:
+                        util.load_and_validate(self.voice.__post_messages(
+                            operation, chunk, value))
+                    except Exception as exc:
+                        failures += 1
+                        self.failed(operation, chunk, value, exc, pending)
+            return failures
+
+    def failed(self, operation, ids, value, error, pending):
+        """ Roll back a failed post locally, and report it. """
+        log.warning('Posting %s=%s for %s messages failed: %s',
+                    operation, value, len(ids), error)
+        for msgid in ids:
+            _, original, message = pending[msgid, operation]
+            # Leave messages changed again since alone:
+            if message is not None and original is not None \
+                    and (msgid, operation) not in self.pending:
+                message.apply(operation, original)
+        if self.callback is not None:
+            try:
+                self.callback(operation, ids, value, error)
+            except Exception:
+                log.exception('Mutation callback %r failed', self.callback)
+
+    def run(self):
+        """ Flush whenever the oldest pending operation is ``interval``
+            seconds old, or ``threshold`` are pending.
+        """
+        while True:
+            with self.condition:
+                while not self.stopped:
+                    if len(self.pending) >= self.threshold:
+                        break
+                    if self.since is None:
+                        self.condition.wait()
+                        continue
+                    timeout = self.since + self.interval - time.time()
+                    if timeout <= 0:
+                        break
+                    self.condition.wait(timeout)
+                if self.stopped:
+                    return
+            try:
+                self.flush()
+            except Exception:
+                log.exception('Mutation flush failed')
+
+    def close(self):
+        """ Flush what’s pending, and stop the background thread. """
+        with self.condition:
+            self.stopped = True
+            self.condition.notify()
+        self.thread.join()
+        return self.flush()
+
+    def __repr__(self):
+        return '<MutationQueue (%s pending)>' % len(self)
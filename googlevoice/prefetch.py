@@ -0,0 +1,187 @@
+# encoding: utf-8
+""" Background prefetching of folders, for the interactive shell.
+
+    A ``Prefetcher`` counts which folders the user views, and – while the
+    shell sits idle at its prompt – keeps the most viewed ones refreshed
+    on a background thread, so that viewing them returns at once:
+
+        >>> prefetcher = Prefetcher(voice, ttl=60.)
+        >>> prefetcher.idle()          # waiting for input
+        >>> folder = prefetcher.get('inbox')
+        >>> staleness(prefetcher.age('inbox'))
+        'fetched 12s ago'
+
+    Folders are refreshed once they are half of ``ttl`` old, and fetched
+    in the foreground once they are older than ``ttl``; ``get(name,
+    refresh=True)`` always fetches. ``pause()`` on logging out, and
+    ``resume()`` on logging back in; ``close()`` when done.
+"""
+from __future__ import print_function
+
+import collections
+import logging
+import threading
+import time
+
+log = logging.getLogger(__name__)
+
+
+def staleness(age):
+    """ A short description of how old ``age`` seconds of data is. """
+    if age < 1:
+        return 'just fetched'
+    if age < 120:
+        return 'fetched %ds ago' % age
+    return 'fetched %dm ago' % (age // 60)
+
+
+class Prefetcher(object):
+
+    """ Caches folders of a logged-in ``Voice`` instance for ``ttl``
+        seconds, refreshing the ``top`` most viewed in the background
+        while ``idle()``. Folders named in ``initial`` are prefetched
+        before they are first viewed.
+    """
+
+    def __init__(self, voice, ttl=60., top=3, initial=('inbox',),
+                 clock=time.time):
+        self.voice = voice
+        self.ttl = ttl
+        self.top = top
+        self.clock = clock
+        self.views = collections.Counter(dict.fromkeys(initial, 0))
+        # name -> (folder, when it was fetched)
+        self.cache = {}
+        self.attempted = {}
+        # Bumped by clear(), so fetches begun before it aren’t cached:
+        self.generation = 0
+        self.waiting = False
+        self.paused = False
+        self.stopped = False
+        self.condition = threading.Condition()
+        self.thread = threading.Thread(target=self.run,
+                                       name='googlevoice-prefetch')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def age(self, name):
+        """ Seconds since the cached folder ``name`` was fetched, or
+            ``None`` if it isn’t cached.
+        """
+        entry = self.cache.get(name)
+        if entry is None:
+            return None
+        return max(0, self.clock() - entry[1])
+
+    def fetch(self, name):
+        started, generation = self.clock(), self.generation
+        folder = getattr(self.voice, name)()
+        with self.condition:
+            # Keep whichever of overlapping fetches started last – if
+            # none started before the cache was last cleared:
+            current = self.cache.get(name)
+            if generation == self.generation and (
+                    current is None or current[1] <= started):
+                self.cache[name] = folder, started
+            self.condition.notify()
+        return folder
+
+    def get(self, name, refresh=False):
+        """ The folder ``name`` – from the cache, unless it is older than
+            ``ttl`` or ``refresh`` is set – counting it as viewed.
+        """
+        with self.condition:
+            self.views[name] += 1
+            age = self.age(name)
+            if not refresh and age is not None and age <= self.ttl:
+                return self.cache[name][0]
+        return self.fetch(name)
+
+    def favourites(self):
+        """ The ``top`` most viewed folder names. """
+        return [name for name, _ in self.views.most_common(self.top)]
+
+    def due(self, now):
+        """ The first favourite due a refresh at ``now``, and the seconds
+            until the next one is due otherwise.
+        """
+        wait = None
+        for name in self.favourites():
+            entry = self.cache.get(name)
+            last = max(entry[1] if entry is not None else 0,
+                       self.attempted.get(name, 0))
+            remaining = last + self.ttl / 2. - now
+            if remaining <= 0:
+                return name, None
+            wait = remaining if wait is None else min(wait, remaining)
+        return None, wait
+
+    def run(self):
+        """ Refresh favourites as they come due, while idle. """
+        while True:
+            with self.condition:
+                while not self.stopped:
+                    if self.waiting and not self.paused:
+                        name, wait = self.due(self.clock())
+                        if name is not None:
+                            break
+                    else:
+                        wait = None
+                    self.condition.wait(wait)
+                if self.stopped:
+                    return
+                # Failed fetches are retried no sooner than a success:
+                self.attempted[name] = self.clock()
+            try:
+                self.fetch(name)
+            except Exception as exc:
+                # Failures after pause() – say, from logging out – are
+                # expected, and not worth interrupting the prompt for:
+                log.log(logging.DEBUG if self.paused else logging.WARNING,
+                        'Prefetching %s failed: %s', name, exc)
+
+    def idle(self):
+        """ Let the background thread fetch – e.g. while at the prompt. """
+        with self.condition:
+            self.waiting = True
+            self.condition.notify()
+
+    def busy(self):
+        """ Stop starting background fetches – e.g. while running a
+            command. A fetch already under way still completes.
+        """
+        with self.condition:
+            self.waiting = False
+
+    def clear(self):
+        """ Forget every cached folder – including those of fetches
+            still under way.
+        """
+        with self.condition:
+            self.cache.clear()
+            self.attempted.clear()
+            self.generation += 1
+
+    def pause(self):
+        """ Stop background fetching, and forget every cached folder –
+            e.g. on logging out.
+        """
+        with self.condition:
+            self.paused = True
+            self.clear()
+
+    def resume(self):
+        """ Start background fetching again, e.g. on logging back in. """
+        with self.condition:
+            self.paused = False
+            self.condition.notify()
+
+    def close(self):
+        """ Stop the background thread. """
+        with self.condition:
+            self.stopped = True
+            self.condition.notify()
+        self.thread.join()
+
+    def __repr__(self):
+        return '<Prefetcher (%s cached)>' % len(self.cache)
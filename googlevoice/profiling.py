@@ -0,0 +1,225 @@
+# encoding: utf-8
+""" Profiling mode, for finding out where a slow command spends its time.
+
+    A ``Profiler`` runs ``cProfile`` over the calling thread, samples the
+    stacks of every thread on a background thread, and traces memory
+    allocations with ``tracemalloc`` (on Python 3). Time is also
+    attributed to the phases marked out in ``voice.py`` and ``util.py``
+    with ``phase()``:
+
+    * network: HTTP requests
+    * parse: expat parsing of feed responses
+    * decode: JSON decoding of feed payloads
+    * build: ``Message`` construction
+
+    When stopped, it writes three files next to its ``prefix``:
+
+    * ``PREFIX.txt``: phase totals, the memory peak, and the ``cProfile``
+      report sorted by cumulative time
+    * ``PREFIX.collapsed``: sampled stacks, collapsed one per line and
+      rooted at their phase, for ``flamegraph.pl`` or speedscope
+    * ``PREFIX.prof``: the raw ``cProfile`` statistics, for ``pstats``
+
+    Enable it with ``python -m googlevoice --profile PREFIX …``, or – for
+    library use – by setting the ``GOOGLEVOICE_PROFILE`` environment
+    variable to a prefix before creating the first ``Voice`` instance;
+    the report is then written at exit. Importing ``googlevoice`` alone
+    never starts it.
+"""
+from __future__ import print_function
+
+import atexit
+import collections
+import cProfile
+import io
+import os
+import pstats
+import sys
+import threading
+import time
+from contextlib import contextmanager
+
+import six
+
+try:
+    import tracemalloc
+except ImportError:  # Python 2
+    tracemalloc = None
+
+#: The running ``Profiler``, if any
+active = None
+
+#: Phase stacks by thread id, while profiling
+phases = {}
+
+#: Whether ``from_environment()`` has looked at ``os.environ`` yet
+environment_checked = False
+
+
+@contextmanager
+def phase(name):
+    """ Attribute the time spent in the ``with`` block to phase ``name``
+        – doing nothing at all unless a ``Profiler`` is running.
+    """
+    profiler = active
+    if profiler is None:
+        yield
+        return
+    stack = phases.setdefault(threading.current_thread().ident, [])
+    stack.append(name)
+    started = time.time()
+    try:
+        yield
+    finally:
+        profiler.record(name, time.time() - started)
+        stack.pop()
+
+
+def frame_name(frame):
+    code = frame.f_code
+    return '%s:%s' % (os.path.basename(code.co_filename), code.co_name)
+
+
+class Profiler(object):
+
+    """ Profiles the process between ``start()`` and ``stop()``, writing
+        its report to files named after ``prefix``; stacks are sampled
+        every ``interval`` seconds.
+    """
+
+    def __init__(self, prefix='googlevoice-profile', interval=0.005):
+        self.prefix = prefix
+        self.interval = interval
+        self.profile = cProfile.Profile()
+        self.lock = threading.Lock()
+        self.totals = collections.defaultdict(float)
+        self.calls = collections.Counter()
+        self.stacks = collections.Counter()
+        self.stopped = threading.Event()
+        self.sampler = None
+        self.peak = None
+        self.started = None
+
+    def record(self, name, seconds):
+        with self.lock:
+            self.totals[name] += seconds
+            self.calls[name] += 1
+
+    def sample(self):
+        """ Collapse the current stack of every other thread. """
+        own = threading.current_thread().ident
+        for ident, frame in sys._current_frames().items():
+            if ident == own:
+                continue
+            names = []
+            while frame is not None:
+                names.append(frame_name(frame))
+                frame = frame.f_back
+            stack = phases.get(ident)
+            root = 'phase:%s' % (stack[-1] if stack else 'other')
+            self.stacks[';'.join([root] + names[::-1])] += 1
+
+    def run_sampler(self):
+        while not self.stopped.wait(self.interval):
+            self.sample()
+
+    def start(self):
+        """ Start profiling; returns ``self``. """
+        global active
+        if active is not None:
+            raise RuntimeError('Already profiling')
+        active = self
+        self.started = time.time()
+        self.tracing = tracemalloc is not None \
+            and not tracemalloc.is_tracing()
+        if self.tracing:
+            tracemalloc.start()
+        elif hasattr(tracemalloc, 'reset_peak'):
+            tracemalloc.reset_peak()
+        self.sampler = threading.Thread(target=self.run_sampler,
+                                        name='googlevoice-profiler')
+        self.sampler.daemon = True
+        self.sampler.start()
+        self.profile.enable()
+        return self
+
+    def stop(self):
+        """ Stop profiling, and write the report; returns the paths
+            written – or ``None``, if it was already stopped.
+        """
+        global active
+        if self.stopped.is_set():
+            return None
+        self.profile.disable()
+        self.stopped.set()
+        self.sampler.join()
+        if tracemalloc is not None:
+            self.peak = tracemalloc.get_traced_memory()[1]
+        if self.tracing:
+            tracemalloc.stop()
+        active = None
+        phases.clear()
+        return self.write()
+
+    def report(self):
+        """ The text report: phase totals, memory peak and ``cProfile``
+            statistics by cumulative time.
+        """
+        out = six.StringIO()
+        elapsed = time.time() - self.started
+        memory = 'not traced' if self.peak is None \
+            else '%.1f MB' % (self.peak / 1e6)
+        out.write('Profiled %.3f s; peak traced memory %s\n\n'
+                  % (elapsed, memory))
+        out.write('%-10s %10s %8s %7s\n'
+                  % ('phase', 'seconds', 'calls', 'share'))
+        for name, seconds in sorted(self.totals.items(),
+                                    key=lambda item: -item[1]):
+            out.write('%-10s %10.3f %8d %6.1f%%\n' % (
+                name, seconds, self.calls[name],
+                100. * seconds / elapsed if elapsed else 0))
+        out.write('\n')
+        stats = pstats.Stats(self.profile, stream=out)
+        stats.sort_stats('cumulative').print_stats(40)
+        return out.getvalue()
+
+    def write(self):
+        paths = dict((kind, '%s.%s' % (self.prefix, kind))
+                     for kind in ('txt', 'collapsed', 'prof'))
+        with io.open(paths['txt'], 'w', encoding='utf-8') as stream:
+            stream.write(six.ensure_text(self.report()))
+        with io.open(paths['collapsed'], 'w', encoding='utf-8') as stream:
+            for stack, count in sorted(self.stacks.items()):
+                stream.write(six.ensure_text('%s %d\n' % (stack, count)))
+        self.profile.dump_stats(paths['prof'])
+        return paths
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+
+def from_environment(environ=None):
+    """ Start a ``Profiler`` writing to the prefix named by the
+        ``GOOGLEVOICE_PROFILE`` environment variable, if it is set, and
+        stop it at exit; returns the profiler, or ``None``.
+        
+        ``Voice`` instances call this as they are created, but only the
+        first call looks at ``os.environ`` – so the variable starts one
+        profiler per process at most.
+    """
+    global environment_checked
+    if environ is None:
+        if environment_checked:
+            return None
+        environment_checked, environ = True, os.environ
+    prefix = environ.get('GOOGLEVOICE_PROFILE')
+    if not prefix or active is not None:
+        return None
+    if prefix.lower() in ('1', 'true', 'yes'):
+        prefix = 'googlevoice-profile'
+    profiler = Profiler(prefix).start()
+    atexit.register(profiler.stop)
+    return profiler
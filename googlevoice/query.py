@@ -0,0 +1,234 @@
+# encoding: utf-8
+""" Indexed queries over fetched messages.
+
+    A ``MessageIndex`` keeps secondary indexes over raw message data –
+    by type, read/star/spam/trash flag, label and normalized number, plus
+    a sorted start-time index for range queries – and is updated
+    incrementally as pages are added, and as message operations (marking
+    read, starring, deleting…) are applied to their messages:
+
+        >>> index = MessageIndex()
+        >>> for folder in voice.pages('all'):
+        ...     index.add(folder)
+        >>> index.query(type='voicemail', isRead=False,
+        ...             since=datetime(2019, 6, 1), number='555-555-0100')
+        [<Message #... (+15555550100)>, ...]
+
+    ``Folder.query(...)`` does the same over a single folder.
+"""
+from __future__ import print_function
+
+import calendar
+from bisect import bisect_left, insort
+from collections import defaultdict
+from datetime import datetime
+
+import six
+
+from . import settings
+from .e164 import normalize
+
+FLAGS = ('isRead', 'star', 'isSpam', 'isTrash')
+
+
+def type_codes(value):
+    """ The ``settings.TYPES`` codes matching ``value``: a code, or a name
+        such as ``'voicemail'`` – where ``'sms'`` matches both
+        ``'sms.received'`` and ``'sms.sent'``.
+    """
+    if isinstance(value, int):
+        return (value,)
+    return tuple(code for code, name in settings.TYPES.items()
+                 if name == value or name.startswith(value + '.'))
+
+
+def milliseconds(value):
+    """ Epoch milliseconds for a `datetime` (naive ones taken as UTC), or
+        for a number that already is epoch milliseconds.
+    """
+    if isinstance(value, datetime):
+        return calendar.timegm(value.utctimetuple()) * 1000 \
+            + value.microsecond // 1000
+    return int(value)
+
+
+class MessageIndex(object):
+
+    """ Secondary indexes over messages, keyed by message id. """
+
+    def __init__(self, folders=()):
+        self.data = {}
+        self.folders = {}
+        self.instances = {}
+        self.by_type = defaultdict(set)
+        self.by_flag = dict((flag, set()) for flag in FLAGS)
+        self.by_label = defaultdict(set)
+        self.by_number = defaultdict(set)
+        self.stamps = {}
+        # (-startTime, id) pairs, ascending – that is, newest first:
+        self.times = []
+        for folder in folders:
+            self.add(folder)
+
+    def add(self, folder):
+        """ Index (or re-index) every message of a ``Folder`` page;
+            returns ``self``.
+        """
+        self.listen(folder)
+        entries = sorted(self.index(folder, msgid, data)
+                         for msgid, data in folder['messages'].items())
+        # Pages come newest first, so usually just append to the end:
+        if entries and self.times and entries[0] < self.times[-1]:
+            self.times.extend(entries)
+            self.times.sort()
+        else:
+            self.times.extend(entries)
+        return self
+
+    def add_message(self, folder, msgid, data):
+        """ Index (or re-index) a single message. """
+        self.listen(folder)
+        insort(self.times, self.index(folder, msgid, data))
+
+    def index(self, folder, msgid, data):
+        """ Add a message to the hash indexes, returning its entry for
+            the start-time index.
+        """
+        if msgid in self.data:
+            self.remove(msgid)
+        self.data[msgid] = data
+        self.folders[msgid] = folder
+        self.by_type[data.get('type')].add(msgid)
+        for flag in FLAGS:
+            if data.get(flag):
+                self.by_flag[flag].add(msgid)
+        for label in data.get('labels') or ():
+            self.by_label[label].add(msgid)
+        self.by_number[normalize(data.get('phoneNumber'))].add(msgid)
+        stamp = self.stamps[msgid] = int(data['startTime'])
+        return -stamp, msgid
+
+    def listen(self, folder):
+        """ Follow operations applied to messages of ``folder``’s voice. """
+        listeners = getattr(folder.voice, 'listeners', None)
+        if listeners is not None:
+            listeners.add(self)
+
+    def applied(self, message, operation):
+        """ Re-index the flags and labels of a ``Message`` that had an
+            operation applied to it locally (see ``Message.apply``).
+        """
+        msgid = message.id
+        data = self.data.get(msgid)
+        if data is None:
+            return
+        for flag in FLAGS:
+            self.by_flag[flag].discard(msgid)
+        for label in data.get('labels') or ():
+            self.by_label[label].discard(msgid)
+        # A copy: the folder’s own data stays as it was fetched.
+        data = self.data[msgid] = dict(data)
+        data.update((field, message[field]) for field in FLAGS + ('labels',)
+                    if field in message)
+        for flag in FLAGS:
+            if data.get(flag):
+                self.by_flag[flag].add(msgid)
+        for label in data.get('labels') or ():
+            self.by_label[label].add(msgid)
+
+    def remove(self, msgid):
+        """ Drop a message from every index. """
+        data = self.data.pop(msgid)
+        del self.folders[msgid]
+        self.instances.pop(msgid, None)
+        self.by_type[data.get('type')].discard(msgid)
+        for flag in FLAGS:
+            self.by_flag[flag].discard(msgid)
+        for label in data.get('labels') or ():
+            self.by_label[label].discard(msgid)
+        self.by_number[normalize(data.get('phoneNumber'))].discard(msgid)
+        stamp = self.stamps.pop(msgid)
+        del self.times[bisect_left(self.times, (-stamp, msgid))]
+
+    def message(self, msgid):
+        """ The ``Message`` for an indexed id, built on first use. """
+        message = self.instances.get(msgid)
+        if message is None:
+            message = self.instances[msgid] = self.folders[msgid].message(
+                msgid, self.data[msgid])
+        return message
+
+    def ids(self, type=None, since=None, until=None, number=None,
+            label=None, **flags):
+        """ Ids of messages matching every given filter, newest first:
+
+            * type: ``settings.TYPES`` code or name (``'sms'`` for both
+              directions)
+            * since, until: `datetime` or epoch milliseconds, inclusive
+            * number: counterpart phone number, in any format
+            * label: one label, or a `list` of labels all required
+            * isRead, star, isSpam, isTrash: `bool`
+        """
+        sets, exclude = [], []
+        if type is not None:
+            codes = type_codes(type)
+            sets.append(set().union(*[self.by_type.get(code, ())
+                                      for code in codes]))
+        if number is not None:
+            sets.append(self.by_number.get(normalize(number), set()))
+        if label is not None:
+            labels = [label] if isinstance(label, six.string_types) else label
+            sets.extend(self.by_label.get(each, set()) for each in labels)
+        for flag, value in flags.items():
+            if flag not in self.by_flag:
+                raise TypeError('Unknown filter: %s' % flag)
+            (sets if value else exclude).append(self.by_flag[flag])
+
+        start = None if since is None else milliseconds(since)
+        end = None if until is None else milliseconds(until)
+        low = 0 if end is None else bisect_left(self.times, (-end,))
+        high = len(self.times) if start is None else bisect_left(
+            self.times, (1 - start,))
+        ranged = start is not None or end is not None
+        sets.sort(key=len)
+
+        if sets and (not ranged or len(sets[0]) < high - low):
+            # The smallest indexed set beats scanning the time range:
+            candidates = sets[0].intersection(*sets[1:])
+            if exclude:
+                candidates = candidates.difference(*exclude)
+            stamps = self.stamps
+            if ranged:
+                start = float('-inf') if start is None else start
+                end = float('inf') if end is None else end
+                candidates = [msgid for msgid in candidates
+                              if start <= stamps[msgid] <= end]
+            return [msgid for _, msgid in sorted(
+                (-stamps[msgid], msgid) for msgid in candidates)]
+
+        return [msgid for _, msgid in self.times[low:high]
+                if all(msgid in each for each in sets)
+                and not any(msgid in each for each in exclude)]
+
+    def query(self, where=None, limit=None, **filters):
+        """ ``Message`` instances matching the ``filters`` (see ``ids``),
+            newest first; ``where`` may add any predicate on a ``Message``,
+            checked after the indexed filters.
+        """
+        result = []
+        for msgid in self.ids(**filters):
+            message = self.message(msgid)
+            if where is None or where(message):
+                result.append(message)
+                if limit is not None and len(result) >= limit:
+                    break
+        return result
+
+    def __len__(self):
+        return len(self.data)
+
+    def __contains__(self, msgid):
+        return msgid in self.data
+
+    def __repr__(self):
+        return '<MessageIndex (%s)>' % len(self)
@@ -0,0 +1,233 @@
+# encoding: utf-8
+""" Streaming output of folder listings, as a table, JSON or TSV.
+
+    Messages are written one row at a time as they come off each page,
+    so the first rows show up while later pages are still unfetched – and
+    with ``limit``, pages past the last row shown are never fetched:
+
+        >>> render(voice, 'all', limit=50, columns=('id', 'displayNumber'))
+
+    From the command line, ``python -m googlevoice list [options] [feed]``;
+    folder commands in the interactive shell take the same options, e.g.
+    ``gvoice> i -n 20 -f tsv``.
+"""
+from __future__ import print_function
+
+import itertools
+import json
+import sys
+from datetime import datetime
+from optparse import OptionParser
+
+from . import settings
+
+FORMATS = ('table', 'json', 'tsv')
+
+#: Columns shown unless others are selected
+COLUMNS = ('id', 'displayStartDateTime', 'displayNumber', 'type', 'isRead',
+           'star', 'messageText')
+
+#: Table widths of known columns; others get ``DEFAULT_WIDTH``
+WIDTHS = {
+    'id': 40, 'displayStartDateTime': 19, 'startDateTime': 25,
+    'localStartDateTime': 25, 'displayNumber': 16, 'phoneNumber': 14,
+    'type': 9, 'isRead': 6, 'star': 4, 'isSpam': 6, 'isTrash': 7,
+    'relativeStartTime': 14, 'labels': 24,
+}
+DEFAULT_WIDTH = 20
+
+parser = OptionParser(usage='''gvoice [options] list [list-options] [feed]
+    Lists the messages of a feed (default: inbox), page by page.''')
+parser.add_option("-c", "--columns", dest="columns", default=None,
+                  help="Comma-separated message fields to show (default: "
+                       "%s)" % ','.join(COLUMNS))
+parser.add_option("-f", "--format", dest="format", default='table',
+                  choices=FORMATS,
+                  help="Output format: %s (default: table)"
+                       % ', '.join(FORMATS))
+parser.add_option("-n", "--limit", dest="limit", default=None, type='int',
+                  help="Stop after this many messages, fetching only the "
+                       "pages needed")
+parser.add_option("-a", "--all", dest="everything", default=False,
+                  action="store_true",
+                  help="Continue through every page (default: only the "
+                       "first, unless --limit is given)")
+parser.add_option("-q", "--query", dest="query", default=None,
+                  help="Search query, for the search feed")
+
+
+def value(message, column):
+    """ The raw value of a message field, ``id`` included. """
+    if column == 'id':
+        return message.id
+    return message.get(column)
+
+
+def text(item):
+    """ Flatten a field value into a single line of text. """
+    if item is None:
+        return ''
+    if isinstance(item, bool):
+        return 'yes' if item else ''
+    if isinstance(item, (list, tuple)):
+        return ','.join(text(part) for part in item)
+    if isinstance(item, datetime):
+        return item.isoformat(' ')
+    return u' '.join((u'%s' % (item,)).split())
+
+
+class TableRenderer(object):
+    """ Writes a header, then one fixed-width row per message, cutting
+        long values short.
+    """
+
+    def __init__(self, stream, columns):
+        self.stream = stream
+        self.columns = columns
+        self.widths = [WIDTHS.get(column, DEFAULT_WIDTH)
+                       for column in columns]
+        self.count = 0
+
+    def row(self, cells):
+        # The last column needs no padding, nor cutting short:
+        padded = [(cell if len(cell) <= width
+                   else cell[:width - 1] + u'…').ljust(width)
+                  for cell, width in zip(cells[:-1], self.widths)]
+        return u'  '.join(padded + [cells[-1]]) + u'\n'
+
+    def header(self):
+        self.stream.write(self.row(list(self.columns)))
+        self.stream.write(u'  '.join(u'-' * width
+                                     for width in self.widths) + u'\n')
+
+    def write(self, message):
+        if not self.count:
+            self.header()
+        self.count += 1
+        self.stream.write(self.row([text(value(message, column))
+                                    for column in self.columns]))
+        self.stream.flush()
+
+    def close(self):
+        if not self.count:
+            self.stream.write(u'(no messages)\n')
+        self.stream.flush()
+
+
+class TSVRenderer(TableRenderer):
+    """ Writes a header row, then one tab-separated row per message. """
+
+    def header(self):
+        self.stream.write(u'\t'.join(self.columns) + u'\n')
+
+    def row(self, cells):
+        return u'\t'.join(cells) + u'\n'
+
+    def close(self):
+        if not self.count:
+            self.header()
+        self.stream.flush()
+
+
+class JSONRenderer(TableRenderer):
+    """ Writes a JSON array of objects, one message per line. """
+
+    def header(self):
+        self.stream.write(u'[\n')
+
+    def write(self, message):
+        if self.count:
+            self.stream.write(u',\n')
+        else:
+            self.header()
+        self.count += 1
+        self.stream.write(json.dumps(dict(
+            (column, value(message, column)) for column in self.columns),
+            default=str, sort_keys=True))
+        self.stream.flush()
+
+    def close(self):
+        self.stream.write(u'\n]\n' if self.count else u'[]\n')
+        self.stream.flush()
+
+
+renderers = {'table': TableRenderer, 'tsv': TSVRenderer,
+             'json': JSONRenderer}
+
+
+def folders(voice, feed, query=None, first=None):
+    """ Iterate over the pages of a feed, starting with a ``first`` page
+        already at hand if there is one.
+    """
+    if first is None:
+        return voice.pages(feed, query)
+    # Without a page size, take the first page’s as one:
+    size = first.get('resultsPerPage') or len(first['messages'])
+    total = first.get('totalSize')
+    if total is not None and size >= total:
+        return iter([first])
+    return itertools.chain([first], voice.pages(feed, query, start=2))
+
+
+def messages(pages, limit=None, everything=False):
+    """ Yield each ``Message`` of successive ``pages`` as it is built,
+        stopping after ``limit`` of them – or after the first page, with
+        neither ``limit`` nor ``everything``. The next page is only
+        fetched once the previous one is used up.
+    """
+    count = 0
+    for folder in pages:
+        for msgid, data in folder['messages'].items():
+            if limit is not None and count >= limit:
+                return
+            count += 1
+            yield folder.message(msgid, data)
+        if limit is None and not everything:
+            return
+        if limit is not None and count >= limit:
+            return
+
+
+def render(voice, feed, query=None, limit=None, everything=False,
+           columns=COLUMNS, format='table', stream=None, first=None):
+    """ Write the messages of a feed to ``stream`` (default: standard
+        output) as they are fetched; returns the number written.
+    """
+    if stream is None:
+        stream = sys.stdout
+    renderer = renderers[format](stream, tuple(columns))
+    try:
+        for message in messages(folders(voice, feed, query, first),
+                                limit, everything):
+            renderer.write(message)
+    finally:
+        renderer.close()
+    return renderer.count
+
+
+def parse_args(args):
+    """ Parse ``list`` options and a feed name from ``args``. """
+    options, feeds = parser.parse_args(list(args))
+    if len(feeds) > 1:
+        parser.error('Only one feed may be listed at a time')
+    feed = feeds[0] if feeds else 'inbox'
+    if feed not in settings.FEEDS + ('search',):
+        parser.error('Unknown feed: %s' % feed)
+    if options.limit is not None and options.limit < 0:
+        parser.error('--limit must not be negative')
+    if options.columns is None:
+        options.columns = COLUMNS
+    else:
+        options.columns = tuple(column.strip() for column
+                                in options.columns.split(',')
+                                if column.strip())
+        if not options.columns:
+            parser.error('--columns must name at least one column')
+    return options, feed
+
+
+def main(voice, args):
+    """ Run the ``list`` command with its command-line ``args``. """
+    options, feed = parse_args(args)
+    return render(voice, feed, options.query, options.limit,
+                  options.everything, options.columns, options.format)
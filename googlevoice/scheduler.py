@@ -0,0 +1,538 @@
+# encoding: utf-8
+""" Deferred calls and SMS, run over one long-lived session.
+
+    Jobs – any ``batch`` command, such as ``call`` or ``send_sms``, along
+    with the time it is due – are kept in a SQLite ``Queue`` so they
+    survive restarts. A ``Scheduler`` loads the pending ones into a heap
+    keyed by due time, sleeps until the earliest is due, and runs due
+    jobs against one logged-in ``Voice`` instance on a bounded worker
+    pool, retrying failures with exponential backoff. It also rereads
+    the queue every few seconds, picking up jobs enqueued or cancelled by
+    other processes while it runs, and logs in again when the session
+    has expired.
+
+    Scheduling and cancelling cost O(log n); cancelled jobs are dropped
+    lazily, as they reach the top of the heap. A job is claimed for
+    running by one scheduler alone, which holds a lease on it, renewed
+    while the scheduler lives. Jobs whose lease has run out – left
+    running by a crashed scheduler – run again, so a job may run more
+    than once after a crash, but is never lost.
+
+    Invoke as ``python -m googlevoice.scheduler``::
+
+        $ python -m googlevoice.scheduler enqueue +15m s 5555551212 on my way
+        $ python -m googlevoice.scheduler enqueue 2019-06-01T09:00 c 5555551212
+        $ python -m googlevoice.scheduler list
+        $ python -m googlevoice.scheduler cancel 2
+        $ python -m googlevoice.scheduler run -j 4
+"""
+from __future__ import print_function
+
+import calendar
+import heapq
+import json
+import logging
+import os
+import re
+import sqlite3
+import sys
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from functools import partial
+from optparse import OptionParser
+
+import six
+
+from .batch import Command
+
+log = logging.getLogger(__name__)
+
+PENDING = 'pending'
+RUNNING = 'running'
+DONE = 'done'
+FAILED = 'failed'
+CANCELLED = 'cancelled'
+
+DEFAULT_PATH = os.path.expanduser('~/.gvoice-schedule.sqlite')
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS jobs (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    due REAL NOT NULL,
+    action TEXT NOT NULL,
+    args TEXT NOT NULL,
+    kwargs TEXT NOT NULL,
+    status TEXT NOT NULL,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    retries INTEGER NOT NULL,
+    error TEXT,
+    created REAL NOT NULL,
+    updated REAL NOT NULL,
+    owner TEXT,
+    lease REAL
+);
+CREATE INDEX IF NOT EXISTS jobs_status_due ON jobs (status, due);
+CREATE INDEX IF NOT EXISTS jobs_updated ON jobs (updated);
+'''
+
+
+class Job(object):
+
+    """ One scheduled command, as stored in the ``Queue``. """
+
+    fields = ('id', 'due', 'action', 'args', 'kwargs', 'status',
+              'attempts', 'retries', 'error', 'created', 'updated',
+              'owner', 'lease')
+
+    def __init__(self, row):
+        for field, value in zip(self.fields, row):
+            setattr(self, field, value)
+        self.args = json.loads(self.args)
+        self.kwargs = json.loads(self.kwargs)
+
+    @property
+    def command(self):
+        return Command(self.id, self.action, self.args, self.kwargs)
+
+    def __repr__(self):
+        return '<Job #%s %s %s (%s)>' % (
+            self.id, self.action, format_time(self.due), self.status)
+
+
+class Queue(object):
+
+    """ Durable job store, in the SQLite database at ``path``. """
+
+    def __init__(self, path=DEFAULT_PATH):
+        self.path = path
+        self.lock = threading.RLock()
+        self.db = sqlite3.connect(path, check_same_thread=False,
+                                  isolation_level=None)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.executescript(SCHEMA)
+        # Databases made before leases were added need their columns:
+        columns = set(row[1] for row in
+                      self.db.execute('PRAGMA table_info(jobs)'))
+        for name, kind in (('owner', 'TEXT'), ('lease', 'REAL')):
+            if name not in columns:
+                self.db.execute('ALTER TABLE jobs ADD COLUMN %s %s'
+                                % (name, kind))
+
+    def add(self, due, action, args=(), kwargs=None, retries=3):
+        """ Store a new pending job, validating its command; returns the
+            ``Job``.
+        """
+        Command(None, action, args, kwargs)
+        now = time.time()
+        with self.lock:
+            cursor = self.db.execute(
+                'INSERT INTO jobs (due, action, args, kwargs, status, '
+                'retries, created, updated) VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                (due, action, json.dumps(list(args)),
+                 json.dumps(kwargs or {}), PENDING, retries, now, now))
+            return self.get(cursor.lastrowid)
+
+    def get(self, job_id):
+        """ The ``Job`` with ``job_id``, or ``None``. """
+        with self.lock:
+            row = self.db.execute(
+                'SELECT %s FROM jobs WHERE id = ?' % ', '.join(Job.fields),
+                (job_id,)).fetchone()
+        return row and Job(row)
+
+    def changed(self, since):
+        """ `list` of jobs added or updated at or after ``since``. """
+        with self.lock:
+            return [Job(row) for row in self.db.execute(
+                'SELECT %s FROM jobs WHERE updated >= ? ORDER BY due, id'
+                % ', '.join(Job.fields), (since,))]
+
+    def jobs(self, *statuses):
+        """ `list` of jobs with any of ``statuses`` (default: all), by
+            due time.
+        """
+        query = 'SELECT %s FROM jobs' % ', '.join(Job.fields)
+        if statuses:
+            query += ' WHERE status IN (%s)' % ', '.join('?' * len(statuses))
+        query += ' ORDER BY due, id'
+        with self.lock:
+            return [Job(row) for row in self.db.execute(query, statuses)]
+
+    def update(self, job_id, status, **fields):
+        """ Set a job’s ``status`` along with any other ``fields``. """
+        fields.update(status=status, updated=time.time())
+        names = sorted(fields)
+        with self.lock:
+            self.db.execute('UPDATE jobs SET %s WHERE id = ?' % ', '.join(
+                '%s = ?' % name for name in names),
+                [fields[name] for name in names] + [job_id])
+
+    def claim(self, job_id, owner, lease):
+        """ Mark a pending job running, for ``owner`` to hold until
+            ``lease`` (epoch seconds), and count the attempt; returns the
+            ``Job`` – or ``None`` if it wasn’t pending, e.g. because
+            another scheduler claimed it first.
+        """
+        with self.lock:
+            if self.db.execute(
+                    'UPDATE jobs SET status = ?, attempts = attempts + 1, '
+                    'owner = ?, lease = ?, updated = ? '
+                    'WHERE id = ? AND status = ?',
+                    (RUNNING, owner, lease, time.time(), job_id,
+                     PENDING)).rowcount != 1:
+                return None
+            return self.get(job_id)
+
+    def renew(self, owner, lease):
+        """ Extend the lease on every job ``owner`` is running. """
+        with self.lock:
+            return self.db.execute(
+                'UPDATE jobs SET lease = ? WHERE owner = ? AND status = ?',
+                (lease, owner, RUNNING)).rowcount
+
+    def cancel(self, job_id):
+        """ Cancel a pending job; returns whether there was one. """
+        with self.lock:
+            return self.db.execute(
+                'UPDATE jobs SET status = ?, updated = ? '
+                'WHERE id = ? AND status = ?',
+                (CANCELLED, time.time(), job_id, PENDING)).rowcount == 1
+
+    def recover(self):
+        """ Return jobs left running by a crashed scheduler – those whose
+            lease has run out – to pending.
+        """
+        now = time.time()
+        with self.lock:
+            return self.db.execute(
+                'UPDATE jobs SET status = ?, owner = NULL, lease = NULL, '
+                'updated = ? WHERE status = ? '
+                'AND (lease IS NULL OR lease < ?)',
+                (PENDING, now, RUNNING, now)).rowcount
+
+    def close(self):
+        self.db.close()
+
+
+class Scheduler(object):
+
+    """ Runs the jobs of a ``Queue`` against ``voice`` as they fall due,
+        at most ``workers`` at a time. A failed job is retried up to its
+        ``retries`` times, ``backoff`` seconds later – doubling with each
+        attempt.
+        
+        Every ``poll`` seconds, jobs changed in the queue by other
+        processes are picked up, and the ``lease`` on running jobs – how
+        long another scheduler waits before taking them over – renewed.
+        A job failing because the session has expired is run again at
+        once after calling ``login`` (default: ``voice.login``), without
+        counting as an attempt.
+    """
+
+    def __init__(self, voice, queue, workers=4, backoff=30., poll=5.,
+                 login=None, lease=60.):
+        self.voice = voice
+        self.queue = queue
+        self.workers = workers
+        self.backoff = backoff
+        self.poll = poll
+        self.login = login
+        self.lease = lease
+        self.owner = uuid.uuid4().hex
+        self.heap = []
+        self.due = {}
+        self.active = set()
+        self.running = 0
+        self.condition = threading.Condition()
+        self.session = threading.Lock()
+        self.logins = 0
+        self.executor = None
+        self.stopped = threading.Event()
+        self.queue.recover()
+        self.checked = time.time()
+        for job in self.queue.jobs(PENDING):
+            self.push(job.id, job.due)
+
+    def refresh(self):
+        """ Pick up jobs enqueued, cancelled or rescheduled in the queue
+            since the last check – e.g. by ``enqueue`` in another process.
+        """
+        # Allow for jobs written as the last check ran:
+        since, self.checked = self.checked - 1, time.time()
+        self.queue.renew(self.owner, self.checked + self.lease)
+        self.queue.recover()
+        for job in self.queue.changed(since):
+            with self.condition:
+                if job.id in self.active:
+                    continue
+                if job.status != PENDING:
+                    self.due.pop(job.id, None)
+                elif self.due.get(job.id) != job.due:
+                    self.push(job.id, job.due)
+
+    def push(self, job_id, due):
+        with self.condition:
+            self.due[job_id] = due
+            heapq.heappush(self.heap, (due, job_id))
+            self.condition.notify()
+
+    def schedule(self, when, action, *args, **kwargs):
+        """ Schedule ``voice.<action>(*args, **kwargs)`` at ``when`` (epoch
+            seconds or a `datetime`); returns the ``Job``.
+        """
+        job = self.queue.add(timestamp(when), action, args, kwargs)
+        self.push(job.id, job.due)
+        return job
+
+    def cancel(self, job_id):
+        """ Cancel a pending job; returns whether there was one. """
+        with self.condition:
+            self.due.pop(job_id, None)
+        return self.queue.cancel(job_id)
+
+    def pop(self, now):
+        """ Remove and return the id of a job due by ``now``, or ``None``. """
+        with self.condition:
+            while self.heap and self.heap[0][0] <= now:
+                due, job_id = heapq.heappop(self.heap)
+                # Skip cancelled jobs, and entries superseded by a retry:
+                if self.due.get(job_id) == due:
+                    del self.due[job_id]
+                    self.active.add(job_id)
+                    return job_id
+
+    def wait(self):
+        """ Sleep until the earliest job is due, something is scheduled, a
+            job finishes, the queue is next checked, or the scheduler
+            stops.
+        """
+        with self.condition:
+            if self.stopped.is_set():
+                return
+            timeout = self.checked + self.poll - time.time()
+            if self.heap and self.running < self.workers:
+                timeout = min(timeout, self.heap[0][0] - time.time())
+            if timeout > 0:
+                self.condition.wait(timeout)
+
+    def renew(self, logins):
+        """ After a job failed for want of a session, log in again if it
+            has expired; returns whether it is worth running the job again
+            now. The count of ``logins`` made before the job ran tells
+            whether another job has already logged in again since.
+        """
+        with self.session:
+            if self.logins != logins:
+                return True
+            valid = getattr(self.voice, 'session_valid', None)
+            if valid is None or valid():
+                return False
+            log.info('Session expired, logging in again')
+            try:
+                if not (self.login or self.voice.login)():
+                    return False
+            except Exception as exc:
+                log.warning('Logging in again failed: %s', exc)
+                return False
+            self.logins += 1
+            return True
+
+    def run_job(self, job_id):
+        """ Run one job, then record its outcome or reschedule it. """
+        job = None
+        try:
+            job = self.queue.claim(job_id, self.owner,
+                                   time.time() + self.lease)
+            if job is None:
+                return None
+            logins = self.logins
+            result = job.command(self.voice)
+            if not result['ok'] and expired(result['error']) \
+                    and self.renew(logins):
+                result = job.command(self.voice)
+            if result['ok']:
+                self.queue.update(job.id, DONE, error=None, owner=None,
+                                  lease=None)
+            elif job.attempts <= job.retries:
+                due = time.time() + self.backoff * 2 ** (job.attempts - 1)
+                self.queue.update(job.id, PENDING, due=due,
+                                  error=result['error'], owner=None,
+                                  lease=None)
+                self.push(job.id, due)
+            else:
+                self.queue.update(job.id, FAILED, error=result['error'],
+                                  owner=None, lease=None)
+                log.warning('Job #%s failed: %s', job.id, result['error'])
+            return result
+        except Exception as exc:
+            # Nothing reads the worker’s future, so say so here:
+            log.exception('Job #%s could not be run', job_id)
+            if job is not None:
+                try:
+                    self.queue.update(job.id, FAILED, error='%s: %s' % (
+                        type(exc).__name__, exc), owner=None, lease=None)
+                except Exception:
+                    pass
+            raise
+        finally:
+            with self.condition:
+                self.active.discard(job_id)
+                self.running -= 1
+                self.condition.notify()
+
+    def run(self, until_idle=False):
+        """ Run jobs as they fall due, until ``stop()`` – or, with
+            ``until_idle``, until no jobs are pending or running.
+        """
+        self.stopped.clear()
+        self.executor = ThreadPoolExecutor(max_workers=self.workers)
+        try:
+            while not self.stopped.is_set():
+                if time.time() >= self.checked + self.poll:
+                    self.refresh()
+                with self.condition:
+                    job_id = None
+                    if self.running < self.workers:
+                        job_id = self.pop(time.time())
+                    if job_id is None:
+                        if until_idle and not self.running and not self.due:
+                            break
+                        self.wait()
+                        continue
+                    self.running += 1
+                self.executor.submit(self.run_job, job_id)
+        finally:
+            self.executor.shutdown(wait=True)
+
+    def stop(self):
+        """ Stop ``run()`` once running jobs finish. """
+        self.stopped.set()
+        with self.condition:
+            self.condition.notify_all()
+
+
+def expired(error):
+    """ Whether a job’s ``error`` is one of a session that has expired –
+        a ``LoginError``, or an HTTP 401 or 403 response.
+    """
+    name, _, message = error.partition(': ')
+    return name == 'LoginError' or (
+        name == 'HTTPError' and message.startswith(('401', '403')))
+
+
+def timestamp(when):
+    """ Epoch seconds for ``when``: a number, a `datetime` (naive ones in
+        local time), or a string – ``+90s``, ``+15m``, ``+2h``, ``+1d`` from
+        now, or an ISO 8601 date and time.
+    """
+    if isinstance(when, datetime):
+        if when.tzinfo is not None:
+            seconds = calendar.timegm(when.utctimetuple())
+        else:
+            seconds = time.mktime(when.timetuple())
+        return seconds + when.microsecond / 1e6
+    if not isinstance(when, six.string_types):
+        return float(when)
+    match = re.match(r'^\+(\d+(?:\.\d+)?)([smhd]?)$', when.strip())
+    if match:
+        units = {'': 1, 's': 1, 'm': 60, 'h': 3600, 'd': 86400}
+        return time.time() + float(match.group(1)) * units[match.group(2)]
+    for format in ('%Y-%m-%dT%H:%M:%S', '%Y-%m-%dT%H:%M', '%Y-%m-%d %H:%M',
+                   '%Y-%m-%d'):
+        try:
+            return timestamp(datetime.strptime(when.strip(), format))
+        except ValueError:
+            pass
+    raise ValueError('Unrecognized time: %r' % when)
+
+
+def format_time(stamp):
+    return datetime.fromtimestamp(stamp).strftime('%Y-%m-%d %H:%M:%S')
+
+
+parser = OptionParser(usage='''
+    python -m googlevoice.scheduler [options] command
+    Where command is one of
+
+    enqueue WHEN ACTION [ARGS...] - schedule a command, as in batch mode,
+        for WHEN: +30s, +15m, +2h, +1d, or an ISO date and time
+    list - show pending jobs (all jobs, with --all)
+    cancel ID... - cancel pending jobs
+    run - log in, and run jobs as they fall due''')
+parser.add_option("-d", "--database", dest="path", default=DEFAULT_PATH,
+                  help="Job database (default: %s)" % DEFAULT_PATH)
+parser.add_option("-r", "--retries", dest="retries", default=3, type="int",
+                  help="Retries for enqueued jobs (default: 3)")
+parser.add_option("-j", "--jobs", dest="jobs", default=4, type="int",
+                  help="Jobs to run at once (default: 4)")
+parser.add_option("-a", "--all", dest="all", default=False,
+                  action="store_true", help="List jobs of every status")
+parser.add_option("-e", "--email", dest="email", default=None,
+                  help="Google Voice Account Email")
+parser.add_option("-p", "--password", dest='passwd', default=None,
+                  help='Your account password (prompted if blank)')
+parser.disable_interspersed_args()
+
+
+def main(args=None, stdout=None):
+    options, args = parser.parse_args(args)
+    stdout = stdout or sys.stdout
+    if not args:
+        parser.error('No command given')
+    command, args = args[0], args[1:]
+    queue = Queue(options.path)
+    try:
+        if command == 'enqueue':
+            if len(args) < 2:
+                parser.error('enqueue needs WHEN and ACTION')
+            parsed = Command(None, args[1], args[2:])
+            if parsed.action == 'send_sms' and len(parsed.args) > 2:
+                parsed.args[1:] = [' '.join(parsed.args[1:])]
+            job = queue.add(timestamp(args[0]), parsed.action, parsed.args,
+                            retries=options.retries)
+            print(job.id, file=stdout)
+        elif command == 'list':
+            statuses = () if options.all else (PENDING, RUNNING)
+            for job in queue.jobs(*statuses):
+                print('%s\t%s\t%s\t%s\t%s' % (
+                    job.id, format_time(job.due), job.status,
+                    ' '.join([job.action] + [str(arg) for arg in job.args]),
+                    job.error or ''), file=stdout)
+        elif command == 'cancel':
+            try:
+                job_ids = [int(job_id) for job_id in args]
+            except ValueError as exc:
+                parser.error('Job IDs must be numbers: %s' % exc)
+            missing = [str(job_id) for job_id in job_ids
+                       if not queue.cancel(job_id)]
+            if missing:
+                print('Not pending: %s' % ' '.join(missing), file=sys.stderr)
+                return 1
+        elif command == 'run':
+            from .__main__ import login
+            from .voice import Voice
+            voice = Voice()
+            if not login(voice, email=options.email, passwd=options.passwd,
+                         batch=True):
+                return 1
+            scheduler = Scheduler(voice, queue, options.jobs, login=partial(
+                login, voice, email=options.email, passwd=options.passwd,
+                batch=True))
+            try:
+                scheduler.run()
+            except KeyboardInterrupt:
+                scheduler.stop()
+            finally:
+                voice.logout()
+        else:
+            parser.error('Unknown command: %s' % command)
+    finally:
+        queue.close()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
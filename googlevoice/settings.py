@@ -33,6 +33,15 @@ TYPES = {
 }
 
 DEBUG = False
+
+# JSON decoder for feeds and API responses: one of 'orjson', 'ujson',
+# 'simdjson' or 'json' – or None, to pick the fastest one installed
+JSON_BACKEND = None
+
+# Directory for folder snapshots reused between runs by ``Voice.snapshot``
+# – or None, to always fetch
+SNAPSHOT_DIR = None
+
 LOGIN = (
     'https://accounts.google.com'
     '/ServiceLogin?service=grandcentral&passive=1209600'
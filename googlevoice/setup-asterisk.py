@@ -2,32 +2,314 @@
 # encoding: utf-8
 """
 Jacob Feisley, Ward Mundy, and Justin Quick
+
+Run without arguments to be asked for one account’s values; or, to set up
+many at once, pass a manifest of accounts – YAML, JSON or CSV, with the
+fields gvnum, acctname, acctpass, ringback and callpark, plus an optional
+key (default: gvnum) naming each account’s contexts, custom-gv-KEY and
+custom-park-KEY (or set them with context and park):
+
+    asterisk-gvoice-setup --manifest trunks.yaml
+
+Every entry is checked before anything is written. Each account’s
+contexts are kept between BEGIN and END marker comments, so running
+again replaces them in place rather than adding duplicates – as are
+unmarked contexts of the same names, left by earlier versions of this
+script – and the configuration file is replaced atomically.
 """
 from __future__ import print_function
 
+import csv
+import errno
+import io
+import json
+import os
+import re
 import sys
+import tempfile
+import textwrap
+from collections import OrderedDict
 from getpass import getpass
+from optparse import OptionParser
 from six.moves import input
 
+CONF_DEFAULT = '/etc/asterisk/extensions_custom.conf'
+
+#: Atomic rename over an existing file – as ``os.rename`` is on POSIX,
+#: for Python 2
+replace = getattr(os, 'replace', os.rename)
+
+FIELDS = ('gvnum', 'acctname', 'acctpass', 'ringback', 'callpark')
+
+#: Checks of each field’s value, with what a valid one looks like
+CHECKS = {
+    'key': (re.compile(r'^[A-Za-z0-9_-]+$'),
+            'letters, digits, “-” and “_” only'),
+    'context': (re.compile(r'^[A-Za-z0-9_-]+$'),
+                'letters, digits, “-” and “_” only'),
+    'park': (re.compile(r'^[A-Za-z0-9_-]+$'),
+             'letters, digits, “-” and “_” only'),
+    'gvnum': (re.compile(r'^\d{10}$'), '10 digits'),
+    'acctname': (re.compile(r'^[^@\s]+@[^@\s]+$'), 'an email address'),
+    'acctpass': (re.compile(r'^\S(.*\S)?$'), 'not blank'),
+    'ringback': (re.compile(r'^\d{11}$'), '11 digits'),
+    'callpark': (re.compile(r'^\d+$'), 'digits'),
+}
+
+BEGIN = '; BEGIN googlevoice %s\n'
+END = '; END googlevoice %s\n'
+BLOCK = re.compile(r'^; BEGIN googlevoice (?P<key>\S+)\n.*?'
+                   r'^; END googlevoice (?P=key)\n', re.M | re.S)
+#: An unmarked context, from its header up to the next context's header
+LEGACY = (r'^\[%s\][^\n]*\n'
+          r'(?:(?![ \t]*\[|; BEGIN googlevoice )(?:[^\n]+\n?|\n))*')
+
+CONTENT = textwrap.dedent(r"""
+    [%(context)s]
+    exten => _X.,1,Wait(1)
+    exten => _X.,n,Set(ACCTNAME=%(acctname)s)
+    exten => _X.,n,Set(ACCTPASS=%(acctpass)s)
+    exten => _X.,n,Set(RINGBACK=%(ringback)s)
+    exten => _X.,n,Set(CALLPARK=%(callpark)s)
+    exten => _X.,n,Playback(pls-wait-connect-call)
+    exten => _X.,n,System(gvoice -b -e \${ACCTNAME} -p \
+    \${ACCTPASS} call \${EXTEN} \${RINGBACK})
+    exten => _X.,n,Set(PARKINGEXTEN=\${CALLPARK})
+    exten => _X.,n,Park()
+    exten => _X.,n,ParkAndAnnounce(pbx-transfer:PARKED|45|Console/dsp)
+
+    [%(park)s]
+    exten => s,1,Wait(4)
+    exten => s,2,Set(GVNUM=%(gvnum)s)
+    exten => s,3,Set(CALLPARK=%(callpark)s)
+    exten => s,4,NoOp(**CALLERID: \${CALLERID(number)})
+    exten => s,5,GotoIf($["${CALLERID(number)}"="${GVNUM}"]?6:7)
+    exten => s,6,ParkedCall(\${CALLPARK})
+    exten => s,7,Goto(from-trunk,gv-incoming,1)
+
+    """)
+
+parser = OptionParser(usage='''%prog [options]
+    Installs Google Voice support on your PBX – asking for one account’s
+    values, or reading many from a --manifest.''')
+parser.add_option("-m", "--manifest", dest="manifest", default=None,
+                  help="YAML, JSON or CSV file of accounts to set up")
+parser.add_option("-c", "--config", dest="config", default=None,
+                  help="Asterisk dialplan configuration file "
+                       "(default: %s)" % CONF_DEFAULT)
+parser.add_option("--prune", dest="prune", default=False,
+                  action="store_true",
+                  help="Remove the contexts of accounts not in the manifest")
+parser.add_option("-n", "--dry-run", dest="dry_run", default=False,
+                  action="store_true",
+                  help="Check the manifest, and print what would be "
+                       "written, without writing it")
+
+
+class ManifestError(ValueError):
+    """ Raised for an unreadable manifest, or invalid accounts; its
+        ``errors`` list every problem found.
+    """
+
+    def __init__(self, errors):
+        self.errors = list(errors)
+        super(ManifestError, self).__init__('\n'.join(self.errors))
+
+
+def load_manifest(path, format=None):
+    """ Read the account entries of a manifest: a YAML or JSON list of
+        mappings – or a mapping with an ``accounts`` list – or a CSV file
+        with a header row. The format defaults to the file extension’s.
+    """
+    if format is None:
+        format = os.path.splitext(path)[1].lower().lstrip('.')
+        format = 'yaml' if format == 'yml' else format
+    with io.open(path, encoding='utf-8', newline='') as stream:
+        if format == 'csv':
+            return [dict((name, value) for name, value in row.items()
+                         if name is not None)
+                    for row in csv.DictReader(stream)]
+        if format == 'json':
+            data = json.load(stream)
+        elif format == 'yaml':
+            import yaml
+            data = yaml.safe_load(stream)
+        else:
+            raise ManifestError(['Unknown manifest format: %r' % format])
+    if isinstance(data, dict):
+        data = data.get('accounts')
+    if not isinstance(data, list) \
+            or not all(isinstance(entry, dict) for entry in data):
+        raise ManifestError(['%s: expected a list of accounts' % path])
+    return data
+
+
+def validate(entries):
+    """ Check every account entry, returning them as complete accounts
+        with their ``key``, ``context`` and ``park`` context names – or
+        raising ``ManifestError`` with every problem found.
+    """
+    accounts, errors, seen = [], [], {}
+    for number, entry in enumerate(entries, 1):
+        account = dict((name, u'%s' % (value,) if value is not None else '')
+                       for name, value in entry.items())
+        account['key'] = account.get('key') or account.get('gvnum', '')
+        account['context'] = account.get('context') \
+            or 'custom-gv-%s' % account['key']
+        account['park'] = account.get('park') \
+            or 'custom-park-%s' % account['key']
+        label = 'Entry %d (%s)' % (number, account['key'] or 'no key')
+        for name in ('key',) + FIELDS + ('context', 'park'):
+            pattern, description = CHECKS[name]
+            if not pattern.match(account.get(name, '')):
+                errors.append('%s: %s must be %s'
+                              % (label, name, description))
+        unknown = set(account) - set(CHECKS)
+        if unknown:
+            errors.append('%s: unknown field(s) %s'
+                          % (label, ', '.join(sorted(unknown))))
+        if account['key'] in seen:
+            errors.append('%s: key also used by entry %d'
+                          % (label, seen[account['key']]))
+        seen.setdefault(account['key'], number)
+        accounts.append(account)
+    if errors:
+        raise ManifestError(errors)
+    return accounts
+
+
+def render(account):
+    """ The marked-out dialplan block of one account. """
+    return (BEGIN % account['key']
+            + CONTENT % account
+            + END % account['key'])
+
 
-def main():
+def legacy(text, account):
+    """ The spans in ``text`` of unmarked contexts named like those of
+        ``account`` – as written by earlier versions of this script.
+    """
+    marked = [match.span() for match in BLOCK.finditer(text)]
+    spans = []
+    for name in (account['context'], account['park']):
+        for match in re.finditer(LEGACY % re.escape(name), text, re.M):
+            if not any(start <= match.start() < end
+                       for start, end in marked):
+                spans.append(match.span())
+    return sorted(spans)
+
+
+def update(text, accounts, prune=False):
+    """ Replace the blocks of ``accounts`` already in the dialplan
+        ``text`` – or their unmarked contexts – in place, and append the
+        others; with ``prune``, drop the blocks of accounts not given.
+        Everything else is left alone.
+    """
+    blocks = OrderedDict((account['key'], render(account))
+                         for account in accounts)
+    written = set()
+
+    def replace(match):
+        key = match.group('key')
+        if key in written:
+            # A duplicate left by hand; keep only the first:
+            return ''
+        if key in blocks:
+            written.add(key)
+            return blocks[key]
+        return '' if prune else match.group(0)
+
+    text = BLOCK.sub(replace, text)
+    for account in accounts:
+        if account['key'] in written:
+            continue
+        spans = legacy(text, account)
+        if not spans:
+            continue
+        # The block takes the place of the first context, and the rest go:
+        for start, end in reversed(spans):
+            block = blocks[account['key']] if start == spans[0][0] else ''
+            text = text[:start] + block + text[end:]
+        written.add(account['key'])
+    missing = [block for key, block in blocks.items() if key not in written]
+    if missing and text and not text.endswith('\n'):
+        text += '\n'
+    return text + ''.join(missing)
+
+
+def write(conf, accounts, prune=False):
+    """ Update the dialplan configuration file ``conf`` with the blocks
+        of ``accounts``, atomically – keeping its mode, owner and group
+        – and returns whether it changed.
+    """
+    try:
+        with io.open(conf, encoding='utf-8', newline='') as stream:
+            text = stream.read()
+            status = os.fstat(stream.fileno())
+    except (IOError, OSError) as exc:
+        # Only a missing file is written afresh; anything else – say,
+        # one we may not read – must not be overwritten:
+        if exc.errno != errno.ENOENT:
+            raise
+        text, status = '', None
+    content = update(text, accounts, prune)
+    if content == text:
+        return False
+    fd, temporary = tempfile.mkstemp(dir=os.path.dirname(
+        os.path.abspath(conf)), suffix='.tmp')
+    try:
+        with io.open(fd, 'w', encoding='utf-8', newline='') as stream:
+            stream.write(content)
+            stream.flush()
+            os.fsync(stream.fileno())
+        if status is None:
+            os.chmod(temporary, 0o644)
+        else:
+            # Owner first, as changing it clears set-id mode bits:
+            if (status.st_uid, status.st_gid) != (os.geteuid(),
+                                                  os.getegid()):
+                os.chown(temporary, status.st_uid, status.st_gid)
+            os.chmod(temporary, status.st_mode & 0o7777)
+        replace(temporary, conf)
+    except BaseException:
+        os.unlink(temporary)
+        raise
+    return True
+
+
+def provision(manifest, conf=CONF_DEFAULT, prune=False, dry_run=False,
+              stdout=sys.stdout):
+    """ Set up every account of a ``manifest`` file in ``conf`` in one
+        pass; returns whether ``conf`` changed.
+    """
+    accounts = validate(load_manifest(manifest))
+    if dry_run:
+        for account in accounts:
+            stdout.write(render(dict(account, acctpass='********')))
+        return False
+    changed = write(conf, accounts, prune)
+    print('%s %d account(s) in %s' % ('Updated' if changed else 'Already had',
+                                      len(accounts), conf), file=stdout)
+    return changed
+
+
+def interactive(conf=None):
     print("""This script installs Google Voice support on your PBX.
     You must have a system that is compatible with PBX in a Flash.
-    WARNING: No error checking is provided.
     By using this script, you agree to assume ALL RISK.
     NO WARRANTY, EXPRESS OR IMPLIED, OF ANY KIND IS PROVIDED.
 
     If you make a typo while entering values below, press
-    Ctrl-C and start over. Before starting, make sure you
-    have removed any original [custom-gv] context.
+    Ctrl-C and start over. Any [custom-gv] and [custom-park]
+    contexts already in the file are replaced.
     """)
 
-    conf_default = '/etc/asterisk/extensions_custom.conf'
-    conf = input("""Asterisk dialplan configuration file
-        [Default %s]: """ % conf_default)
+    if conf is None:
+        conf = input("""Asterisk dialplan configuration file
+        [Default %s]: """ % CONF_DEFAULT)
 
     if not conf.strip():
-        conf = conf_default
+        conf = CONF_DEFAULT
 
     print("""
     Your Google Voice entries are stored in %s
@@ -45,6 +327,15 @@ def main():
         'callpark': input("Parking Lot Magic Number: "),
     }
 
+    try:
+        # One account, in the original unsuffixed contexts:
+        account, = validate([dict(
+            ((name, settings[name]) for name in FIELDS),
+            key='custom-gv', context='custom-gv', park='custom-park')])
+    except ManifestError as exc:
+        print(exc)
+        sys.exit(1)
+
     input("""
     We are now ready to begin the installation.
     Confirm your entries below or press Ctrl-C to abort and try again.
@@ -62,41 +353,15 @@ def main():
     Installing Google Voice support for your PBX. One moment please...
     """)
 
-    content = r"""
-    [custom-gv]
-    exten => _X.,1,Wait(1)
-    exten => _X.,n,Set(ACCTNAME=%(acctname)s)
-    exten => _X.,n,Set(ACCTPASS=%(acctpass)s)
-    exten => _X.,n,Set(RINGBACK=%(ringback)s)
-    exten => _X.,n,Set(CALLPARK=%(callpark)s)
-    exten => _X.,n,Playback(pls-wait-connect-call)
-    exten => _X.,n,System(gvoice -b -e \${ACCTNAME} -p \
-\${ACCTPASS} call \${EXTEN} \${RINGBACK})
-    exten => _X.,n,Set(PARKINGEXTEN=\${CALLPARK})
-    exten => _X.,n,Park()
-    exten => _X.,n,ParkAndAnnounce(pbx-transfer:PARKED|45|Console/dsp)
-
-    [custom-park]
-    exten => s,1,Wait(4)
-    exten => s,2,Set(GVNUM=%(gvnum)s)
-    exten => s,3,Set(CALLPARK=%(callpark)s)
-    exten => s,4,NoOp(**CALLERID: \${CALLERID(number)})
-    exten => s,5,GotoIf($["${CALLERID(number)}"="${GVNUM}"]?6:7)
-    exten => s,6,ParkedCall(\${CALLPARK})
-    exten => s,7,Goto(from-trunk,gv-incoming,1)
-
-    """
-
     try:
-        fo = open(conf, 'a')
-        fo.write(content % settings)
-        fo.close()
-    except IOError:
+        write(conf, [account])
+    except (IOError, OSError):
         print('Error opening file for writing: %s' % conf)
         sys.exit(0)
 
     print("""
-    Installation script is finished. Do NOT run it again on this system!
+    Installation script is finished. Running it again replaces
+    these entries.
 
     You can now reload your Asterisk dialplan configuration with
     the following command:
@@ -109,5 +374,23 @@ def main():
     """)
 
 
+def main(args=None):
+    options, rest = parser.parse_args(args)
+    if rest:
+        parser.error('Unexpected arguments: %s' % ' '.join(rest))
+    if options.manifest is None:
+        return interactive(options.config)
+    try:
+        provision(options.manifest, options.config or CONF_DEFAULT,
+                  options.prune, options.dry_run)
+    except ManifestError as exc:
+        print(exc, file=sys.stderr)
+        sys.exit(1)
+    except (IOError, OSError) as exc:
+        print('Error updating %s: %s' % (options.config or CONF_DEFAULT,
+                                         exc), file=sys.stderr)
+        sys.exit(1)
+
+
 if __name__ == '__main__':
     main()
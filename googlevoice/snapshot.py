@@ -0,0 +1,329 @@
+# encoding: utf-8
+""" Binary snapshots of fetched folders, for reuse between runs.
+
+    A snapshot holds a ``Folder``’s decoded feed data – message data,
+    counts and paging metadata, but none of the raw XML or HTML – behind a
+    fixed-size header::
+
+        magic     8 bytes   b'\\x89GVSNAP\\n'
+        version   uint16    FORMAT_VERSION
+        encoding  uint8     PICKLE or MSGPACK
+        compress  uint8     NONE or ZSTD
+        fetched   float64   when the folder was fetched (epoch seconds)
+        written   float64   when the snapshot was written
+        length    uint64    payload size in bytes
+
+    The payload – optionally zstd-compressed as a whole – is the length
+    of the metadata record, the record itself, and then one record per
+    message, back to back; the metadata holds the message ids and the
+    offsets of their records. Records are pickled with protocol 5 – or
+    packed with ``msgpack``, where installed.
+
+    Files are memory mapped when loaded, so records are decoded straight
+    out of the page cache without first being copied – on Python 3; on
+    Python 2, whose mappings can’t be sliced through a ``memoryview``,
+    they are read whole instead – and freshness can be checked from the
+    header alone. With ``lazy``, messages are only
+    decoded as they are accessed, so even a snapshot of hundreds of
+    thousands of messages opens at once – close the ``Messages`` when done
+    with it, to unmap the file.
+
+    Only load pickled snapshots from a directory you trust.
+"""
+from __future__ import print_function
+
+import collections
+import mmap
+import os
+import pickle
+import struct
+import sys
+import tempfile
+import time
+import traceback
+from array import array
+
+import six
+from six.moves.collections_abc import Mapping
+
+from . import util
+
+MAGIC = b'\x89GVSNAP\n'
+FORMAT_VERSION = 1
+HEADER = struct.Struct('<8sHBBddQ')
+LENGTH = struct.Struct('<Q')
+
+PICKLE, MSGPACK = 0, 1
+NONE, ZSTD = 0, 1
+
+Header = collections.namedtuple('Header', (
+    'version', 'encoding', 'compression', 'fetched', 'written', 'length'))
+
+#: Slices a mapped snapshot without copying it (by copying, on Python 2)
+memory = bytes if six.PY2 else memoryview
+#: Atomic rename over an existing file (on Python 2, only POSIX renames are)
+replace = getattr(os, 'replace', os.rename)
+
+
+def mapped(stream):
+    """ A read-only memory mapping of the open file ``stream`` – or, on
+        Python 2, its whole content.
+    """
+    if six.PY2:
+        content = stream.read()
+        if not content:
+            raise ValueError('cannot mmap an empty file')
+        return content
+    return mmap.mmap(stream.fileno(), 0, access=mmap.ACCESS_READ)
+
+
+def release(*buffers):
+    """ Release every `memoryview`, and close every mapping, given. """
+    for buffer in buffers:
+        if isinstance(buffer, memoryview):
+            buffer.release()
+        elif isinstance(buffer, mmap.mmap):
+            buffer.close()
+
+
+def pack_offsets(offsets):
+    """ Record offsets, as little-endian uint64s. """
+    if six.PY2:
+        # No 'Q' arrays on Python 2:
+        return struct.pack('<%dQ' % len(offsets), *offsets)
+    offsets = array('Q', offsets)
+    if sys.byteorder == 'big':
+        offsets.byteswap()
+    return offsets.tobytes()
+
+
+def unpack_offsets(data):
+    """ The record offsets packed by ``pack_offsets``. """
+    if six.PY2:
+        return struct.unpack('<%dQ' % (len(data) // LENGTH.size), data)
+    offsets = array('Q')
+    offsets.frombytes(data)
+    if sys.byteorder == 'big':
+        offsets.byteswap()
+    return offsets
+
+
+def encode(payload, encoding):
+    if encoding == MSGPACK:
+        import msgpack
+        return msgpack.packb(payload, use_bin_type=True)
+    return pickle.dumps(payload, protocol=min(5, pickle.HIGHEST_PROTOCOL))
+
+
+def decode(body, encoding):
+    """ Decode a record, raising ``SnapshotError`` for any that won’t. """
+    try:
+        if encoding == MSGPACK:
+            import msgpack
+            return msgpack.unpackb(body, raw=False, strict_map_key=False)
+        return pickle.loads(body)
+    except Exception as exc:
+        six.raise_from(util.SnapshotError('Undecodable snapshot record: %r'
+                                          % (exc,)), exc)
+
+
+def default_encoding():
+    """ ``MSGPACK`` if ``msgpack`` is installed, otherwise ``PICKLE``. """
+    try:
+        import msgpack  # noqa: F401
+    except ImportError:
+        return PICKLE
+    return MSGPACK
+
+
+def dump(folder, path, compress=False, encoding=None):
+    """ Write a snapshot of ``folder`` to ``path``, atomically replacing
+        any file there; ``compress`` requires ``zstandard``.
+    """
+    if encoding is None:
+        encoding = default_encoding()
+    data = dict(folder)
+    messages = data.pop('messages', None) or {}
+    ids, records, offsets = [], [], [0]
+    for msgid, message in messages.items():
+        record = encode(message, encoding)
+        ids.append(msgid)
+        records.append(record)
+        offsets.append(offsets[-1] + len(record))
+    meta = encode(dict(name=folder.name, fetched=folder.fetched,
+                       page=folder.__dict__.get('page'),
+                       terms=folder.__dict__.get('terms'), data=data,
+                       ids=ids, offsets=pack_offsets(offsets)), encoding)
+    body = b''.join([LENGTH.pack(len(meta)), meta] + records)
+    if compress:
+        import zstandard
+        body = zstandard.ZstdCompressor().compress(body)
+    header = HEADER.pack(MAGIC, FORMAT_VERSION, encoding,
+                         ZSTD if compress else NONE, folder.fetched,
+                         time.time(), len(body))
+    directory = os.path.dirname(os.path.abspath(path))
+    fd, temporary = tempfile.mkstemp(dir=directory, suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as stream:
+            stream.write(header)
+            stream.write(body)
+        replace(temporary, path)
+    except BaseException:
+        os.unlink(temporary)
+        raise
+    return path
+
+
+def parse_header(buffer, size=None):
+    """ The ``Header`` at the start of ``buffer``, validated against the
+        snapshot’s total ``size`` (default: that of ``buffer``).
+    """
+    size = len(buffer) if size is None else size
+    if len(buffer) < HEADER.size:
+        raise util.SnapshotError('Truncated snapshot')
+    magic, version, encoding, compression, fetched, written, length = \
+        HEADER.unpack_from(buffer)
+    if magic != MAGIC:
+        raise util.SnapshotError('Not a folder snapshot')
+    if version != FORMAT_VERSION:
+        raise util.SnapshotError('Unsupported snapshot version: %s'
+                                 % version)
+    if HEADER.size + length > size:
+        raise util.SnapshotError('Truncated snapshot')
+    return Header(version, encoding, compression, fetched, written, length)
+
+
+def info(path):
+    """ The ``Header`` of the snapshot at ``path``, read without decoding
+        its payload.
+    """
+    with open(path, 'rb') as stream:
+        return parse_header(stream.read(HEADER.size),
+                            os.fstat(stream.fileno()).st_size)
+
+
+class Messages(Mapping):
+
+    """ Read-only message data of a snapshot, by id, decoding each
+        message’s record on first access.
+        
+        ``close()`` – or leaving a ``with`` block – unmaps the snapshot;
+        messages already decoded stay readable, others raise
+        ``ValueError``.
+    """
+
+    def __init__(self, ids, offsets, records, encoding, view=None,
+                 buffer=None):
+        self.ids = ids
+        self.offsets = offsets
+        self.records = records
+        self.encoding = encoding
+        self.view = view
+        self.buffer = buffer
+        self.positions = None
+        self.decoded = {}
+
+    def __getitem__(self, msgid):
+        data = self.decoded.get(msgid)
+        if data is None:
+            if self.records is None:
+                raise ValueError('Snapshot is closed')
+            if self.positions is None:
+                self.positions = dict(zip(self.ids, range(len(self.ids))))
+            position = self.positions[msgid]
+            data = self.decoded[msgid] = decode(self.records[
+                self.offsets[position]:self.offsets[position + 1]],
+                self.encoding)
+        return data
+
+    def __iter__(self):
+        return iter(self.ids)
+
+    def __len__(self):
+        return len(self.ids)
+
+    @property
+    def closed(self):
+        return self.records is None
+
+    def close(self):
+        """ Release the snapshot’s memory mapping. """
+        if self.records is None:
+            return
+        # Every slice of the mapping must go before it can be closed:
+        release(self.records, self.view, self.buffer)
+        self.records = self.view = self.buffer = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def load(path, voice=None, max_age=None, lazy=False):
+    """ Read the snapshot at ``path`` back into a ``Folder`` for ``voice``,
+        with its original fetch time. Raises ``SnapshotError`` for files
+        that aren’t valid snapshots, whatever is wrong with them – or,
+        with ``max_age``, for those of a folder fetched more than
+        ``max_age`` seconds ago.
+        
+        With ``lazy``, the folder’s ``messages`` are a read-only
+        ``Messages`` mapping, decoded on access, and the file stays mapped
+        until it is closed – ``with folder['messages']: ...``.
+    """
+    with open(path, 'rb') as stream:
+        try:
+            buffer = mapped(stream)
+        except ValueError:
+            raise util.SnapshotError('Empty snapshot')
+    view = None
+    try:
+        header = parse_header(buffer)
+        if max_age is not None and time.time() - header.fetched > max_age:
+            raise util.SnapshotError('Stale snapshot')
+        view = body = memory(buffer)[
+            HEADER.size:HEADER.size + header.length]
+        if header.compression not in (NONE, ZSTD):
+            raise util.SnapshotError('Unknown snapshot compression')
+        if header.compression == ZSTD:
+            import zstandard
+            body = memory(zstandard.ZstdDecompressor().decompress(view))
+        length, = LENGTH.unpack_from(body)
+        meta = decode(body[LENGTH.size:LENGTH.size + length],
+                      header.encoding)
+        offsets = unpack_offsets(meta['offsets'])
+        records = body[LENGTH.size + length:]
+        messages = Messages(meta['ids'], offsets, records, header.encoding,
+                            view, buffer)
+        if not lazy:
+            messages = dict((msgid, decode(records[start:end],
+                                           header.encoding))
+                            for msgid, start, end in zip(
+                                meta['ids'], offsets, offsets[1:]))
+    except Exception as exc:
+        # Drop every slice of the mapping, so it can be closed:
+        body = records = messages = None
+        # … including those held by the frames of the traceback (there
+        # are none to clear on Python 2, where nothing is mapped):
+        for error in (exc, getattr(exc, '__cause__', None),
+                      getattr(exc, '__context__', None)):
+            if getattr(error, '__traceback__', None) is not None:
+                traceback.clear_frames(error.__traceback__)
+        release(view, buffer)
+        if isinstance(exc, util.SnapshotError):
+            raise
+        six.raise_from(util.SnapshotError('Unreadable snapshot: %r'
+                                          % (exc,)), exc)
+    else:
+        if not lazy:
+            body = records = None
+            release(view, buffer)
+    data = meta['data']
+    data['messages'] = messages
+    folder = util.Folder(voice, meta['name'], data, fetched=meta['fetched'])
+    if meta.get('page') is not None:
+        folder.page = meta['page']
+    if meta.get('terms') is not None:
+        folder.terms = meta['terms']
+    return folder
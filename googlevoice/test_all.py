@@ -1,13 +1,21 @@
 # encoding: utf-8
 from __future__ import print_function
 
+import collections
+import csv
+import datetime
+import gzip
 import itertools
+import json
 import os
 import sys
 import random
 import string
+import sqlite3
+import threading
 import time
 
+import six
 from six.moves import input
 
 import faker
@@ -16,10 +24,25 @@ import responses
 
 from googlevoice import conf
 from googlevoice import settings
+from googlevoice import totp
+from googlevoice import util
 from googlevoice import Voice
 
 fake = faker.Faker()
 
+
+def feed_xml(messages, **extra):
+    """ Render a Google Voice feed response around ``messages``. """
+    data = dict(messages=messages,
+                totalSize=len(messages),
+                unreadCounts={'all': 0, 'inbox': 0},
+                resultsPerPage=10)
+    data.update(extra)
+    return ('<?xml version="1.0" encoding="UTF-8"?>'
+            '<response><json><![CDATA[%s]]></json>'
+            '<html><![CDATA[<div>html</div>]]></html></response>'
+            % json.dumps(data))
+
 @pytest.fixture
 def random_gxf():
     
@@ -138,3 +161,1823 @@ class TestConfig(object):
         config.save()
         new_config = conf.Config(config.fname)
         assert new_config.forwardingNumber == number
+
+
+class TestJSONDecoder(object):
+    
+    def test_stdlib(self):
+        decoder = util.JSONDecoder('json')
+        assert decoder.name == 'json'
+        assert decoder(b'{"ok": true}') == {'ok': True}
+    
+    def test_unknown_backend(self):
+        with pytest.raises(ValueError):
+            util.JSONDecoder('yaml')
+    
+    def test_callable_backend_falls_back(self):
+        def picky(payload):
+            raise OverflowError('too wide')
+        decoder = util.JSONDecoder(picky)
+        assert decoder('[18446744073709551616]') == [2 ** 64]
+        with pytest.raises(util.JSONError):
+            decoder('{not json')
+    
+    def test_decoded_once_per_response(self, monkeypatch):
+        calls = []
+        
+        def counting(payload):
+            calls.append(payload)
+            return json.loads(payload)
+        
+        monkeypatch.setattr(util.json_decoder, 'loads', counting)
+        parser = util.XMLParser(None, 'inbox', lambda: feed_xml({}))
+        folder = parser()
+        assert folder.name == 'inbox'
+        assert parser.data['totalSize'] == len(folder) == 0
+        assert len(calls) == 1
+        parser()
+        assert len(calls) == 2
+
+
+def message_data(msgid, minutes=0, **extra):
+    """ Raw feed data for one message, ``minutes`` after 2019-01-01 UTC,
+        displayed in US Eastern (UTC-5) time.
+    """
+    stamp = 1546300800000 + minutes * 60000
+    display = datetime.datetime(2018, 12, 31, 19) + \
+        datetime.timedelta(minutes=minutes)
+    data = dict(id=msgid,
+                phoneNumber='+15555550100',
+                displayNumber='(555) 555-0100',
+                startTime=str(stamp),
+                displayStartDateTime=display.strftime('%m/%d/%y %I:%M %p'),
+                isRead=True, isSpam=False, isTrash=False, star=False,
+                labels=['inbox', 'all'], type=10)
+    data.update(extra)
+    return data
+
+
+class TestTimestamps(object):
+    
+    @pytest.mark.parametrize('text', [
+        '1/1/19 12:00 AM', '1/1/19 12:59 PM', '12/31/68 1:05 pm',
+        '07/04/69 11:30 PM', '2/9/05 09:01 am'])
+    def test_matches_strptime(self, text):
+        expected = datetime.datetime.strptime(text, util.DISPLAY_FORMAT)
+        assert util.parse_display_datetime(text) == expected
+    
+    def test_invalid(self):
+        with pytest.raises(ValueError):
+            util.parse_display_datetime('13/1/19 0:00 AM')
+    
+    def test_message(self):
+        msg = util.Message(None, 'abc', message_data('abc', minutes=90))
+        display = datetime.datetime.strptime(
+            '12/31/18 08:30 PM', util.DISPLAY_FORMAT)
+        assert msg.startTime == time.gmtime(1546306200)
+        assert msg.displayStartDateTime == display
+        assert msg.displayStartTime == display.time()
+        assert msg.startDateTime == datetime.datetime(
+            2019, 1, 1, 1, 30, tzinfo=util.timezone.utc)
+        assert msg.localStartDateTime == msg.startDateTime
+        assert msg.localStartDateTime.utcoffset() == \
+            datetime.timedelta(hours=-5)
+
+
+@pytest.fixture
+def voice():
+    """ A ``Voice`` instance that believes it is logged in. """
+    voice = Voice()
+    voice._special = 'special-value'
+    return voice
+
+
+def page_matcher(number):
+    """ A ``responses`` matcher for requests of page ``number`` of a feed,
+        whatever their other parameters.
+    """
+    page = 'p%d' % number
+    
+    def match(request):
+        query = six.moves.urllib.parse.urlsplit(request.url).query
+        found = six.moves.urllib.parse.parse_qs(query).get('page')
+        return found == [page], 'Page %s is not %s' % (found, page)
+    return match
+
+
+def add_feed_pages(name, pages, per_page=2, **extra):
+    """ Register every page of a feed (a `list` of message dicts per page)
+        with ``responses``; ``extra`` keys go in every page's JSON.
+    """
+    total = sum(len(page) for page in pages)
+    url = getattr(settings, 'XML_%s' % name.upper())
+    for number, page in enumerate(pages, 1):
+        messages = collections.OrderedDict((msg['id'], msg) for msg in page)
+        responses.add(
+            responses.GET, url,
+            feed_xml(messages, totalSize=total, resultsPerPage=per_page,
+                     **extra),
+            match=[page_matcher(number)])
+
+
+class TestColumns(object):
+    
+    @pytest.fixture
+    def columns(self):
+        return util.Folder(None, 'all', dict(messages={
+            'a': message_data('a', minutes=1, type=2, star=True),
+            'b': message_data('b', minutes=2, type=99, isRead=False),
+        })).to_columns()
+    
+    def test_arrays(self, columns):
+        assert len(columns) == 2
+        assert columns.id == ['a', 'b']
+        assert list(columns.startTime) == [1546300860000, 1546300920000]
+        assert [columns.categories[c] for c in columns.type[:1]] == \
+            ['voicemail']
+        assert list(columns.type[1:]) == [-1]
+        assert list(columns.star) == [1, 0]
+        assert list(columns.isRead) == [1, 0]
+    
+    def test_numpy(self, columns):
+        pytest.importorskip('numpy')
+        records = columns.to_numpy()
+        assert records['startTime'].dtype.str.endswith('i8')
+        assert list(records['star']) == [True, False]
+        assert list(records['phoneNumber']) == ['+15555550100'] * 2
+    
+    def test_pandas(self, columns):
+        pytest.importorskip('pandas')
+        frame = columns.to_pandas()
+        assert list(frame.index) == ['a', 'b']
+        assert frame.loc['a', 'type'] == 'voicemail'
+        assert frame['type'].isna().tolist() == [False, True]
+    
+    def test_arrow(self, columns):
+        pytest.importorskip('pyarrow')
+        table = columns.to_arrow()
+        assert table.column_names == list(columns.fields)
+        assert table.column('type').to_pylist() == ['voicemail', None]
+    
+    @responses.activate
+    def test_export_columns(self, voice):
+        add_feed_pages('all', [
+            [message_data('a'), message_data('b', 1)],
+            [message_data('c', 2)]])
+        columns = voice.export_columns('all')
+        assert columns.id == ['a', 'b', 'c']
+        assert len(responses.calls) == 2
+
+
+class TestExport(object):
+    
+    @pytest.fixture
+    def pages(self):
+        add_feed_pages('all', [
+            [message_data('c', 20), message_data('b', 10)],
+            [message_data('a', 0, labels=['sms'])]])
+    
+    @responses.activate
+    def test_jsonl_gzip(self, voice, pages, tmpdir):
+        from googlevoice import export
+        path = str(tmpdir / 'history.jsonl.gz')
+        reports = []
+        count = export.export(voice, ['all'], path,
+                              report=lambda *args: reports.append(args))
+        with gzip.open(path, 'rt') as lines:
+            records = [json.loads(line) for line in lines]
+        assert count == 3
+        assert reports[0][0] == 3
+        assert [item['id'] for item in records] == ['c', 'b', 'a']
+        assert records[0]['feed'] == 'all'
+        assert records[0]['startTime'] == 1546302000000
+    
+    @responses.activate
+    def test_csv_since(self, voice, pages, tmpdir):
+        from googlevoice import export
+        path = str(tmpdir / 'history.csv')
+        since = export.parse_since('2019-01-01T00:10')
+        assert export.export(voice, ['all'], path, since=since) == 2
+        with open(path) as lines:
+            rows = list(csv.DictReader(lines))
+        assert [row['id'] for row in rows] == ['c', 'b']
+        assert rows[0]['labels'] == 'inbox,all'
+        assert len(responses.calls) == 2
+        # No page is fetched past one reaching back before ``since``:
+        since = export.parse_since('2019-01-01T00:15')
+        assert export.export(voice, ['all'], path, since=since) == 1
+        assert len(responses.calls) == 3
+    
+    @responses.activate
+    def test_parquet(self, voice, pages, tmpdir):
+        parquet = pytest.importorskip('pyarrow.parquet')
+        from googlevoice import export
+        path = str(tmpdir / 'history.parquet')
+        assert export.export(voice, ['all'], path) == 3
+        table = parquet.read_table(path)
+        assert table.column('id').to_pylist() == ['c', 'b', 'a']
+        assert table.column('labels').to_pylist()[-1] == ['sms']
+
+
+class TestBatch(object):
+    
+    class Recorder(object):
+        """ Stands in for ``Voice``, recording the calls made on it. """
+        
+        def __init__(self):
+            self.calls = []
+        
+        def send_sms(self, number, text):
+            self.calls.append(('send_sms', number, text))
+        
+        def call(self, number, forwarding=None, phoneType=None):
+            self.calls.append(('call', number, phoneType))
+            raise util.ValidationError('busy')
+        
+        def inbox(self):
+            return util.Folder(self, 'inbox', dict(
+                messages={'a': message_data('a')}, totalSize=1))
+    
+    def test_parse(self):
+        from googlevoice import batch
+        lines = ['# comment', '', 's 5551212 on my way',
+                 '{"action": "call", "args": ["5551212"], '
+                 '"kwargs": {"phoneType": 2}}', 'frobnicate']
+        parsed = list(batch.parse(lines))
+        assert parsed[0].line == 3
+        assert parsed[0].action == 'send_sms'
+        assert parsed[0].args == ['5551212', 'on my way']
+        assert parsed[1].kwargs == {'phoneType': 2}
+        assert parsed[2] == dict(
+            line=5, ok=False, error="ValueError: Unknown command: 'frobnicate'")
+    
+    @pytest.mark.parametrize('jobs', [1, 4])
+    def test_main(self, jobs, tmpdir):
+        from googlevoice import batch
+        script = tmpdir / 'commands.txt'
+        script.write('send_sms 5551212 hi there\ncall 5551212\ni\n')
+        voice, out = self.Recorder(), six.StringIO()
+        failures = batch.main(voice, ['-f', str(script), '-j', str(jobs)],
+                              stdout=out)
+        results = [json.loads(line) for line in out.getvalue().splitlines()]
+        assert failures == 1
+        assert [r['ok'] for r in results] == [True, False, True]
+        assert results[1]['error'] == 'ValidationError: busy'
+        assert results[2]['result']['name'] == 'inbox'
+        assert results[2]['result']['messages']['a']['id'] == 'a'
+        assert sorted(voice.calls) == [
+            ('call', '5551212', None), ('send_sms', '5551212', 'hi there')]
+    
+    def test_run_reads_ahead_a_bounded_window(self):
+        from googlevoice import batch
+        read = []
+        
+        def commands():
+            for number in itertools.count(1):
+                read.append(number)
+                yield batch.Command(number, 'inbox')
+        
+        results = batch.run(self.Recorder(), commands(), jobs=2)
+        lines = [result['line'] for result in itertools.islice(results, 5)]
+        results.close()
+        assert lines == [1, 2, 3, 4, 5]
+        assert len(read) <= 5 + 2 * 2
+
+
+class TestWatcher(object):
+    
+    class Feed(object):
+        """ Stands in for a ``Voice`` feed, serving scripted pages. """
+        
+        def __init__(self, *pages):
+            self.pages = list(pages)
+            self.calls = 0
+        
+        def __call__(self):
+            self.calls += 1
+            page = self.pages.pop(0) if len(self.pages) > 1 \
+                else self.pages[0]
+            return util.Folder(None, 'inbox', dict(
+                messages=dict((msg['id'], msg) for msg in page),
+                totalSize=len(page),
+                unreadCounts={'inbox': sum(not m['isRead'] for m in page)}))
+    
+    def voice(self, *pages):
+        """ A ``Voice`` serving scripted inbox pages, whose unread counts
+            are those of the page last served.
+        """
+        voice = Voice()
+        voice.inbox = self.Feed(*pages)
+        voice.unread_counts = lambda max_age=None: dict(
+            unread=sum(not message['isRead'] for message
+                       in voice.inbox.pages[0]))
+        return voice
+    
+    def test_events_and_backoff(self):
+        from googlevoice.watch import Watcher
+        first = [message_data('a')]
+        second = [message_data('a', isRead=False, star=True),
+                  message_data('b', 1)]
+        voice = self.voice(first, first, second, second)
+        received = []
+        watcher = Watcher(voice, callback=lambda *e: received.append(e),
+                          min_interval=1, max_interval=3, refresh=0)
+        assert watcher.poll() == []
+        assert watcher.interval == 2
+        assert watcher.poll() == []
+        assert watcher.interval == 3
+        events = watcher.poll()
+        assert sorted((event, msg.id) for event, msg in events) == [
+            ('changed', 'a'), ('new', 'b')]
+        assert watcher.interval == 1
+        assert watcher.poll() == []
+        watcher.stop()
+        assert sorted(received) == sorted(events)
+    
+    def test_only_star_changed(self):
+        from googlevoice.watch import Watcher
+        voice = self.voice([message_data('a')],
+                           [message_data('a', star=True)])
+        watcher = Watcher(voice, refresh=0)
+        assert watcher.poll() == []
+        [(event, message)] = watcher.poll()
+        assert (event, message.id, message['star']) == ('changed', 'a', True)
+        watcher.stop()
+    
+    def test_probe(self):
+        from googlevoice.watch import Watcher
+        first = [message_data('a'), message_data('b', 1)]
+        voice = self.voice(first, first,
+                           [message_data('b', 1, isRead=False)])
+        watcher = Watcher(voice, refresh=60)
+        assert watcher.poll() == []
+        # Unread counts unchanged, and the page is fresh: no fetch.
+        assert watcher.poll() == []
+        assert voice.inbox.calls == 1
+        # Marking a message unread moves the counts:
+        voice.inbox.pages.pop(0)
+        events = watcher.poll()
+        assert [(event, msg.id) for event, msg in events] == [('changed', 'b')]
+        assert voice.inbox.calls == 2
+        # Messages gone from the page are forgotten:
+        assert list(watcher.seen) == ['b']
+        watcher.stop()
+    
+    def test_voice_watch(self):
+        voice = self.voice([], [message_data('a')])
+        received = threading.Event()
+        watcher = voice.watch('inbox', lambda *event: received.set(),
+                              min_interval=0.01, refresh=0)
+        try:
+            assert received.wait(5)
+        finally:
+            watcher.stop()
+        assert voice.inbox.calls >= 2
+    
+    def test_restart(self):
+        from googlevoice.watch import Watcher
+        voice = self.voice([], [message_data('a')], [message_data('b', 1)])
+        received = []
+        watcher = Watcher(voice, callback=lambda *e: received.append(e),
+                          min_interval=60, refresh=0)
+        
+        def until(condition):
+            deadline = time.time() + 5
+            while not condition() and time.time() < deadline:
+                time.sleep(0.01)
+            assert condition()
+        
+        # Each start polls once straight away, then waits out the minute:
+        watcher.start()
+        until(lambda: voice.inbox.calls == 1)
+        watcher.stop(wait=False)
+        watcher.stop()
+        for count, msgid in ((1, 'a'), (2, 'b')):
+            watcher.start()
+            until(lambda: len(received) == count)
+            watcher.stop()
+            assert received[-1][1].id == msgid
+
+
+
+class TestUnreadCounts(object):
+    
+    def test_parser_chunks(self):
+        payload = feed_xml(dict(('m%d' % idx, message_data('m%d' % idx))
+                                for idx in range(200)),
+                           unreadCounts={'all': 7, 'inbox': 3})
+        chunks = [payload[i:i + 64].encode()
+                  for i in range(0, len(payload), 64)]
+        consumed = []
+        
+        def feed():
+            for chunk in chunks:
+                consumed.append(chunk)
+                yield chunk
+        
+        assert util.CountsParser().parse(feed()) == {'all': 7, 'inbox': 3}
+        assert len(consumed) < len(chunks)
+    
+    def test_missing(self):
+        with pytest.raises(util.ParsingError):
+            util.CountsParser().parse([b'<response><json>{}</json>'])
+    
+    @responses.activate
+    def test_cached(self, voice):
+        responses.add(responses.GET, settings.XML_INBOX,
+                      feed_xml({}, unreadCounts={'sms': 4}))
+        assert voice.unread_counts() == {'sms': 4}
+        assert voice.unread_counts().sms == 4
+        assert len(responses.calls) == 1
+        voice.unread_counts(max_age=0)
+        assert len(responses.calls) == 2
+
+
+class TestContacts(object):
+    
+    @pytest.fixture
+    def feed(self):
+        responses.add(responses.GET, settings.XML_CONTACTS, feed_xml(
+            {}, contacts={
+                'c1': {'contactId': 'c1', 'name': 'Alice',
+                       'phoneNumber': '+15555550100',
+                       'numbers': [{'phoneNumber': '+15555550199'}]},
+                'c2': {'contactId': 'c2', 'name': 'Bob',
+                       'phoneNumber': '+442071234567'}},
+            phones={'1': {'id': 1, 'phoneNumber': '+15555550111'}},
+            settings={'credits': 0}))
+    
+    @responses.activate
+    def test_lookup(self, voice, feed):
+        cache = voice.contacts_cache
+        assert cache.lookup('(555) 555-0199').name == 'Alice'
+        assert cache.lookup('+44 20 7123 4567').name == 'Bob'
+        assert cache.lookup('555-0100') is None
+        assert cache.get('c2').name == 'Bob'
+        assert len(cache) == 2
+        assert voice.phones[0] is voice.phones[0]
+        assert voice.settings is voice.settings
+        assert len(responses.calls) == 1
+    
+    @responses.activate
+    def test_ttl_and_invalidate(self, voice, feed):
+        voice.contacts
+        voice.contacts_cache.invalidate()
+        voice.contacts
+        assert len(responses.calls) == 2
+        voice.contacts_cache.ttl = -1
+        voice.contacts
+        assert len(responses.calls) == 3
+    
+    @responses.activate
+    def test_message_contact(self, voice, feed):
+        folder = util.Folder(voice, 'inbox', {})
+        msg = util.Message(folder, 'a', message_data('a'))
+        assert msg.contact.contactId == 'c1'
+        assert util.Message(None, 'a', message_data('a')).contact is None
+
+
+class TestE164(object):
+    
+    @pytest.mark.parametrize('number,expected', [
+        ('(555) 555-0100', '+15555550100'),
+        ('1.555.555.0100', '+15555550100'),
+        ('+1 555‑555‑0100', '+15555550100'),
+        ('555-555-0100 x12', '+15555550100'),
+        ('1-800-FLOWERS', '+18003569377'),
+        ('011 44 20 7123 4567', '+442071234567'),
+        ('0044 20 7123 4567', '+442071234567'),
+        ('22000', '22000'),
+        ('Private', 'Private'),
+        ('Unknown', 'Unknown'),
+        ('', ''),
+        (None, ''),
+    ])
+    def test_normalize(self, number, expected):
+        from googlevoice import e164
+        assert e164.normalize(number) == expected
+    
+    def test_country(self):
+        from googlevoice import e164
+        assert e164.normalize('020 7123 4567', '44') == '+442071234567'
+    
+    def test_normalize_many(self):
+        from googlevoice import e164
+        numbers = ['(555) 555-0100', '+15555550100', None, '22000'] * 3
+        assert e164.normalize_many(numbers) == \
+            [e164.normalize(number) for number in numbers]
+        assert e164.same_number('555.555.0100', '+1 (555) 555-0100')
+        assert not e164.same_number('Private', 'Unknown')
+
+
+class TestConversations(object):
+    
+    def test_threads(self):
+        from googlevoice.conversations import Conversations
+        alice, bob = '+15555550100', '(555) 555-0122'
+        conversations = Conversations()
+        conversations.add(util.Folder(None, 'sms', dict(messages={
+            'a1': message_data('a1', 5, phoneNumber=alice, isRead=False),
+            'b1': message_data('b1', 10, phoneNumber=bob),
+            'a0': message_data('a0', 1, phoneNumber='555.555.0100'),
+        })))
+        assert [t.number for t in conversations.top(1)] == ['+15555550122']
+        thread = conversations.thread('1 555 555 0100')
+        assert [msg.id for msg in thread] == ['a0', 'a1']
+        assert thread.unread == 1
+        assert conversations.unread == {'+15555550100': 1}
+        
+        conversations.add([
+            util.Message(None, 'a1', message_data('a1', 5, phoneNumber=alice)),
+            util.Message(None, 'a2', message_data('a2', 20, phoneNumber=alice)),
+        ])
+        assert [t.number for t in conversations] == [
+            '+15555550100', '+15555550122']
+        assert thread.unread == 0
+        assert thread.last.id == 'a2'
+        assert len(thread) == 3
+        assert len(conversations) == 2
+        assert conversations.top(0) == []
+    
+    @responses.activate
+    def test_unread_follows_operations(self, voice):
+        from googlevoice.conversations import Conversations
+        responses.add(responses.POST, settings.MARK, '{"ok": true}')
+        conversations = Conversations().add(util.Folder(voice, 'sms', dict(
+            messages={'a1': message_data('a1', 5, isRead=False),
+                      'a2': message_data('a2', 6, isRead=False)})))
+        thread, = conversations
+        assert thread.unread == 2
+        thread.last.mark()
+        assert thread.unread == 1
+        thread.last.mark(0)
+        assert conversations.unread == {thread.number: 2}
+
+
+class TestQuery(object):
+    
+    @pytest.fixture
+    def folder(self):
+        return util.Folder(None, 'all', dict(messages={
+            'v1': message_data('v1', 1, type=2, isRead=False),
+            'v2': message_data('v2', 2, type=2, star=True,
+                               phoneNumber='+15555550122'),
+            's1': message_data('s1', 3, type=10, labels=['sms', 'work']),
+            's2': message_data('s2', 4, type=11, isRead=False,
+                               labels=['sms']),
+        }))
+    
+    def ids(self, messages):
+        return [msg.id for msg in messages]
+    
+    def test_filters(self, folder):
+        assert self.ids(folder.query(type='voicemail')) == ['v2', 'v1']
+        assert self.ids(folder.query(type='sms')) == ['s2', 's1']
+        assert self.ids(folder.query(isRead=False)) == ['s2', 'v1']
+        assert self.ids(folder.query(type=2, isRead=True)) == ['v2']
+        assert self.ids(folder.query(label=['sms', 'work'])) == ['s1']
+        assert self.ids(folder.query(number='555 555 0122')) == ['v2']
+        assert self.ids(folder.query(star=False, limit=2)) == ['s2', 's1']
+        assert self.ids(folder.query(where=lambda m: m.type == 11)) == ['s2']
+        with pytest.raises(TypeError):
+            folder.query(unread=True)
+    
+    def test_time_range(self, folder):
+        since = datetime.datetime(2019, 1, 1, 0, 2)
+        assert self.ids(folder.query(since=since)) == ['s2', 's1', 'v2']
+        assert self.ids(folder.query(since=since, type=2)) == ['v2']
+        assert self.ids(folder.query(
+            since=1546300860000, until=since, isRead=False)) == ['v1']
+    
+    def test_incremental(self, folder):
+        index = folder.index
+        assert folder.index is index
+        index.add(util.Folder(None, 'all', dict(messages={
+            'v1': message_data('v1', 1, type=2, isRead=True),
+            'v3': message_data('v3', 9, type=2, isRead=False),
+        })))
+        assert len(index) == 5
+        assert self.ids(folder.query(type='voicemail', isRead=False)) == \
+            ['v3']
+    
+    @responses.activate
+    def test_follows_operations(self, voice):
+        for url in (settings.MARK, settings.STAR, settings.ARCHIVE):
+            responses.add(responses.POST, url, '{"ok": true}')
+        folder = util.Folder(voice, 'all', dict(messages={
+            'v1': message_data('v1', 1, isRead=False),
+            'v2': message_data('v2', 2, isRead=False),
+        }))
+        first, = folder.query(isRead=False, limit=1)
+        first.mark()
+        first.star()
+        voice.archive(folder.message('v1'))
+        assert self.ids(folder.query(isRead=False)) == ['v1']
+        assert self.ids(folder.query(star=True)) == ['v2']
+        assert self.ids(folder.query(label='inbox')) == ['v2']
+        # What was fetched is left as it was:
+        assert folder['messages']['v2']['isRead'] is False
+        folder.index.remove('v2')
+        assert self.ids(folder.query(star=True)) == []
+
+
+class TestIdentityMap(object):
+    
+    @responses.activate
+    def test_shared_across_folders(self, voice):
+        responses.add(responses.GET, settings.XML_INBOX,
+                      feed_xml({'a': message_data('a', isRead=False)}))
+        responses.add(responses.GET, settings.XML_ALL,
+                      feed_xml({'a': message_data('a', isRead=True),
+                                'b': message_data('b')}))
+        inbox = voice.inbox().messages
+        assert inbox[0].isRead is False
+        everything = voice.all().messages
+        assert everything[0] is inbox[0]
+        assert inbox[0].isRead is True
+        assert inbox[0].folder.name == 'all'
+        assert voice.identity_map['b'] is everything[1]
+    
+    def test_stale_payload_ignored(self, voice):
+        fresh = util.Folder(voice, 'inbox', dict(messages={
+            'a': message_data('a', star=True)}), fetched=2)
+        stale = util.Folder(voice, 'all', dict(messages={
+            'a': message_data('a', star=False)}), fetched=1)
+        message = fresh.message('a')
+        assert stale.message('a') is message
+        assert message['star'] is True
+    
+    @responses.activate
+    def test_optimistic_operations(self, voice):
+        for url in (settings.STAR, settings.MARK, settings.DELETE,
+                    settings.ARCHIVE):
+            responses.add(responses.POST, url, '{"ok": true}')
+        folder = util.Folder(voice, 'inbox', dict(messages={
+            'a': message_data('a', isRead=False)}))
+        message = folder.messages[0]
+        message.star()
+        message.mark()
+        message.delete()
+        assert (message['star'], message.isRead, message.isTrash) == \
+            (True, True, True)
+        voice.archive('a')
+        assert message.labels == ['all']
+        voice.archive('a', 0)
+        assert message.labels == ['inbox', 'all']
+        assert len(responses.calls) == 5
+
+
+class TestRefresh(object):
+    
+    @responses.activate
+    def test_delta(self, voice):
+        add_feed_pages('inbox', [
+            [message_data('d', 40), message_data('c', 30)],
+            [message_data('b', 20), message_data('a', 10)]])
+        folder = next(voice.pages('inbox'))
+        assert list(folder['messages']) == ['d', 'c']
+        
+        responses.reset()
+        add_feed_pages('inbox', [
+            [message_data('e', 50), message_data('c', 30, isRead=False)],
+            [message_data('b', 20), message_data('a', 10)]])
+        delta = folder.refresh()
+        assert delta.added == ['e']
+        assert delta.removed == ['d']
+        assert delta.changed == {'c': ['isRead']}
+        assert delta.pages == 2
+        assert list(folder['messages']) == ['e', 'c']
+        assert folder.hashes['c'] == util.content_hash(
+            message_data('c', 30, isRead=False))
+        
+        responses.reset()
+        add_feed_pages('inbox', [
+            [message_data('e', 50), message_data('c', 30, isRead=False)],
+            [message_data('b', 20), message_data('a', 10)]])
+        delta = folder.refresh()
+        assert not delta
+        assert delta.pages == 1
+        assert len(responses.calls) == 1
+    
+    @staticmethod
+    def spanning(voice):
+        """ A snapshot of both pages of an inbox, all read. """
+        messages = [message_data(msgid, minutes)
+                    for msgid, minutes in zip('dcba', (40, 30, 20, 10))]
+        return util.Folder(voice, 'inbox', dict(
+            messages=collections.OrderedDict(
+                (msg['id'], msg) for msg in messages),
+            totalSize=4, unreadCounts={'all': 0, 'inbox': 0},
+            resultsPerPage=2))
+    
+    @responses.activate
+    def test_older_read_change_followed_by_unread_count(self, voice):
+        folder = self.spanning(voice)
+        add_feed_pages('inbox', [
+            [message_data('d', 40), message_data('c', 30)],
+            [message_data('b', 20, isRead=False), message_data('a', 10)]],
+            unreadCounts={'all': 1, 'inbox': 1})
+        delta = folder.refresh()
+        assert delta.changed == {'b': ['isRead']}
+        assert delta.pages == 2
+        assert folder['unreadCounts']['inbox'] == 1
+    
+    @responses.activate
+    def test_older_star_change_needs_full(self, voice):
+        folder = self.spanning(voice)
+        add_feed_pages('inbox', [
+            [message_data('d', 40), message_data('c', 30)],
+            [message_data('b', 20), message_data('a', 10, star=True)]])
+        delta = folder.refresh()
+        assert not delta
+        assert delta.pages == 1
+        
+        delta = folder.refresh(full=True)
+        assert delta.changed == {'a': ['star']}
+        assert delta.pages == 2
+        assert not delta.removed
+    
+    @responses.activate
+    def test_removed_with_older_message_sliding_in(self, voice):
+        add_feed_pages('inbox', [
+            [message_data('d', 40), message_data('c', 30)],
+            [message_data('b', 20), message_data('a', 10)]])
+        folder = next(voice.pages('inbox'))
+        
+        # “c” is deleted, and “b” – never seen – slides into its place:
+        responses.reset()
+        add_feed_pages('inbox', [
+            [message_data('d', 40), message_data('b', 20)],
+            [message_data('a', 10)]])
+        delta = folder.refresh()
+        assert delta.removed == ['c']
+        assert delta.added == []
+        assert list(folder['messages']) == ['d']
+
+
+class TestSingleFlight(object):
+    
+    def test_errors_shared(self):
+        flights = util.SingleFlight()
+        started, release = threading.Event(), threading.Event()
+        errors = []
+        
+        def fail():
+            started.set()
+            release.wait(5)
+            raise ValueError('boom')
+        
+        def call():
+            try:
+                flights.do('key', fail)
+            except ValueError as exc:
+                errors.append(exc)
+        
+        leader = threading.Thread(target=call)
+        leader.start()
+        started.wait(5)
+        waiter = threading.Thread(target=call)
+        waiter.start()
+        while not flights.stats['waiters']:
+            time.sleep(0.001)
+        release.set()
+        leader.join()
+        waiter.join()
+        assert len(errors) == 2 and errors[0] is errors[1]
+        assert flights.stats == dict(calls=2, executions=1, waiters=1)
+        assert flights.flights == {}
+    
+    @responses.activate
+    def test_coalesced_feed(self, voice):
+        arrived, release = threading.Semaphore(0), threading.Event()
+        
+        def respond(request):
+            arrived.release()
+            release.wait(5)
+            return 200, {}, feed_xml({'a': message_data('a')})
+        
+        responses.add_callback(responses.GET, settings.XML_INBOX, respond)
+        folders = []
+        threads = [threading.Thread(target=lambda: folders.append(
+            voice.inbox())) for _ in range(8)]
+        for thread in threads:
+            thread.start()
+        arrived.acquire()
+        while voice.flights.stats['calls'] < len(threads):
+            time.sleep(0.001)
+        release.set()
+        for thread in threads:
+            thread.join()
+        assert len(responses.calls) == 1
+        assert all(folder is folders[0] for folder in folders)
+        assert voice.flights.stats['waiters'] == len(threads) - 1
+
+
+class TestFetchMessages(object):
+    
+    @responses.activate
+    def test_bounded_and_cached(self, voice):
+        lock = threading.Lock()
+        active, peak = [0], [0]
+        
+        def respond(request):
+            msgid = request.url.rsplit('id=', 1)[1]
+            with lock:
+                active[0] += 1
+                peak[0] = max(peak[0], active[0])
+            time.sleep(0.01)
+            with lock:
+                active[0] -= 1
+            if msgid == 'bad':
+                return 500, {}, ''
+            return 200, {}, feed_xml({msgid: message_data(msgid)})
+        
+        responses.add_callback(responses.GET, settings.XML_MESSAGE, respond)
+        ids = ['m%d' % n for n in range(12)]
+        fetched = dict(voice.fetch_messages(ids + ids[:2], concurrency=3))
+        assert sorted(fetched) == sorted(ids)
+        assert list(fetched['m5']['messages']) == ['m5']
+        assert peak[0] <= 3
+        assert len(responses.calls) == len(ids)
+        
+        # Cached ids are yielded once, however often they are given:
+        assert [msgid for msgid, _ in voice.fetch_messages(
+            ['m1', 'm2', 'm1', 'm2'])] \
+            == ['m1', 'm2']
+        
+        result = dict(voice.fetch_messages(['m1', 'bad'], concurrency=2,
+                                           return_exceptions=True))
+        assert result['m1'] is fetched['m1']
+        assert isinstance(result['bad'], Exception)
+        assert len(responses.calls) == len(ids) + 1
+        with pytest.raises(Exception):
+            list(voice.fetch_messages(['bad']))
+
+
+class TestTOTP(object):
+    
+    def test_rfc6238_vectors(self):
+        secret = b'12345678901234567890'
+        for at, code in [(59, '94287082'), (1111111109, '07081804'),
+                         (1234567890, '89005924'), (2000000000, '69279037')]:
+            assert totp.hotp(secret, totp.counter(at), digits=8) == code
+        key = 'gezd gnbv gy3t qojq gezd gnbv gy3t qojq'
+        assert totp.secret(key) == secret
+        assert totp.totp(key, at=59) == '287082'
+    
+    def test_windows(self):
+        now, slept = [95.], []
+        
+        def sleep(seconds):
+            slept.append(seconds)
+            now[0] += seconds
+        
+        steps = totp.windows(clock=lambda: now[0], sleep=sleep)
+        assert list(itertools.islice(steps, 5)) == [3, 4, 2, 5, 6]
+        assert slept == [25., 30.]
+        
+        # No waiting at all for steps already within the skew:
+        now[0], slept[:] = 95., []
+        steps = totp.windows(skew=2, clock=lambda: now[0], sleep=sleep)
+        assert list(itertools.islice(steps, 6)) == [3, 4, 2, 5, 1, 6]
+        assert slept == [25.]
+    
+    @responses.activate
+    def test_sms_auth_skew(self, voice):
+        key = 'JBSWY3DPEHPK3PXP'
+        pins = []
+        
+        def respond(request):
+            pins.append(dict(six.moves.urllib.parse.parse_qsl(
+                request.body))['smsUserPin'])
+            if len(pins) < 3:
+                return 200, {}, "The code you entered didn&#39;t verify."
+            return 200, {}, 'name="smsToken" value="token"'
+        
+        responses.add_callback(responses.POST, settings.SMSAUTH, respond)
+        start = totp.counter()
+        content = voice._Voice__smsAuth(key)
+        assert 'smsToken' in content
+        secret = totp.secret(key)
+        assert pins in [[totp.hotp(secret, step + offset)
+                         for offset in (0, 1, -1)]
+                        for step in (start, start + 1)]
+
+
+class TestScheduler(object):
+    
+    class Recorder(object):
+        """ Stands in for ``Voice``, failing its first ``call``. """
+        
+        def __init__(self):
+            self.calls = []
+        
+        def send_sms(self, number, text):
+            self.calls.append(('send_sms', number, text))
+        
+        def call(self, number):
+            self.calls.append(('call', number))
+            if len(self.calls) == 1:
+                raise util.ValidationError('busy')
+    
+    def test_run(self, tmpdir):
+        from googlevoice import scheduler
+        queue = scheduler.Queue(str(tmpdir / 'jobs.sqlite'))
+        voice = self.Recorder()
+        runner = scheduler.Scheduler(voice, queue, workers=2, backoff=0)
+        now = time.time()
+        late = runner.schedule(now + 0.05, 'send_sms', '5551212', 'later')
+        runner.schedule(now - 1, 'call', '5551213')
+        cancelled = runner.schedule(now - 2, 's', '5551214', 'never')
+        assert runner.cancel(cancelled.id)
+        runner.run(until_idle=True)
+        assert voice.calls == [('call', '5551213'), ('call', '5551213'),
+                               ('send_sms', '5551212', 'later')]
+        jobs = dict((job.id, job) for job in queue.jobs())
+        assert jobs[late.id].status == scheduler.DONE
+        assert jobs[cancelled.id].status == scheduler.CANCELLED
+        assert [jobs[key].attempts for key in sorted(jobs)] == [1, 2, 0]
+        assert queue.jobs(scheduler.PENDING) == []
+    
+    def test_durable(self, tmpdir):
+        from googlevoice import scheduler
+        path = str(tmpdir / 'jobs.sqlite')
+        queue = scheduler.Queue(path)
+        job = queue.add(time.time() + 3600, 'call', ['5551212'])
+        queue.update(job.id, scheduler.RUNNING)
+        # Claimed by another scheduler, still running it:
+        live = queue.add(time.time(), 'call', ['5551213'])
+        assert queue.claim(live.id, 'other', time.time() + 60).attempts == 1
+        queue.close()
+        runner = scheduler.Scheduler(self.Recorder(), scheduler.Queue(path))
+        assert runner.queue.get(job.id).status == scheduler.PENDING
+        assert runner.queue.get(live.id).status == scheduler.RUNNING
+        assert runner.heap == [(job.due, job.id)]
+        # … until its lease runs out:
+        runner.queue.renew('other', time.time() - 1)
+        runner.refresh()
+        assert runner.queue.get(live.id).status == scheduler.PENDING
+        assert live.id in runner.due
+        with pytest.raises(ValueError):
+            runner.queue.add(0, 'frobnicate')
+    
+    def test_cli(self, tmpdir):
+        from googlevoice import scheduler
+        path = str(tmpdir / 'jobs.sqlite')
+        out = six.StringIO()
+        assert scheduler.main(['-d', path, 'enqueue', '+15m', 's',
+                               '5551212', 'on', 'my', 'way'], out) == 0
+        assert scheduler.main(['-d', path, 'enqueue', '2030-01-01T09:00',
+                               'call', '5551213'], out) == 0
+        first, second = out.getvalue().split()
+        assert scheduler.main(['-d', path, 'cancel', second]) == 0
+        assert scheduler.main(['-d', path, 'cancel', second]) == 1
+        with pytest.raises(SystemExit):
+            scheduler.main(['-d', path, 'cancel', 'first'])
+        out = six.StringIO()
+        scheduler.main(['-d', path, 'list'], out)
+        rows = [line.split('\t') for line in out.getvalue().splitlines()]
+        assert [row[0] for row in rows] == [first]
+        assert rows[0][3] == 'send_sms 5551212 on my way'
+    
+    def test_claimed_once(self, tmpdir):
+        from googlevoice import scheduler
+        path = str(tmpdir / 'jobs.sqlite')
+        first, second = scheduler.Queue(path), scheduler.Queue(path)
+        job = first.add(time.time(), 'call', ['5551212'])
+        claimed = [queue.claim(job.id, owner, time.time() + 60)
+                   for queue, owner in ((first, 'a'), (second, 'b'))]
+        assert claimed[0].owner == 'a' and claimed[1] is None
+        assert second.get(job.id).attempts == 1
+    
+    def test_logs_errors_running_jobs(self, tmpdir, caplog):
+        from googlevoice import scheduler
+        runner = scheduler.Scheduler(self.Recorder(), scheduler.Queue(
+            str(tmpdir / 'jobs.sqlite')))
+        job = runner.schedule(0, 'send_sms', '5551212', 'hi')
+        update = runner.queue.update
+        
+        def broken(job_id, status, **fields):
+            if status == scheduler.DONE:
+                raise sqlite3.OperationalError('database is locked')
+            return update(job_id, status, **fields)
+        
+        runner.queue.update = broken
+        runner.run(until_idle=True)
+        assert 'Job #%s could not be run' % job.id in caplog.text
+        assert runner.queue.get(job.id).error == \
+            'OperationalError: database is locked'
+    
+    def test_picks_up_jobs_while_running(self, tmpdir):
+        from googlevoice import scheduler
+        path = str(tmpdir / 'jobs.sqlite')
+        voice = self.Recorder()
+        runner = scheduler.Scheduler(voice, scheduler.Queue(path), poll=0.02)
+        thread = threading.Thread(target=runner.run)
+        thread.start()
+        try:
+            # Enqueued and cancelled from another process, as by the CLI:
+            other = scheduler.Queue(path)
+            cancelled = other.add(time.time() + 0.3, 'call', ['5551214'])
+            other.add(time.time(), 'send_sms', ['5551212', 'hi'])
+            deadline = time.time() + 5
+            while not voice.calls or cancelled.id not in runner.due:
+                assert time.time() < deadline
+                time.sleep(0.01)
+            assert other.cancel(cancelled.id)
+            time.sleep(0.5)
+        finally:
+            runner.stop()
+            thread.join()
+        assert voice.calls == [('send_sms', '5551212', 'hi')]
+    
+    def test_logs_in_again(self, tmpdir):
+        from googlevoice import scheduler
+        
+        class Expiring(object):
+            """ A session that has expired, until logged into again. """
+            
+            def __init__(self):
+                self.logged_in = False
+                self.logins = 0
+                self.calls = []
+            
+            def session_valid(self):
+                return self.logged_in
+            
+            def login(self):
+                self.logins += 1
+                self.logged_in = True
+                return self
+            
+            def call(self, number):
+                self.calls.append(number)
+                if not self.logged_in:
+                    raise util.LoginError('not logged in')
+        
+        voice = Expiring()
+        runner = scheduler.Scheduler(voice, scheduler.Queue(
+            str(tmpdir / 'jobs.sqlite')), workers=2)
+        runner.schedule(0, 'call', '5551212')
+        runner.schedule(0, 'call', '5551213')
+        runner.run(until_idle=True)
+        assert voice.logins == 1
+        assert set(voice.calls) == set(['5551212', '5551213'])
+        # Run again at once, without using up an attempt:
+        assert [(job.status, job.attempts) for job in runner.queue.jobs()] \
+            == [(scheduler.DONE, 1)] * 2
+    
+    def test_other_failures_leave_the_session(self, tmpdir):
+        from googlevoice import scheduler
+        voice = self.Recorder()
+        voice.session_valid = lambda: pytest.fail('session checked')
+        runner = scheduler.Scheduler(voice, scheduler.Queue(
+            str(tmpdir / 'jobs.sqlite')), backoff=0)
+        runner.schedule(0, 'call', '5551212')
+        runner.run(until_idle=True)
+        assert voice.calls == [('call', '5551212')] * 2
+        assert scheduler.expired('LoginError: ')
+        assert scheduler.expired('HTTPError: 401 Client Error: for url')
+        assert not scheduler.expired('HTTPError: 500 Server Error')
+        assert not scheduler.expired('ValidationError: busy')
+    
+    def test_timestamp(self):
+        from googlevoice.scheduler import timestamp
+        assert abs(timestamp('+2m') - time.time() - 120) < 1
+        utc = datetime.datetime(2019, 1, 1, tzinfo=util.timezone.utc)
+        assert timestamp(utc) == 1546300800
+        with pytest.raises(ValueError):
+            timestamp('tomorrow')
+
+
+class TestWriteBehind(object):
+    
+    @responses.activate
+    def test_coalesced(self, voice):
+        for url in (settings.STAR, settings.MARK):
+            responses.add(responses.POST, url, '{"ok": true}')
+        folder = util.Folder(voice, 'inbox', dict(messages=dict(
+            (msgid, message_data(msgid, isRead=False))
+            for msgid in 'abc')))
+        a, b, c = [folder.message(msgid) for msgid in 'abc']
+        queue = voice.write_behind(interval=60)
+        a.mark(1)
+        a.mark(0)
+        b.mark()
+        b.star()
+        b.star(0)
+        b.star()
+        c.mark()
+        assert (a.isRead, b.isRead, b['star']) == (False, True, True)
+        assert len(queue) == 3
+        assert queue.flush() == 0
+        posted = sorted((call.request.url, call.request.body)
+                        for call in responses.calls)
+        assert [url for url, _ in posted] == [settings.MARK, settings.STAR]
+        assert not any('messages=a' in body for _, body in posted)
+        assert posted[0][1].startswith('messages=b&messages=c&read=1') or \
+            posted[0][1].startswith('messages=c&messages=b&read=1')
+        assert posted[1][1].startswith('messages=b&star=1')
+        assert queue.close() == 0
+        assert len(responses.calls) == 2
+    
+    @responses.activate
+    def test_threshold_and_failure(self, voice):
+        responses.add(responses.POST, settings.STAR, '{"ok": false}')
+        failures = []
+        done = threading.Event()
+        
+        def callback(*failure):
+            failures.append(failure)
+            done.set()
+        
+        folder = util.Folder(voice, 'inbox', dict(messages=dict(
+            (msgid, message_data(msgid)) for msgid in 'ab')))
+        voice.write_behind(interval=60, threshold=2, callback=callback)
+        for message in folder.messages:
+            message.star()
+        assert done.wait(5)
+        operation, ids, value, error = failures[0]
+        assert (operation, sorted(ids), value) == ('star', ['a', 'b'], 1)
+        assert isinstance(error, util.ValidationError)
+        assert [message['star'] for message in folder.messages] == \
+            [False, False]
+        voice.mutations.close()
+
+
+class TestSnapshot(object):
+    
+    def folder(self, voice):
+        folder = util.Folder(voice, 'sms', dict(
+            messages=dict((msgid, message_data(msgid, minutes))
+                          for minutes, msgid in enumerate('abc')),
+            totalSize=3, unreadCounts={'sms': 1}), fetched=time.time() - 60)
+        folder.page = 2
+        return folder
+    
+    @pytest.mark.parametrize('encoding,compress', [
+        (0, False), (0, True), (1, False), (1, True)])
+    def test_round_trip(self, voice, tmpdir, encoding, compress):
+        from googlevoice import snapshot
+        if encoding == snapshot.MSGPACK:
+            pytest.importorskip('msgpack')
+        if compress:
+            pytest.importorskip('zstandard')
+        folder = self.folder(voice)
+        path = str(tmpdir / 'sms.gvsnap')
+        snapshot.dump(folder, path, compress, encoding)
+        header = snapshot.info(path)
+        assert (header.version, header.encoding) == (
+            snapshot.FORMAT_VERSION, encoding)
+        assert header.fetched == folder.fetched
+        loaded = util.Folder.load(path, voice, max_age=3600)
+        assert loaded == folder
+        assert (loaded.name, loaded.fetched, loaded.page) == (
+            'sms', folder.fetched, 2)
+        assert loaded.messages[0].startDateTime == \
+            folder.messages[0].startDateTime
+        with pytest.raises(util.SnapshotError):
+            util.Folder.load(path, voice, max_age=30)
+        lazy = snapshot.load(path, voice, lazy=True)
+        assert isinstance(lazy['messages'], snapshot.Messages)
+        assert lazy['messages']['b'] == folder['messages']['b']
+        assert list(lazy['messages'].decoded) == ['b']
+        assert [message.id for message in lazy.query(since=0)] == \
+            ['c', 'b', 'a']
+    
+    def test_invalid(self, voice, tmpdir):
+        path = tmpdir / 'sms.gvsnap'
+        self.folder(voice).dump(str(path))
+        data = path.read_binary()
+        for broken in (b'', data[:20], data[:-1], b'x' + data[1:],
+                       data[:8] + b'\x09' + data[9:]):
+            path.write_binary(broken)
+            with pytest.raises(util.SnapshotError):
+                util.Folder.load(str(path))
+    
+    def test_undecodable_records(self, voice, tmpdir):
+        from googlevoice import snapshot
+        path = tmpdir / 'sms.gvsnap'
+        folder = self.folder(voice)
+        snapshot.dump(folder, str(path), encoding=snapshot.PICKLE)
+        last = list(folder['messages'])[-1]
+        # The last record’s pickle loses its STOP opcode:
+        data = path.read_binary()
+        path.write_binary(data[:-1] + b'\xff')
+        with pytest.raises(util.SnapshotError):
+            util.Folder.load(str(path))
+        lazy = snapshot.load(str(path), voice, lazy=True)
+        with lazy['messages'] as messages:
+            with pytest.raises(util.SnapshotError):
+                messages[last]
+            first = messages[list(folder['messages'])[0]]
+        assert messages.closed
+        assert messages[list(folder['messages'])[0]] == first
+        with pytest.raises(ValueError):
+            messages[list(folder['messages'])[1]]
+    
+    @responses.activate
+    def test_voice_snapshot(self, voice, tmpdir):
+        responses.add(responses.GET, settings.XML_SMS,
+                      feed_xml({'a': message_data('a')}, totalSize=1))
+        voice.snapshot_dir = str(tmpdir / 'snapshots')
+        first = voice.snapshot('sms')
+        second = voice.snapshot('sms')
+        assert len(responses.calls) == 1
+        assert second == first and second.fetched == first.fetched
+        voice.snapshot('sms', max_age=0)
+        assert len(responses.calls) == 2
+        # An undecodable snapshot is refetched, too:
+        path = tmpdir / 'snapshots' / 'sms.gvsnap'
+        path.write_binary(path.read_binary()[:-1] + b'\xff')
+        assert voice.snapshot('sms') == first
+        assert len(responses.calls) == 3
+
+
+class TestMessageStream(object):
+    
+    def test_scanner_chunks(self):
+        tricky = u'q\\"u"o}{,te[]\\\\ é'
+        data = dict(unreadCounts={'all': 3, 'x': [1, {'y': '}'}]},
+                    messages=dict(('m%d' % n, message_data(
+                        'm%d' % n, n, note=tricky, extra={'n': [{}]}))
+                        for n in range(20)),
+                    totalSize=20, resultsPerPage=10, empty=[])
+        text = json.dumps(data)
+        rng = random.Random(7)
+        for _ in range(50):
+            scanner, entries, position = util.MemberScanner(), [], 0
+            while position < len(text):
+                size = rng.randint(1, 40)
+                entries.extend(scanner.feed(text[position:position + size]))
+                position += size
+            assert dict(entries) == data['messages']
+            assert [msgid for msgid, _ in entries] == list(data['messages'])
+            assert sorted(scanner.meta) == [
+                'empty', 'resultsPerPage', 'totalSize', 'unreadCounts']
+        scanner = util.MemberScanner()
+        assert scanner.feed('{"messages": {}, "totalSize": 0}') == []
+        assert scanner.meta == {'totalSize': 0}
+    
+    @pytest.mark.parametrize('text', [
+        '{"n": 1.5, "messages": {"a": 2.25e3}}',
+        '{"n": -10E-1 , "messages": {"a": 0.125}\n}'])
+    def test_scanner_split_numbers(self, text):
+        for split in range(1, len(text)):
+            scanner = util.MemberScanner()
+            entries = scanner.feed(text[:split]) + scanner.feed(text[split:])
+            scanner.close()
+            expected = json.loads(text)
+            assert dict(entries) == expected.pop('messages')
+            assert scanner.meta == expected
+    
+    @responses.activate
+    def test_iter_messages(self, voice):
+        messages = collections.OrderedDict(
+            ('m%d' % n, message_data('m%d' % n, n)) for n in range(30))
+        responses.add(responses.GET, settings.XML_ALL,
+                      feed_xml(messages, totalSize=300))
+        streamed = list(voice.iter_messages('all', chunk_size=97))
+        assert [message.id for message in streamed] == list(messages)
+        assert streamed[3].startDateTime == \
+            datetime.datetime(2019, 1, 1, 0, 3, tzinfo=util.timezone.utc)
+        assert streamed[0].folder.totalSize == 300
+        assert streamed[0].folder['messages'] == {}
+        assert voice.identity_map['m3'] is streamed[3]
+        assert responses.calls[0].request.params['page'] == 'p1'
+
+
+class TestProfiling(object):
+    
+    @responses.activate
+    def test_report(self, voice, tmpdir):
+        from googlevoice import profiling
+        
+        def respond(request):
+            time.sleep(0.05)
+            return 200, {}, feed_xml({'a': message_data('a')})
+        
+        responses.add_callback(responses.GET, settings.XML_INBOX, respond)
+        prefix = str(tmpdir / 'run')
+        with profiling.Profiler(prefix, interval=0.001) as profiler:
+            assert profiling.active is profiler
+            assert len(voice.inbox().messages) == 1
+        assert profiling.active is None
+        assert set(profiler.calls) == {'network', 'parse', 'decode', 'build'}
+        assert profiler.totals['network'] >= 0.05
+        report = (tmpdir / 'run.txt').read()
+        assert 'peak traced memory' in report
+        assert 'cumulative' in report
+        collapsed = (tmpdir / 'run.collapsed').read().splitlines()
+        assert any(line.startswith('phase:network;') for line in collapsed)
+        assert all(line.rsplit(' ', 1)[1].isdigit() for line in collapsed)
+        assert (tmpdir / 'run.prof').size()
+    
+    @responses.activate
+    def test_streamed_messages_are_built_in_phase(self, voice, tmpdir):
+        from googlevoice import profiling
+        responses.add(responses.GET, settings.XML_INBOX,
+                      feed_xml({'a': message_data('a')}))
+        with profiling.Profiler(str(tmpdir / 'run')) as profiler:
+            assert len(list(voice.iter_messages('inbox'))) == 1
+        assert profiler.calls['build'] == 1
+    
+    def test_started_by_first_voice(self, tmpdir, monkeypatch):
+        from googlevoice import profiling
+        prefix = str(tmpdir / 'voice')
+        monkeypatch.setenv('GOOGLEVOICE_PROFILE', prefix)
+        monkeypatch.setattr(profiling, 'environment_checked', False)
+        profiler = None
+        try:
+            Voice()
+            profiler = profiling.active
+            assert profiler is not None and profiler.prefix == prefix
+            Voice()
+            assert profiling.active is profiler
+        finally:
+            if profiler is not None:
+                profiler.stop()
+        assert profiling.environment_checked
+    
+    def test_from_environment(self, tmpdir):
+        from googlevoice import profiling
+        assert profiling.from_environment({}) is None
+        prefix = str(tmpdir / 'env')
+        profiler = profiling.from_environment(
+            {'GOOGLEVOICE_PROFILE': prefix})
+        try:
+            assert profiling.active is profiler
+            assert profiler.prefix == prefix
+        finally:
+            profiler.stop()
+        assert (tmpdir / 'env.txt').check()
+        # … and the stop at exit does nothing more:
+        assert profiler.stop() is None
+
+
+class TestThreadSafety(object):
+    
+    feeds = ('inbox', 'all', 'sms', 'voicemail')
+    
+    @pytest.fixture
+    def server(self, monkeypatch):
+        """ A local stand-in for Google Voice, serving a distinct feed per
+            URL, slowly enough for requests to overlap.
+        """
+        from six.moves import BaseHTTPServer, socketserver
+        from six.moves.urllib.parse import urlparse, parse_qs
+        hits = dict(special=0)
+        lock = threading.Lock()
+        feeds = self.feeds
+        
+        class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+            
+            def do_GET(self):
+                url = urlparse(self.path)
+                name = url.path.strip('/')
+                time.sleep(0.002)
+                if name == 'special':
+                    with lock:
+                        hits['special'] += 1
+                    time.sleep(0.05)
+                    body = "'_rnr_se': 'special-value'"
+                elif name in feeds:
+                    page = parse_qs(url.query).get('page', ['p1'])[0]
+                    body = feed_xml(dict(
+                        ('%s-%s-%d' % (name, page, n),
+                         message_data('%s-%s-%d' % (name, page, n), n))
+                        for n in range(25)), totalSize=50, resultsPerPage=25)
+                else:
+                    self.send_error(404)
+                    return
+                body = body.encode('utf-8')
+                self.send_response(200)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+            
+            def log_message(self, *args):
+                pass
+        
+        class Server(socketserver.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+            daemon_threads = True
+        
+        httpd = Server(('127.0.0.1', 0), Handler)
+        thread = threading.Thread(target=httpd.serve_forever)
+        thread.daemon = True
+        thread.start()
+        base = 'http://127.0.0.1:%d/' % httpd.server_address[1]
+        monkeypatch.setattr(settings, 'INBOX', base + 'special')
+        for name in feeds:
+            monkeypatch.setattr(settings, 'XML_' + name.upper(), base + name)
+        yield hits
+        httpd.shutdown()
+        httpd.server_close()
+    
+    def test_concurrent_feeds(self, server):
+        voice = Voice()
+        voice.session.mount('http://', requests_adapter(32))
+        errors = []
+        start = threading.Event()
+        
+        def work(worker):
+            try:
+                start.wait()
+                assert voice.special == 'special-value'
+                for round in range(8):
+                    name = self.feeds[(worker + round) % len(self.feeds)]
+                    if round % 2:
+                        pages = list(voice.pages(name))
+                    else:
+                        pages = [getattr(voice, name)()]
+                    for number, folder in enumerate(pages, 1):
+                        ids = sorted(message.id
+                                     for message in folder.messages)
+                        assert len(ids) == 25
+                        assert all(msgid.startswith('%s-p%d-' % (
+                            name, number)) for msgid in ids), ids
+            except Exception as exc:
+                errors.append(exc)
+        
+        threads = [threading.Thread(target=work, args=(n,))
+                   for n in range(32)]
+        for thread in threads:
+            thread.start()
+        start.set()
+        for thread in threads:
+            thread.join()
+        assert errors == []
+        assert server['special'] == 1
+
+
+def requests_adapter(size):
+    from requests.adapters import HTTPAdapter
+    return HTTPAdapter(pool_connections=size, pool_maxsize=size)
+
+
+class TestCommandLine(object):
+    
+    def test_parse_args(self):
+        from googlevoice.__main__ import parse_args
+        options, args = parse_args(['sms', '-b', '-e', 'me@example.com'])
+        assert args == ['sms']
+        assert options.batch and options.email == 'me@example.com'
+        # Subcommands get the options following them:
+        options, args = parse_args(['-b', 'list', '-n', '5', '-a', 'sms'])
+        assert args == ['list', '-n', '5', '-a', 'sms']
+        assert options.batch
+        options, args = parse_args(['export', '-e', 'x.csv', 'all'])
+        assert args == ['export', '-e', 'x.csv', 'all']
+        assert options.email is None
+
+
+class TestPrefetch(object):
+    
+    @pytest.fixture
+    def fetches(self, voice):
+        fetches = collections.Counter()
+        for name in ('inbox', 'sms', 'voicemail', 'all'):
+            def respond(request, name=name):
+                fetches[name] += 1
+                return 200, {}, feed_xml({
+                    '%s%d' % (name, fetches[name]): message_data(name)})
+            responses.add_callback(responses.GET,
+                                   getattr(settings, 'XML_' + name.upper()),
+                                   respond)
+        return fetches
+    
+    def wait_for(self, condition, timeout=5.):
+        deadline = time.time() + timeout
+        while not condition():
+            assert time.time() < deadline
+            time.sleep(0.01)
+    
+    def test_staleness(self):
+        from googlevoice.prefetch import staleness
+        assert staleness(0.2) == 'just fetched'
+        assert staleness(12.7) == 'fetched 12s ago'
+        assert staleness(600) == 'fetched 10m ago'
+    
+    @responses.activate
+    def test_cache_and_refresh(self, voice, fetches):
+        from googlevoice.prefetch import Prefetcher
+        now = [1000.]
+        prefetcher = Prefetcher(voice, ttl=60., initial=(),
+                                clock=lambda: now[0])
+        try:
+            assert prefetcher.get('sms').messages[0].id == 'sms1'
+            assert fetches['sms'] == 1
+            now[0] += 30
+            assert prefetcher.get('sms').messages[0].id == 'sms1'
+            assert prefetcher.age('sms') == 30
+            assert prefetcher.get('sms', refresh=True).messages[0].id \
+                == 'sms2'
+            assert prefetcher.age('sms') == 0
+            now[0] += 61
+            assert prefetcher.get('sms').messages[0].id == 'sms3'
+            assert prefetcher.age('voicemail') is None
+        finally:
+            prefetcher.close()
+        assert not prefetcher.thread.is_alive()
+    
+    @responses.activate
+    def test_prefetches_favourites_while_idle(self, voice, fetches):
+        from googlevoice.prefetch import Prefetcher
+        prefetcher = Prefetcher(voice, ttl=0.2, top=2)
+        try:
+            # Nothing is fetched until the shell is idle:
+            time.sleep(0.05)
+            assert not fetches
+            prefetcher.idle()
+            self.wait_for(lambda: prefetcher.age('inbox') is not None)
+            prefetcher.busy()
+            for _ in range(3):
+                prefetcher.get('voicemail')
+            prefetcher.get('all')
+            assert prefetcher.favourites() == ['voicemail', 'all']
+            count = fetches['voicemail']
+            prefetcher.idle()
+            self.wait_for(lambda: fetches['voicemail'] > count + 1)
+            prefetcher.busy()
+            # Refreshed in the background, at half the TTL:
+            assert prefetcher.age('voicemail') <= 0.2
+            assert fetches['sms'] == 0
+        finally:
+            prefetcher.close()
+    
+    @responses.activate
+    def test_pause_and_resume(self, voice, fetches):
+        from googlevoice.prefetch import Prefetcher
+        prefetcher = Prefetcher(voice, ttl=0.2)
+        try:
+            prefetcher.idle()
+            self.wait_for(lambda: prefetcher.age('inbox') is not None)
+            # Logging out forgets the cache, and stops background fetches:
+            prefetcher.pause()
+            assert prefetcher.age('inbox') is None
+            # A fetch already under way finishes, but isn’t cached:
+            time.sleep(0.05)
+            count = fetches['inbox']
+            time.sleep(0.3)
+            assert fetches['inbox'] == count
+            assert prefetcher.age('inbox') is None
+            prefetcher.resume()
+            self.wait_for(lambda: prefetcher.age('inbox') is not None)
+        finally:
+            prefetcher.close()
+        assert not prefetcher.thread.is_alive()
+
+
+class TestRender(object):
+    
+    @pytest.fixture
+    def paged(self, voice):
+        """ Three pages of ten messages in the ``all`` feed, counting the
+            requests for each page.
+        """
+        requests = collections.Counter()
+        
+        def respond(request):
+            page = int(request.url.partition('page=p')[2].split('&')[0]
+                       or 1)
+            requests[page] += 1
+            return 200, {}, feed_xml(collections.OrderedDict(
+                ('m%02d' % n, dict(message_data('m%02d' % n, n),
+                                   displayNumber='(555) 01%02d' % n,
+                                   messageText='line\tone\nline two'))
+                for n in range(page * 10 - 10, min(page * 10, 25))),
+                totalSize=25)
+        
+        responses.add_callback(responses.GET, settings.XML_ALL, respond)
+        return requests
+    
+    @responses.activate
+    def test_limit_stops_fetching(self, voice, paged):
+        from googlevoice import render
+        out = six.StringIO()
+        assert render.render(voice, 'all', limit=12, columns=('id',),
+                             format='tsv', stream=out) == 12
+        assert out.getvalue().splitlines() == \
+            ['id'] + ['m%02d' % n for n in range(12)]
+        assert dict(paged) == {1: 1, 2: 1}
+        
+        # Exactly a page’s worth needs no look at the next page:
+        paged.clear()
+        assert render.render(voice, 'all', limit=10, stream=six.StringIO()) \
+            == 10
+        assert dict(paged) == {1: 1}
+    
+    @responses.activate
+    def test_pages(self, voice, paged):
+        from googlevoice import render
+        assert render.render(voice, 'all', stream=six.StringIO()) == 10
+        assert dict(paged) == {1: 1}
+        assert render.render(voice, 'all', everything=True,
+                             stream=six.StringIO()) == 25
+        assert dict(paged) == {1: 2, 2: 1, 3: 1}
+        
+        # A first page at hand – e.g. prefetched – isn’t fetched again:
+        paged.clear()
+        first = voice.all()
+        assert render.render(voice, 'all', limit=15, first=first,
+                             stream=six.StringIO()) == 15
+        assert dict(paged) == {1: 1, 2: 1}
+        
+        # Nor is a first page without its page size:
+        paged.clear()
+        first = voice.all()
+        del first['resultsPerPage']
+        assert render.render(voice, 'all', everything=True, first=first,
+                             stream=six.StringIO()) == 25
+        assert dict(paged) == {1: 1, 2: 1, 3: 1}
+    
+    @responses.activate
+    def test_formats(self, voice, paged):
+        from googlevoice import render
+        columns = ('id', 'displayNumber', 'isRead', 'messageText')
+        out = six.StringIO()
+        render.render(voice, 'all', limit=2, columns=columns,
+                      format='json', stream=out)
+        rows = json.loads(out.getvalue())
+        assert [row['id'] for row in rows] == ['m00', 'm01']
+        assert set(rows[0]) == set(columns)
+        assert rows[1]['messageText'] == 'line\tone\nline two'
+        
+        out = six.StringIO()
+        render.render(voice, 'all', limit=2, columns=columns,
+                      format='tsv', stream=out)
+        lines = out.getvalue().splitlines()
+        assert lines[0] == 'id\tdisplayNumber\tisRead\tmessageText'
+        assert lines[2].split('\t') == ['m01', '(555) 0101', 'yes',
+                                        'line one line two']
+        
+        out = six.StringIO()
+        render.render(voice, 'all', limit=2, columns=('id', 'messageText'),
+                      stream=out)
+        lines = out.getvalue().splitlines()
+        assert lines[0].split() == ['id', 'messageText']
+        assert lines[2] == 'm00'.ljust(40) + '  line one line two'
+        
+        out = six.StringIO()
+        render.render(voice, 'all', limit=0, format='json', stream=out)
+        assert json.loads(out.getvalue()) == []
+    
+    def test_parse_args(self):
+        from googlevoice import render
+        options, feed = render.parse_args(['-n', '5', '-c', 'id, star',
+                                           '-f', 'json', 'sms'])
+        assert feed == 'sms'
+        assert options.limit == 5
+        assert options.columns == ('id', 'star')
+        options, feed = render.parse_args([])
+        assert feed == 'inbox' and options.columns == render.COLUMNS
+        with pytest.raises(SystemExit):
+            render.parse_args(['nowhere'])
+        for columns in (',', '', ' , '):
+            with pytest.raises(SystemExit):
+                render.parse_args(['-c', columns])
+
+
+class TestAsteriskManifest(object):
+
+    @pytest.fixture
+    def setup(self):
+        """ The ``setup-asterisk.py`` script, loaded as a module. """
+        path = os.path.join(os.path.dirname(__file__), 'setup-asterisk.py')
+        try:
+            import importlib.util
+        except ImportError:  # Python 2
+            import imp
+            return imp.load_source('setup_asterisk', path)
+        spec = importlib.util.spec_from_file_location('setup_asterisk', path)
+        module = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(module)
+        return module
+
+    def account(self, n, **extra):
+        data = dict(gvnum='987123456%d' % n,
+                    acctname='trunk%d@example.com' % n,
+                    acctpass='secret %d' % n,
+                    ringback='1678123456%d' % n, callpark='70%d' % n)
+        data.update(extra)
+        return data
+
+    def test_manifest_formats(self, setup, tmpdir):
+        accounts = [self.account(1), self.account(2, key='office')]
+        (tmpdir / 'accounts.json').write(json.dumps({'accounts': accounts}))
+        with open(str(tmpdir / 'accounts.csv'), 'w') as stream:
+            writer = csv.DictWriter(stream, ['key', 'gvnum', 'acctname',
+                                             'acctpass', 'ringback',
+                                             'callpark'])
+            writer.writeheader()
+            writer.writerows(accounts)
+        loaded = [setup.validate(setup.load_manifest(str(tmpdir / name)))
+                  for name in ('accounts.json', 'accounts.csv')]
+        try:
+            import yaml
+        except ImportError:
+            pass
+        else:
+            (tmpdir / 'accounts.yml').write(yaml.safe_dump(accounts))
+            loaded.append(setup.validate(setup.load_manifest(
+                str(tmpdir / 'accounts.yml'))))
+        for result in loaded:
+            assert result == loaded[0]
+        assert [account['context'] for account in loaded[0]] == \
+            ['custom-gv-9871234561', 'custom-gv-office']
+
+    def test_validates_every_entry(self, setup):
+        with pytest.raises(setup.ManifestError) as info:
+            setup.validate([self.account(1),
+                            self.account(2, gvnum='555', acctname='nobody'),
+                            self.account(3, key='9871234561', extra='x')])
+        assert info.value.errors == [
+            'Entry 2 (555): gvnum must be 10 digits',
+            'Entry 2 (555): acctname must be an email address',
+            'Entry 3 (9871234561): unknown field(s) extra',
+            'Entry 3 (9871234561): key also used by entry 1']
+
+    def test_rewrites_blocks_by_key(self, setup, tmpdir):
+        conf = tmpdir / 'extensions_custom.conf'
+        conf.write('[from-internal-custom]\nexten => 1234,1,Playback(hi)\n')
+        accounts = setup.validate([self.account(1), self.account(2)])
+        assert setup.write(str(conf), accounts)
+        first = conf.read()
+        assert first.startswith('[from-internal-custom]\n')
+        assert first.count('[custom-gv-9871234561]') == 1
+        assert first.count('; END googlevoice 9871234562') == 1
+
+        # Running again changes nothing, and doesn’t touch the file:
+        mtime = conf.mtime()
+        assert not setup.write(str(conf), accounts)
+        assert conf.read() == first and conf.mtime() == mtime
+
+        # Changed accounts are replaced where they are:
+        conf.write(conf.read() + '[custom-other]\nexten => s,1,Hangup()\n')
+        changed = setup.validate([self.account(1, callpark='799'),
+                                  self.account(3)])
+        assert setup.write(str(conf), changed)
+        text = conf.read()
+        assert text.count('; BEGIN googlevoice') == 3
+        assert 'Set(CALLPARK=799)' in text and 'Set(CALLPARK=701)' not in text
+        assert text.index('[custom-gv-9871234561]') \
+            < text.index('[custom-other]') \
+            < text.index('[custom-gv-9871234563]')
+
+        assert setup.write(str(conf), changed, prune=True)
+        text = conf.read()
+        assert '9871234562' not in text and '[custom-other]' in text
+        assert [path.basename for path in tmpdir.listdir()] \
+            == ['extensions_custom.conf']
+
+    def test_replaces_unmarked_contexts(self, setup, tmpdir):
+        # As written by the script before it marked its blocks:
+        conf = tmpdir / 'extensions_custom.conf'
+        conf.write('[from-internal-custom]\n'
+                   'exten => 1234,1,Playback(hi)\n'
+                   '\n'
+                   '[custom-gv]\n'
+                   'exten => _X.,1,Wait(1)\n'
+                   'exten => _X.,n,Set(CALLPARK=700)\n'
+                   '\n'
+                   '[custom-park]\n'
+                   'exten => s,1,Wait(4)\n'
+                   '\n'
+                   '[custom-other]\n'
+                   'exten => s,1,Hangup()')
+        account = setup.validate([self.account(
+            1, key='custom-gv', context='custom-gv', park='custom-park')])
+        assert setup.write(str(conf), account)
+        text = conf.read()
+        assert text.count('[custom-gv]') == text.count('[custom-park]') == 1
+        assert 'Set(CALLPARK=700)' not in text
+        assert text.index('[from-internal-custom]') \
+            < text.index('; BEGIN googlevoice custom-gv') \
+            < text.index('[custom-other]')
+        assert text.endswith('[custom-other]\nexten => s,1,Hangup()')
+        assert not setup.write(str(conf), account)
+
+    def test_keeps_mode_and_reraises(self, setup, tmpdir):
+        conf = tmpdir / 'extensions_custom.conf'
+        conf.write('[from-internal-custom]\n')
+        conf.chmod(0o640)
+        assert setup.write(str(conf), setup.validate([self.account(1)]))
+        assert conf.stat().mode & 0o777 == 0o640
+        # Only a missing file counts as empty; others aren’t overwritten:
+        directory = tmpdir.mkdir('extensions.d')
+        with pytest.raises(EnvironmentError):
+            setup.write(str(directory), setup.validate([self.account(1)]))
+        assert directory.check(dir=1)
+
+    def test_invalid_manifest_writes_nothing(self, setup, tmpdir):
+        manifest = tmpdir / 'accounts.json'
+        manifest.write(json.dumps([self.account(1),
+                                   self.account(2, ringback='')]))
+        conf = tmpdir / 'extensions_custom.conf'
+        with pytest.raises(SystemExit):
+            setup.main(['--manifest', str(manifest), '--config', str(conf)])
+        assert not conf.exists()
+        out = six.StringIO()
+        manifest.write(json.dumps([self.account(1)]))
+        assert setup.provision(str(manifest), str(conf), stdout=out)
+        assert 'Updated 1 account(s)' in out.getvalue()
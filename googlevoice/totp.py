@@ -0,0 +1,84 @@
+# encoding: utf-8
+""" Time-based one-time passwords (RFC 6238), for 2-step verification.
+
+    The ``smsKey`` in ``~/.gvoice`` is the base32 secret shown when an
+    authenticator app is set up; ``totp(key)`` turns it into the current
+    six-digit code – as ``oathtool --totp -b`` would, without spawning it:
+
+        >>> totp('JBSW Y3DP EHPK 3PXP')
+        '...'
+
+    ``windows()`` orders the time steps worth trying for one login: the
+    current one, its neighbours in case either clock is off, and then
+    each new step as soon as it begins.
+"""
+from __future__ import print_function
+
+import base64
+import hashlib
+import hmac
+import re
+import struct
+import time
+
+#: Seconds per time step
+STEP = 30
+DIGITS = 6
+
+
+def secret(key):
+    """ Decode a base32 ``key`` – in any case, spaced or not, padded or
+        not – to the raw secret `bytes`.
+    """
+    key = re.sub(r'[\s=-]', '', key).upper()
+    return base64.b32decode(key + '=' * (-len(key) % 8))
+
+
+def hotp(secret, counter, digits=DIGITS):
+    """ The RFC 4226 one-time password for ``counter``, as a string. """
+    digest = hmac.new(secret, struct.pack('>Q', counter),
+                      hashlib.sha1).digest()
+    offset = ord(digest[-1:]) & 0x0f
+    code = struct.unpack('>I', digest[offset:offset + 4])[0] & 0x7fffffff
+    return str(code % 10 ** digits).zfill(digits)
+
+
+def counter(at=None, step=STEP):
+    """ The time step that the epoch time ``at`` (default now) falls in. """
+    return int((time.time() if at is None else at) // step)
+
+
+def remaining(at=None, step=STEP):
+    """ Seconds from ``at`` (default now) until the next time step. """
+    at = time.time() if at is None else at
+    return step - at % step
+
+
+def totp(key, at=None, step=STEP, digits=DIGITS):
+    """ The code for a base32 ``key`` at the epoch time ``at`` (default
+        now).
+    """
+    return hotp(secret(key), counter(at, step), digits)
+
+
+def windows(skew=1, step=STEP, clock=time.time, sleep=time.sleep):
+    """ Yield the time steps to try, in order, for one login: the current
+        step, then up to ``skew`` steps either side of it (next first, for
+        a server clock running ahead), and then each later step not yet
+        tried – sleeping only until it comes within ``skew`` steps of the
+        clock. No step is yielded twice. The caller stops iterating once
+        a code is accepted.
+    """
+    current = counter(clock(), step)
+    yield current
+    for offset in range(1, skew + 1):
+        yield current + offset
+        yield current - offset
+    following = current + skew + 1
+    while True:
+        now = clock()
+        if counter(now, step) + skew < following:
+            sleep(remaining(now, step))
+            continue
+        yield following
+        following += 1
@@ -2,10 +2,209 @@
 from __future__ import print_function
 
 import json
-from datetime import datetime
-from time import gmtime
+import re
+import threading
+from collections import OrderedDict
+from datetime import datetime, timedelta, tzinfo
+from functools import partial, wraps
+from time import gmtime, time
 from xml.parsers.expat import ParserCreate
 
+import six
+
+from . import settings
+from .columns import Columns
+from .profiling import phase
+
+try:
+    from datetime import timezone
+except ImportError:
+    class timezone(tzinfo):
+        """ Python 2 stand-in for the fixed UTC offsets of
+            ``datetime.timezone``.
+        """
+
+        def __init__(self, offset):
+            self.offset = offset
+
+        def __getinitargs__(self):
+            return (self.offset,)
+
+        def utcoffset(self, dt):
+            return self.offset
+
+        def dst(self, dt):
+            return timedelta(0)
+
+        def tzname(self, dt):
+            minutes = int(self.offset.total_seconds()) // 60
+            if not minutes:
+                return 'UTC'
+            return 'UTC%s%02d:%02d' % ('-' if minutes < 0 else '+',
+                                       abs(minutes) // 60, abs(minutes) % 60)
+
+        def __repr__(self):
+            return 'timezone(%r)' % (self.offset,)
+
+    timezone.utc = timezone(timedelta(0))
+
+
+def memoize(maxsize):
+    """ Memoize a function of one hashable argument in a plain `dict`,
+        emptied whenever it holds ``maxsize`` results; ``cache_clear()``
+        empties it at once.
+    """
+    def decorator(function):
+        cache = {}
+
+        @wraps(function)
+        def memoized(argument):
+            try:
+                return cache[argument]
+            except KeyError:
+                pass
+            if len(cache) >= maxsize:
+                cache.clear()
+            result = cache[argument] = function(argument)
+            return result
+
+        memoized.cache_clear = cache.clear
+        return memoized
+    return decorator
+
+
+if six.PY2:
+    # Keep objects – a feed’s messages, above all – in document order, as
+    # every decoder does on Python 3:
+    json_loads = partial(json.loads, object_pairs_hook=OrderedDict)
+else:
+    json_loads = json.loads
+
+
+class JSONDecoder(object):
+    
+    """ Pluggable JSON decoding hook, shared by the feed parsers and the
+        POST endpoint validators.
+        
+        With no backend named, the fastest installed decoder is used –
+        trying ``orjson``, ``ujson`` and ``simdjson`` in that order –
+        falling back to the stdlib ``json`` module (decoding objects to
+        ``OrderedDict``, on Python 2). A backend may also be given as any
+        callable with the signature of ``json.loads``:
+        
+            >>> decoder = JSONDecoder('json')
+            >>> decoder.name
+            'json'
+            >>> decoder('{"ok": true}')
+            {'ok': True}
+    """
+    
+    backends = ('orjson', 'ujson', 'simdjson', 'json')
+    
+    def __init__(self, backend=None):
+        self.use(backend)
+    
+    def use(self, backend=None):
+        """ Switch to the named backend (or callable), or to the fastest
+            one available if ``backend`` is ``None``.
+        """
+        if callable(backend):
+            self.name = getattr(backend, '__module__', None) or repr(backend)
+            self.loads = backend
+            return self
+        if backend is None:
+            for name in self.backends:
+                try:
+                    return self.use(name)
+                except ImportError:
+                    continue
+        if backend not in self.backends:
+            raise ValueError('Unknown JSON backend: %r' % backend)
+        self.name = backend
+        self.loads = json_loads if backend == 'json' \
+            else __import__(backend).loads
+        return self
+    
+    def __call__(self, payload):
+        """ Decode ``payload`` (`str` or `bytes`), raising ``JSONError``
+            on failure. Payloads a fast backend refuses (e.g. integers
+            wider than 64 bits) are retried with the stdlib decoder.
+        """
+        try:
+            return self.loads(payload)
+        except Exception as exc:
+            if self.loads is json_loads:
+                raise JSONError(str(exc))
+        try:
+            return json_loads(payload)
+        except Exception as exc:
+            raise JSONError(str(exc))
+
+
+json_decoder = JSONDecoder(settings.JSON_BACKEND)
+
+
+def loads(payload):
+    """ Decode a JSON payload with the configured backend. """
+    return json_decoder(payload)
+
+
+def use_json_backend(backend=None):
+    """ Select the JSON backend used by all feed and POST decoding;
+        see ``JSONDecoder`` for the accepted values.
+    """
+    return json_decoder.use(backend)
+
+
+DISPLAY_FORMAT = '%m/%d/%y %I:%M %p'
+display_pattern = re.compile(
+    r'(\d{1,2})/(\d{1,2})/(\d{2}) (1[0-2]|0?[1-9]):([0-5]\d) ([AaPp])[Mm]$')
+
+
+@memoize(maxsize=4096)
+def parse_display_datetime(text):
+    """ Parse a ``displayStartDateTime`` string (e.g. ``'3/14/19 9:26 PM'``)
+        into the same naive `datetime` that ``DISPLAY_FORMAT`` yields with
+        ``datetime.strptime`` – without paying for ``strptime`` each time.
+        Messages sharing a minute share a string, so results are memoized.
+    """
+    match = display_pattern.match(text)
+    if match is None:
+        return datetime.strptime(text, DISPLAY_FORMAT)
+    month, day, year, hour, minute, meridian = match.groups()
+    year = int(year)
+    hour = int(hour) % 12
+    if meridian in 'Pp':
+        hour += 12
+    return datetime(year + (2000 if year < 69 else 1900),
+                    int(month), int(day), hour, int(minute))
+
+
+@memoize(maxsize=64)
+def fixed_timezone(minutes):
+    """ A shared `timezone` instance for a UTC offset in minutes. """
+    return timezone(timedelta(minutes=minutes))
+
+
+def utc_datetime(milliseconds):
+    """ A timezone-aware UTC `datetime` for an epoch-ms ``startTime``. """
+    return datetime.fromtimestamp(int(milliseconds) / 1000., timezone.utc)
+
+
+def local_datetime(display, utc):
+    """ Attach the account’s UTC offset – derived from the distance
+        between the displayed wall-clock time and the UTC start time,
+        rounded to the quarter hour – to the naive ``display`` datetime.
+    """
+    delta = display - utc.replace(tzinfo=None, second=0, microsecond=0)
+    minutes = int(round(delta.total_seconds() / 900.)) * 15
+    return display.replace(tzinfo=fixed_timezone(minutes))
+
+
+def content_hash(data):
+    """ A digest of a raw message’s content, for change detection. """
+    return hash(json.dumps(data, sort_keys=True))
+
 
 def validate_response(response):
     """ Validates that a given JSON response is A-OK. """
@@ -18,7 +217,7 @@ def validate_response(response):
 
 def load_and_validate(response):
     """ Loads JSON data from an HTTP response, then validates it. """
-    validate_response(response.json())
+    validate_response(loads(response.content))
 
 
 class ValidationError(Exception):
@@ -53,6 +252,11 @@ class ForwardingError(Exception):
     pass
 
 
+class SnapshotError(Exception):
+    """ A folder snapshot that can’t be read – or is older than wanted. """
+    pass
+
+
 class AttrDict(dict):
     """ A dict whose values can be conveninently accessed through dot.notation """
     def __getattr__(self, attr):
@@ -127,7 +331,9 @@ class Message(AttrDict):
         
         * id: SHA1 identifier
         * isTrash: `bool`
-        * displayStartDateTime: `datetime`
+        * displayStartDateTime: naive `datetime`, in the account’s timezone
+        * localStartDateTime: aware `datetime`, in the account’s timezone
+        * startDateTime: aware `datetime`, in UTC
         * star: `bool`
         * isSpam: `bool`
         * startTime: `gmtime`
@@ -140,32 +346,84 @@ class Message(AttrDict):
         * relativeStartTime: `str`
         * phoneNumber: `str`
         * type: `int`
+        
+        Messages fetched through a ``Voice`` instance are shared between
+        all of its folders – one object per message id – and are updated
+        in place by fresher payloads and by the message operations below.
     """
     
+    #: Fields changed by each message operation, with its parameter name
+    operations = {
+        'archive': ('labels', 'archive'),
+        'delete': ('isTrash', 'trash'),
+        'star': ('star', 'star'),
+        'mark': ('isRead', 'read'),
+    }
+    
     def __init__(self, folder, id, data):
         self.folder = folder
         self.id = id
-        super(AttrDict, self).__init__(data)
-        self['startTime'] = gmtime(int(self['startTime']) / 1000)
-        self['displayStartDateTime'] = datetime.strptime(self['displayStartDateTime'],
-                                                              '%m/%d/%y %I:%M %p')
-        self['displayStartTime'] = self['displayStartDateTime'].time()
+        super(AttrDict, self).__init__()
+        self.load(data)
+
+    def load(self, data):
+        """ Replace this message’s contents with the raw feed ``data``. """
+        milliseconds = int(data['startTime'])
+        display = parse_display_datetime(data['displayStartDateTime'])
+        utc = utc_datetime(milliseconds)
+        fields = dict(data)
+        fields['startTime'] = gmtime(milliseconds // 1000)
+        fields['startDateTime'] = utc
+        fields['displayStartDateTime'] = display
+        fields['localStartDateTime'] = local_datetime(display, utc)
+        fields['displayStartTime'] = display.time()
+        # Update in place, so concurrent readers never see fields missing:
+        stale = [key for key in self if key not in fields]
+        self.update(fields)
+        for key in stale:
+            self.pop(key, None)
+        self.raw = data
+
+    def apply(self, operation, value):
+        """ Apply a message operation (e.g. ``'star'``, ``1``) to this
+            message’s local state, as the server will once it’s posted,
+            and tell the ``listeners`` of its ``Voice`` – indexes over its
+            messages – through their ``applied(message, operation)``.
+        """
+        if operation == 'archive':
+            labels = [label for label in self.labels or () if label != 'inbox']
+            if not int(value):
+                labels.insert(0, 'inbox')
+            self['labels'] = labels
+        else:
+            self[self.operations[operation][0]] = bool(int(value))
+        voice = getattr(self.folder, 'voice', None)
+        for listener in list(getattr(voice, 'listeners', None) or ()):
+            listener.applied(self, operation)
+
+    def state(self, operation):
+        """ This message’s local value for a message operation – the value
+            that would leave it as it is.
+        """
+        if operation == 'archive':
+            return int('inbox' not in (self.labels or ()))
+        return int(bool(self.get(self.operations[operation][0])))
 
     def delete(self, trash=1):
         """ Moves this message to the Trash. Use ``message.delete(0)``
             to move it back out of the Trash.
         """
-        self.folder.voice.__messages_post('delete', self.id, trash=trash)
+        self.folder.voice.__messages_post('delete', self, trash=trash)
 
     def star(self, star=1):
         """ Star this message. Use ``message.star(0)`` to unstar it. """
-        self.folder.voice.__messages_post('star', self.id, star=star)
+        self.folder.voice.__messages_post('star', self, star=star)
 
     def mark(self, read=1):
         """ Mark this message as read. Use ``message.mark(0)`` to
             subsequently mark it as unread.
         """
-        self.folder.voice.__messages_post('mark', self.id, read=read)
+        self.folder.voice.__messages_post('mark', self, read=read)
 
     def download(self, adir=None):
         """ Download the message as an MP3 file, if such data exists.
@@ -179,6 +437,16 @@ class Message(AttrDict):
         """
         return self.folder.voice.download(self, adir)
 
+    @property
+    def contact(self):
+        """ The contact for this message’s ``phoneNumber`` (an `AttrDict`
+            of contact data), or ``None`` if it isn’t in your contacts.
+        """
+        voice = getattr(self.folder, 'voice', None)
+        if voice is None:
+            return None
+        return voice.contacts_cache.lookup(self.phoneNumber)
+
     def __str__(self):
         return self.id
 
@@ -186,6 +454,32 @@ class Message(AttrDict):
         return '<Message #%s (%s)>' % (self.id, self.phoneNumber)
 
 
+class Delta(object):
+    
+    """ The changes found by ``Folder.refresh()``:
+        
+        * added: `list` of new message ids, newest first
+        * removed: `list` of message ids no longer in the folder
+        * changed: `dict` of message id → sorted `list` of changed fields
+        * pages: `int` number of pages fetched
+    """
+    
+    def __init__(self, added=(), removed=(), changed=None, pages=0):
+        self.added = list(added)
+        self.removed = list(removed)
+        self.changed = changed or {}
+        self.pages = pages
+    
+    def __bool__(self):
+        return bool(self.added or self.removed or self.changed)
+    
+    __nonzero__ = __bool__
+    
+    def __repr__(self):
+        return '<Delta +%d -%d ~%d (%d pages)>' % (
+            len(self.added), len(self.removed), len(self.changed), self.pages)
+
+
 class Folder(AttrDict):
     
     """ Folder wrapper for “feeds” of object data from Google Voice.
@@ -198,15 +492,176 @@ class Folder(AttrDict):
         * messages: `list` of `Message` instances
     """
     
-    def __init__(self, voice, name, data):
+    def __init__(self, voice, name, data, fetched=None):
         self.voice = voice
         self.name = name
+        self.fetched = time() if fetched is None else fetched
         super(AttrDict, self).__init__(data)
 
     @property
     def messages(self):
         """ Returns a list of all messages contained in this folder. """
-        return [Message(self, *i) for i in self['messages'].items()]
+        with phase('build'):
+            return [self.message(*i) for i in self['messages'].items()]
+
+    def message(self, msgid, data=None):
+        """ Returns the ``Message`` for one of this folder’s message ids.
+            
+            With a ``Voice`` instance, the message comes from its identity
+            map – shared with every other folder holding that id, and
+            refreshed in place if this folder was fetched since the
+            message was last loaded.
+        """
+        if data is None:
+            data = self['messages'][msgid]
+        identity_map = getattr(self.voice, 'identity_map', None)
+        if identity_map is None:
+            return Message(self, msgid, data)
+        lock = self.voice.identity_lock
+        message = identity_map.get(msgid)
+        if message is None:
+            fresh = Message(self, msgid, data)
+            with lock:
+                message = identity_map.setdefault(msgid, fresh)
+        if message.raw is not data and \
+                self.fetched >= getattr(message.folder, 'fetched', 0):
+            with lock:
+                if message.raw is not data and \
+                        self.fetched >= getattr(message.folder, 'fetched', 0):
+                    message.load(data)
+                    message.folder = self
+        return message
+
+    @property
+    def index(self):
+        """ A ``MessageIndex`` over this folder’s messages, built on first
+            use; ``add()`` further pages to it to query across them.
+        """
+        if self.__dict__.get('_index') is None:
+            from .query import MessageIndex
+            self._index = MessageIndex([self])
+        return self._index
+
+    def query(self, **filters):
+        """ Returns the messages matching ``filters`` – e.g.
+            ``folder.query(type='voicemail', isRead=False)`` – newest first;
+            see ``MessageIndex.ids`` for the filters available.
+        """
+        return self.index.query(**filters)
+
+    @property
+    def hashes(self):
+        """ `dict` of message id → content hash for this folder’s snapshot
+            of its messages, built on first use.
+        """
+        if self.__dict__.get('_hashes') is None:
+            self._hashes = dict((msgid, content_hash(data))
+                                for msgid, data in self['messages'].items())
+        return self._hashes
+
+    def refresh(self, full=False):
+        """ Refetch this folder, updating it in place, and returns a
+            ``Delta`` of the messages added, removed and changed since.
+            
+            Pages are refetched newest first, stopping at the first page
+            with nothing new or changed on it – unless the feed’s unread
+            count has moved by more than the pages refetched so far
+            account for, in which case the read state of some older
+            message changed, and every page the folder spans is checked.
+            Otherwise anything older is taken to be unchanged, so a star
+            or label changed further back goes unseen; with ``full``,
+            every page the folder spans is refetched regardless. Messages
+            missing from the span of pages refetched are reported removed.
+        """
+        previous, hashes = self['messages'], self.hashes
+        counts = (self.get('unreadCounts') or {}).get(self.name)
+        start = self.__dict__.get('page') or 1
+        query = (self.__dict__.get('terms') or {}).get('q')
+        # Messages older than the snapshot were never part of it:
+        floor = min(int(data['startTime'])
+                    for data in previous.values()) if previous else None
+        messages, fresh, delta = OrderedDict(), {}, Delta()
+        first, oldest = None, None
+        # Change in the number of unread messages, over the pages fetched:
+        unread = 0
+        for page in self.voice.pages(self.name, query, start):
+            first = first or page
+            delta.pages += 1
+            dirty, beyond = False, floor is None
+            for msgid, data in page['messages'].items():
+                stamp = int(data['startTime'])
+                # Every entry fetched counts towards the span covered, even
+                # those older than the snapshot:
+                oldest = stamp if oldest is None else min(oldest, stamp)
+                if floor is not None and stamp < floor \
+                        and msgid not in previous:
+                    beyond = True
+                    continue
+                messages[msgid] = data
+                fresh[msgid] = content_hash(data)
+                old = previous.get(msgid)
+                unread += (not data.get('isRead', True)) \
+                    - (old is not None and not old.get('isRead', True))
+                if msgid not in previous:
+                    delta.added.append(msgid)
+                elif hashes[msgid] != fresh[msgid]:
+                    old = previous[msgid]
+                    delta.changed[msgid] = sorted(
+                        key for key in set(old) | set(data)
+                        if old.get(key) != data.get(key))
+                else:
+                    continue
+                dirty = True
+            if beyond:
+                break
+            if not dirty and not full:
+                fetched = (first.get('unreadCounts') or {}).get(self.name)
+                if counts is None or fetched is None \
+                        or fetched - counts == unread:
+                    break
+        for msgid, data in previous.items():
+            if msgid in messages:
+                continue
+            if oldest is None or int(data['startTime']) >= oldest:
+                delta.removed.append(msgid)
+            else:
+                messages[msgid] = data
+                fresh[msgid] = hashes[msgid]
+        if first is not None:
+            for key in ('totalSize', 'unreadCounts', 'resultsPerPage'):
+                if key in first:
+                    self[key] = first[key]
+            self.fetched = first.fetched
+        else:
+            self['totalSize'] = 0
+        self['messages'] = messages
+        self._hashes = fresh
+        self._index = None
+        return delta
+
+    def dump(self, path, compress=False):
+        """ Save this folder’s data and fetch time to a binary snapshot at
+            ``path``, zstd-compressed with ``compress``; see
+            ``googlevoice.snapshot``.
+        """
+        from . import snapshot
+        return snapshot.dump(self, path, compress)
+
+    @classmethod
+    def load(cls, path, voice=None, max_age=None, lazy=False):
+        """ Returns the ``Folder`` saved at ``path`` by ``dump()``; raises
+            ``SnapshotError`` if it was fetched over ``max_age`` seconds
+            ago, or is unreadable. With ``lazy``, messages are decoded as
+            they are accessed, until the ``messages`` mapping is closed.
+        """
+        from . import snapshot
+        return snapshot.load(path, voice, max_age, lazy)
+
+    def to_columns(self):
+        """ Returns a ``Columns`` instance holding typed column arrays of
+            this folder’s messages, built straight from the feed data.
+        """
+        return Columns.from_messages(self['messages'])
 
     def __len__(self):
         return self['totalSize']
@@ -215,6 +670,309 @@ class Folder(AttrDict):
         return '<Folder %s (%s)>' % (self.name, len(self))
 
 
+class CountsParser(object):
+    
+    """ Digs just the ``unreadCounts`` object out of a feed response,
+        fed incrementally in chunks. Only a short tail of the JSON text is
+        kept, the HTML is ignored, and nothing else is decoded:
+        
+            >>> parser = CountsParser()
+            >>> parser.feed('<response><json><![CDATA[{"unreadCounts": ')
+            >>> parser.feed('{"all": 2}, "messages": {}}]]></json>')
+            >>> parser.counts
+            {'all': 2}
+    """
+    
+    pattern = re.compile(r'"unreadCounts"\s*:\s*(\{[^{}]*\})')
+    tail = 8192
+    
+    def __init__(self):
+        self.attr = None
+        self.buffer = ''
+        self.counts = None
+        self.parser = ParserCreate()
+        self.parser.StartElementHandler = self.start_element
+        self.parser.EndElementHandler = self.end_element
+        self.parser.CharacterDataHandler = self.char_data
+    
+    def start_element(self, name, attrs):
+        self.attr = name
+    
+    def end_element(self, name):
+        self.attr = None
+    
+    def char_data(self, data):
+        if self.attr == 'json' and self.counts is None:
+            self.buffer += data
+    
+    def feed(self, chunk):
+        """ Parse another chunk of the response; once ``counts`` is set,
+            the rest of the response may be dropped.
+        """
+        try:
+            with phase('parse'):
+                self.parser.Parse(chunk, 0)
+        except Exception as exc:
+            raise ParsingError(str(exc))
+        if self.counts is None:
+            match = self.pattern.search(self.buffer)
+            if match is not None:
+                self.counts = loads(match.group(1))
+                self.buffer = ''
+            else:
+                self.buffer = self.buffer[-self.tail:]
+    
+    def parse(self, chunks):
+        """ Feed ``chunks`` until the counts turn up, and return them. """
+        for chunk in chunks:
+            self.feed(chunk)
+            if self.counts is not None:
+                return self.counts
+        raise ParsingError('No unreadCounts found in feed response')
+
+
+class MemberScanner(object):
+    
+    """ Incremental scanner over the JSON object of a feed, fed text in
+        chunks of any size. It decodes each member of the object – and,
+        for ``"messages"``, each member of *that* object – as soon as the
+        member is complete, holding on to no more than the text of one
+        incomplete member:
+        
+            >>> scanner = MemberScanner()
+            >>> scanner.feed('{"totalSize": 2, "messages": {"a": {"id"')
+            []
+            >>> scanner.feed(': "a"}, "b": {"id": "b"}}}')
+            [('a', {'id': 'a'}), ('b', {'id': 'b'})]
+            >>> scanner.meta
+            {'totalSize': 2}
+        
+        Each member is decoded by the standard library’s C scanner; a
+        member cut off at the end of a chunk is retried with the next.
+    """
+    
+    container = 'messages'
+    space = re.compile(r'[\s,]*')
+    colon = re.compile(r'\s*:\s*')
+    delimiters = frozenset(',}] \t\n\r')
+    decoder = json.JSONDecoder()
+    
+    def __init__(self):
+        self.buffer = ''
+        self.depth = 0
+        self.done = False
+        self.meta = {}
+    
+    def feed(self, text):
+        """ Scan another chunk of JSON text, returning a `list` of the
+            ``(id, data)`` pairs of container entries it completed; other
+            top-level members are collected into ``meta``.
+        """
+        buffer = self.buffer + text if self.buffer else text
+        entries = []
+        position, size = 0, len(buffer)
+        raw_decode = self.decoder.raw_decode
+        while not self.done:
+            position = self.space.match(buffer, position).end()
+            if position >= size:
+                break
+            char = buffer[position]
+            if self.depth == 0:
+                if char != '{':
+                    raise ParsingError('Feed JSON is not an object')
+                self.depth, position = 1, position + 1
+                continue
+            if char == '}':
+                self.depth -= 1
+                self.done = self.depth == 0
+                position += 1
+                continue
+            try:
+                key, after = raw_decode(buffer, position)
+                match = self.colon.match(buffer, after)
+                if match is None or match.end() >= size:
+                    break
+                start = match.end()
+                if self.depth == 1 and key == self.container \
+                        and buffer[start] == '{':
+                    self.depth, position = 2, start + 1
+                    continue
+                value, end = raw_decode(buffer, start)
+            except ValueError:
+                # Cut off mid-member – unless it’s simply bad JSON,
+                # which close() will report:
+                break
+            if end >= size or buffer[end] not in self.delimiters:
+                # A number may yet continue in the next chunk – "1." or
+                # "1e" decodes as 1 – so it only ends at a delimiter:
+                break
+            if self.depth == 2:
+                entries.append((key, value))
+            else:
+                self.meta[key] = value
+            position = end
+        self.buffer = buffer[position:]
+        return entries
+    
+    def close(self):
+        """ Check that the whole object was scanned. """
+        if not self.done:
+            raise ParsingError('Incomplete or invalid feed JSON')
+
+
+class MessageStream(object):
+    
+    """ Incremental parser for feed responses, yielding their messages one
+        at a time as the response streams in – so memory use is bounded by
+        one message, rather than by the whole page:
+        
+            >>> stream = MessageStream(voice, 'all')
+            >>> for message in stream.parse(response.iter_content(65536)):
+            ...     print(message.id)
+            >>> stream.folder.totalSize
+            
+        The ``<json>`` section is scanned by a ``MemberScanner`` as expat
+        delivers it, and the ``<html>`` section is skipped. Once parsing
+        ends, ``folder`` holds the page’s metadata – but no messages.
+    """
+    
+    def __init__(self, voice, name):
+        self.voice = voice
+        self.name = name
+        self.attr = None
+        self.scanner = MemberScanner()
+        self.pieces = []
+        self.entries = []
+        self.folder = Folder(voice, name, dict(messages={}))
+        self.parser = ParserCreate()
+        self.parser.StartElementHandler = self.start_element
+        self.parser.EndElementHandler = self.end_element
+        self.parser.CharacterDataHandler = self.char_data
+    
+    def start_element(self, name, attrs):
+        self.attr = name
+    
+    def end_element(self, name):
+        if self.attr == 'json':
+            self.scan()
+            self.scanner.close()
+        self.attr = None
+    
+    def char_data(self, data):
+        if self.attr == 'json':
+            self.pieces.append(data)
+    
+    def scan(self):
+        """ Hand the JSON text gathered so far to the scanner, at once. """
+        if self.pieces:
+            self.entries.extend(self.scanner.feed(''.join(self.pieces)))
+            del self.pieces[:]
+    
+    def feed(self, chunk, final=False):
+        """ Parse another chunk of the response, returning a `list` of
+            ``(id, data)`` pairs for the messages it completed.
+        """
+        try:
+            with phase('parse'):
+                self.parser.Parse(chunk, final)
+                self.scan()
+        except Exception as exc:
+            raise ParsingError(str(exc))
+        entries, self.entries = self.entries, []
+        self.folder.update(self.scanner.meta)
+        return entries
+    
+    def parse(self, chunks):
+        """ Feed ``chunks`` through, yielding a ``Message`` for each
+            message as soon as it has been parsed.
+        """
+        folder = self.folder
+        for chunk in chunks:
+            for msgid, data in self.feed(chunk):
+                with phase('build'):
+                    message = folder.message(msgid, data)
+                yield message
+        for msgid, data in self.feed(b'', True):
+            with phase('build'):
+                message = folder.message(msgid, data)
+            yield message
+
+
+class SingleFlight(object):
+    
+    """ Coalesces concurrent identical calls: while a call for some key
+        is in flight, further calls for that key wait for it and share its
+        result (or exception) instead of making their own.
+        
+        ``stats`` counts ``calls`` made, ``executions`` actually run, and
+        ``waiters`` that shared another call’s result.
+    """
+    
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.flights = {}
+        self.stats = dict(calls=0, executions=0, waiters=0)
+    
+    def do(self, key, func):
+        """ Call ``func()`` – unless a call for ``key`` is already in
+            flight, in which case wait for that one’s outcome.
+        """
+        with self.lock:
+            self.stats['calls'] += 1
+            flight = self.flights.get(key)
+            leader = flight is None
+            if leader:
+                flight = self.flights[key] = dict(event=threading.Event())
+                self.stats['executions'] += 1
+            else:
+                self.stats['waiters'] += 1
+        if not leader:
+            flight['event'].wait()
+            if 'error' in flight:
+                raise flight['error']
+            return flight['result']
+        try:
+            flight['result'] = func()
+        except BaseException as exc:
+            flight['error'] = exc
+            raise
+        finally:
+            with self.lock:
+                del self.flights[key]
+            flight['event'].set()
+        return flight['result']
+
+
+class FeedSections(object):
+    
+    """ Expat handlers gathering the ``<json>`` and ``<html>`` sections of
+        one feed response – kept apart from the ``XMLParser``, so that each
+        parse has its own.
+    """
+    
+    def __init__(self, parser):
+        self.attr = None
+        self.pieces = dict(json=[], html=[])
+        parser.StartElementHandler = self.start_element
+        parser.EndElementHandler = self.end_element
+        parser.CharacterDataHandler = self.char_data
+    
+    def start_element(self, name, attrs):
+        if name in ('json', 'html'):
+            self.attr = name
+    
+    def end_element(self, name):
+        self.attr = None
+    
+    def char_data(self, data):
+        # Text is gathered piecewise, as expat delivers it, and joined once:
+        if self.attr and data:
+            self.pieces[self.attr].append(data)
+    
+    def text(self, name):
+        return ''.join(self.pieces[name])
+
+
 class XMLParser(object):
     """ `XMLParser` is a helper class that can dig both json and html
         out of Google feed responses.
@@ -235,45 +993,52 @@ class XMLParser(object):
             'loaded json payload'
             >>> o.html
             'some html payload'
+        
+        Given a ``key`` identifying its request, concurrent calls with the
+        same key – on this or any other parser of the same ``Voice`` – are
+        coalesced into one fetch and parse through ``voice.flights``.
+        
+        Parsers may be called from many threads at once: each call parses
+        into state of its own, and returns its own ``Folder``. ``json``,
+        ``html`` and ``data`` are those of the latest call to finish,
+        always all from the same response.
     """
-    # attr = None
 
-    def __init__(self, voice, name, datafunc):
-        self.attr = None
-        self.json = ''
-        self.html = ''
+    def __init__(self, voice, name, datafunc, key=None):
+        self._result = ('', '', None)
         self.datafunc = datafunc
         self.voice = voice
         self.name = name
+        self.key = key
 
-    def start_element(self, name, attrs):
-        if name in ('json', 'html'):
-            self.attr = name
-
-    def end_element(self, name):
-        self.attr = None
-
-    def char_data(self, data):
-        if self.attr and data:
-            setattr(self, self.attr,
-            getattr(self, self.attr) + data)
+    json = property(lambda self: self._result[0])
+    html = property(lambda self: self._result[1])
 
     def __call__(self):
-        self.json = ''
-        self.html = ''
-        datafunc = self.datafunc
+        flights = getattr(self.voice, 'flights', None)
+        if flights is None or self.key is None:
+            return self.parse()
+        folder, result = flights.do(self.key, lambda: (self.parse(),
+                                                       self._result))
+        self._result = result
+        return folder
+
+    def parse(self):
+        """ Fetch and parse the page, returning its ``Folder``. """
         parser = ParserCreate()
-        parser.StartElementHandler = self.start_element
-        parser.EndElementHandler = self.end_element
-        parser.CharacterDataHandler = self.char_data
+        sections = FeedSections(parser)
         
         try:
-            data = datafunc()
-            parser.Parse(data, 1)
+            data = self.datafunc()
+            with phase('parse'):
+                parser.Parse(data, 1)
         except Exception as exc:
             raise ParsingError(str(exc))
-        
-        return self.folder
+        text = sections.text('json')
+        with phase('decode'):
+            data = loads(text)
+        self._result = (text, sections.text('html'), data)
+        return Folder(self.voice, self.name, data)
 
     @property
     def folder(self):
@@ -286,8 +1051,7 @@ class XMLParser(object):
 
     @property
     def data(self):
-        """ Returns the parsed JSON after the XMLParser has been called. """
-        try:
-            return json.loads(self.json)
-        except Exception as exc:
-            raise JSONError(str(exc))
+        """ Returns the parsed JSON after the XMLParser has been called.
+            The payload is decoded once per response.
+        """
+        return self._result[2]
@@ -1,17 +1,30 @@
 # encoding: utf-8
 from __future__ import print_function
 
-import base64
 import getpass
 import logging
+import os
 import platform
 import re
+import threading
+import time
+import weakref
 
 from .conf import config
 from . import settings
+from . import totp
 from . import util
+from .contacts import Contacts
+from .mutations import MutationQueue
+from . import profiling
+from .profiling import phase
+from .watch import Watcher
 
 import requests
+import six
+from concurrent.futures import (ThreadPoolExecutor, wait,
+                                FIRST_COMPLETED)
+from requests.adapters import HTTPAdapter
 from six.moves import input
 
 qpat = re.compile(r'\?')
@@ -32,12 +45,32 @@ class Voice(object):
         
         Some of the methodology for accessing undocumented endpoints is
         somewhat unorthodox… _here be dragons_, indeed. Yes!
+        
+        One logged-in instance may be shared between threads: feeds,
+        searches, paging, message operations and the other API methods
+        can all be called concurrently. Each feed call parses into state
+        of its own, lazily initialized state (``special``, the contacts
+        cache, the connection pool) is set up once under a lock, and
+        shared ``Message`` objects are updated in place under the
+        identity map’s lock. ``login()`` and ``logout()`` should still be
+        called from one thread, while no others are using the instance.
     """
 
     user_agent = 'googlevoice/{__version__} Python/{pyver}'.format(
         pyver=platform.python_version(), **vars(__import__('googlevoice')))
 
+    #: Seconds for which ``unread_counts()`` results are shared
+    unread_counts_ttl = 5
+
+    #: Directory of folder snapshots for ``snapshot()``
+    snapshot_dir = settings.SNAPSHOT_DIR
+
     def __init__(self):
+        # Profile the whole process, if asked to by GOOGLEVOICE_PROFILE:
+        profiling.from_environment()
+
+        # Guards lazy initialization of shared state:
+        self._lock = threading.RLock()
         self.session = requests.Session()
         self.session.headers.update({'User-Agent': self.user_agent})
 
@@ -46,6 +79,27 @@ class Voice(object):
 
         setattr(self, 'message', self.__get_xml_page('message'))
 
+        self._unread_counts = (0, None)
+        self._unread_counts_lock = threading.Lock()
+
+        self.contacts_cache = Contacts(self.__get_xml_page('contacts'), self)
+
+        # One shared Message per id, across every folder:
+        self.identity_map = weakref.WeakValueDictionary()
+        self.identity_lock = threading.Lock()
+        # Indexes over its messages, told of each operation applied locally:
+        self.listeners = weakref.WeakSet()
+
+        # Concurrent identical feed requests share one fetch and parse:
+        self.flights = util.SingleFlight()
+
+        # Message detail pages, by message id:
+        self.message_cache = {}
+        self._pool_size = 10
+
+        # Message operations are posted straight away, until write_behind():
+        self.mutations = None
+
     ######################
     # Some handy methods
     ######################
@@ -54,15 +108,21 @@ class Voice(object):
         """ Returns the special identifier for the active session, if logged in. """
         if getattr(self, '_special', None):
             return self._special
+        with self._lock:
+            # Another thread may have fetched it while this one waited:
+            if getattr(self, '_special', None):
+                return self._special
+            self._special = self.__fetch_special()
+            return self._special
+    special = property(special)
+
+    def __fetch_special(self):
         pattern = re.compile(r"('_rnr_se':) '(.+)'")
         resp = self.session.get(settings.INBOX).text
         try:
-            sp = pattern.search(resp).group(2)
+            return pattern.search(resp).group(2)
         except AttributeError:
-            sp = None
-        self._special = sp
-        return sp
-    special = property(special)
+            return None
 
     def login(self, email=None, passwd=None, smsKey=None):
         """ Login to the service using the provided Google Voice credentials;
@@ -115,43 +175,51 @@ class Voice(object):
         if smsKey is None:
             from getpass import getpass
             smsPin = getpass("SMS PIN: ")
-            content = self.__do_page('smsauth', {'smsUserPin': smsPin}).read()
+            content = self.__do_page('smsauth', {'smsUserPin': smsPin}).text
 
         else:
-            smsKey = base64.b32decode(
-                re.sub(r' ', '', smsKey), casefold=True).encode("hex")
-            content = self.__oathtoolAuth(smsKey)
-
-            try_count = 1
-
-            while ("The code you entered didn&#39;t verify." in content
-                    and try_count < 5):
-                sleep_seconds = 10
-                try_count += 1
-                print(
-                    'invalid code, retrying after %s seconds (attempt %s)'
-                    % (sleep_seconds, try_count))
-                import time
-                time.sleep(sleep_seconds)
-                content = self.__oathtoolAuth(smsKey)
+            secret = totp.secret(smsKey)
+            for try_count, step in enumerate(totp.windows(), 1):
+                content = self.__totpAuth(secret, step)
+                if ("The code you entered didn&#39;t verify." not in content
+                        or try_count >= 5):
+                    break
+                log.info('invalid code, retrying (attempt %s)', try_count + 1)
+            del secret
 
         del smsKey
         return content
 
-    def __oathtoolAuth(self, smsKey):
-        import commands
-        smsPin = commands.getstatusoutput('oathtool --totp ' + smsKey)[1]
-        content = self.__do_page('smsauth', {'smsUserPin': smsPin}).read()
+    def __totpAuth(self, secret, step):
+        smsPin = totp.hotp(secret, step)
+        content = self.__do_page('smsauth', {'smsUserPin': smsPin}).text
         del smsPin
         return content
 
     def logout(self):
         """ Logs the instance out and ensures its session data is deleted. """
+        if self.mutations is not None:
+            self.mutations.close()
+            self.mutations = None
         self.__do_page('logout')
-        del self._special
+        self.contacts_cache.invalidate()
+        with self._lock:
+            del self._special
         assert self.special is None
         return self
 
+    def session_valid(self):
+        """ Whether the session is still logged in – checked by fetching
+            the special identifier afresh, rather than using the one
+            cached at login. Other threads keep using the cached one
+            meanwhile; it is only replaced by a fresh one that was found.
+        """
+        special = self.__fetch_special()
+        if special:
+            with self._lock:
+                self._special = special
+        return bool(special)
+
     def call(self, outgoingNumber,
                    forwardingNumber=None, phoneType=None,
                    subscriberNumber=None):
@@ -187,14 +255,12 @@ class Voice(object):
 
     def phones(self):
         """ Returns a list of ``Phone`` instances attached to your account. """
-        return [
-            util.Phone(self, data)
-            for data in self.contacts['phones'].values()]
+        return self.contacts_cache.phones
     phones = property(phones)
 
     def settings(self):
         """ Returns a `dict` of the current Google Voice settings. """
-        return util.AttrDict(self.contacts['settings'])
+        return self.contacts_cache.settings
     settings = property(settings)
 
     def send_sms(self, phoneNumber, text):
@@ -209,7 +275,191 @@ class Voice(object):
             Returns a ``Folder`` instance, containting any matching messages.
         """
         data = dict(q=query)
-        return self.__get_xml_page('search', terms=data)()
+        folder = self.__get_xml_page('search', terms=data)()
+        folder.terms = data
+        return folder
+
+    def pages(self, feed, query=None, start=1):
+        """ Iterate over every page of a feed (e.g. ``'inbox'``, or
+            ``'search'`` along with a ``query``), yielding a ``Folder``
+            instance for each page in turn, starting at page ``start``.
+        """
+        number = start
+        while True:
+            terms = {'page': 'p%d' % number}
+            if query is not None:
+                terms['q'] = query
+            folder = self.__get_xml_page(feed, terms=terms)()
+            folder.page = number
+            folder.terms = terms
+            if not folder['messages']:
+                return
+            yield folder
+            # Lacking either count, go on until an empty page:
+            size = folder.get('resultsPerPage') or len(folder['messages'])
+            total = folder.get('totalSize')
+            if total is not None and number * size >= total:
+                return
+            number += 1
+
+    def iter_messages(self, feed, query=None, page=1, chunk_size=65536):
+        """ Stream one page of a feed, yielding each of its messages as
+            soon as it has been parsed – without holding the whole page,
+            or its HTML, in memory. See ``util.MessageStream``.
+        """
+        terms = {'page': 'p%d' % page}
+        if query is not None:
+            terms['q'] = query
+        response = self.__do_special_page('XML_%s' % feed.upper(),
+                                          terms=terms, stream=True)
+        try:
+            stream = util.MessageStream(self, feed)
+            for message in stream.parse(response.iter_content(chunk_size)):
+                yield message
+        finally:
+            response.close()
+
+    def export_columns(self, feed, query=None):
+        """ Fetch every page of a feed into one ``Columns`` instance of
+            typed column arrays, without constructing ``Message`` objects.
+        """
+        columns = util.Columns()
+        for folder in self.pages(feed, query):
+            columns.extend(folder['messages'])
+        return columns
+
+    def fetch_message(self, msg):
+        """ Fetch and parse the detail page of one message (a ``Message``
+            instance or id), returning it as a ``Folder``.
+        """
+        if isinstance(msg, util.Message):
+            msg = msg.id
+        return self.__get_xml_page('message', terms={'id': msg})()
+
+    def fetch_messages(self, msgs, concurrency=8, cache=True,
+                       return_exceptions=False):
+        """ Fetch the detail pages of many messages (``Message`` instances
+            or ids) at once, over at most ``concurrency`` requests in
+            flight, yielding ``(id, Folder)`` pairs as each completes.
+            
+            With ``cache``, pages are kept in ``self.message_cache`` and
+            ids already there are yielded straight away, without a fetch.
+            A failed fetch raises its exception – or, with
+            ``return_exceptions``, is yielded in place of the ``Folder``.
+        """
+        ids, seen = [], set()
+        for msg in msgs:
+            msgid = msg.id if isinstance(msg, util.Message) else msg
+            # Each id once – whether cached or fetched:
+            if msgid in seen:
+                continue
+            seen.add(msgid)
+            if cache and msgid in self.message_cache:
+                yield msgid, self.message_cache[msgid]
+            else:
+                ids.append(msgid)
+        if not ids:
+            return
+        self.__ensure_pool(concurrency)
+        pending = iter(ids)
+        with ThreadPoolExecutor(max_workers=concurrency) as executor:
+            running = {}
+            for msgid in pending:
+                running[executor.submit(self.fetch_message, msgid)] = msgid
+                if len(running) >= concurrency:
+                    break
+            while running:
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    msgid = running.pop(future)
+                    try:
+                        folder = future.result()
+                    except Exception as exc:
+                        if not return_exceptions:
+                            for other in running:
+                                other.cancel()
+                            raise
+                        folder = exc
+                    else:
+                        if cache:
+                            self.message_cache[msgid] = folder
+                    for nextid in pending:
+                        running[executor.submit(
+                            self.fetch_message, nextid)] = nextid
+                        break
+                    yield msgid, folder
+
+    def snapshot(self, feed, max_age=300, compress=False, lazy=False):
+        """ Returns the first page of ``feed`` from its snapshot in
+            ``snapshot_dir``, if that was fetched within ``max_age``
+            seconds – and otherwise fetches it, and saves a new snapshot.
+            See ``Folder.load`` for ``lazy``.
+        """
+        if not self.snapshot_dir:
+            raise ValueError('No snapshot_dir set')
+        directory = os.path.expanduser(self.snapshot_dir)
+        path = os.path.join(directory, '%s.gvsnap' % feed)
+        try:
+            return util.Folder.load(path, self, max_age, lazy)
+        except (IOError, OSError, util.SnapshotError) as exc:
+            log.debug('Not using snapshot %s: %s', path, exc)
+        folder = getattr(self, feed)()
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        folder.dump(path, compress)
+        return folder
+
+    def watch(self, feeds=('inbox',), callback=None, **options):
+        """ Start watching ``feeds`` for new or changed messages, calling
+            ``callback(event, message)`` for each on a worker pool; see
+            ``Watcher`` for the polling ``options``.
+            
+            Returns the running ``Watcher`` – call its ``stop()`` method
+            when done.
+        """
+        if isinstance(feeds, six.string_types):
+            feeds = (feeds,)
+        return Watcher(self, feeds, callback, **options).start()
+
+    def unread_counts(self, max_age=None):
+        """ Returns a `dict` of unread message counts per folder – as in
+            ``Folder.unreadCounts`` – without parsing any messages.
+            
+            The inbox feed is streamed only until its counts turn up, and
+            the result is shared for ``max_age`` seconds (defaulting to
+            ``unread_counts_ttl``) between callers, who wait on a single
+            fetch rather than each making their own.
+        """
+        if max_age is None:
+            max_age = self.unread_counts_ttl
+        with self._unread_counts_lock:
+            fetched, counts = self._unread_counts
+            if counts is not None and time.time() - fetched < max_age:
+                return counts
+            response = self.__do_special_page('XML_INBOX', stream=True)
+            try:
+                counts = util.AttrDict(util.CountsParser().parse(
+                    response.iter_content(chunk_size=4096)))
+            finally:
+                response.close()
+            self._unread_counts = (time.time(), counts)
+            return counts
+
+    def write_behind(self, interval=1., threshold=50, callback=None):
+        """ Queue message operations (``star``, ``mark``, ``archive`` and
+            ``delete``) instead of posting each at once: they are applied
+            to local messages straight away, coalesced per message, and
+            posted in batches every ``interval`` seconds – or as soon as
+            ``threshold`` are pending. Failed posts are rolled back locally
+            and reported to ``callback(operation, ids, value, error)``.
+            
+            Returns the ``MutationQueue``; ``flush()`` it to post pending
+            operations immediately.
+        """
+        if self.mutations is None:
+            self.mutations = MutationQueue(self, interval, threshold,
+                                           callback)
+        return self.mutations
 
     def archive(self, msg, archive=1):
         """ Archive the specified message by removing it from the Inbox. """
@@ -251,34 +501,50 @@ class Voice(object):
         """ Partial data of your Google Account Contacts related to
             your Voice account.
             
+            The feed is cached by ``self.contacts_cache`` for its ``ttl``;
+            use that for indexed lookups, or ``invalidate()`` it to force
+            a refetch.
+            
             For a more comprehensive suite of APIs, check out:
                 http://code.google.com/apis/contacts/docs/1.0/developers_guide_python.html
         """
-        if hasattr(self, '_contacts'):
-            return self._contacts
-        self._contacts = self.__get_xml_page('contacts')()
-        return self._contacts
+        return self.contacts_cache.folder
     contacts = property(contacts)
 
     ######################
     # Helper methods
     ######################
 
+    def __ensure_pool(self, size):
+        """ Grow the session’s connection pool to hold ``size`` connections
+            per host, for concurrent requests.
+        """
+        with self._lock:
+            if size > self._pool_size:
+                self._pool_size = size
+                self.session.mount('https://',
+                                   HTTPAdapter(pool_maxsize=size))
+
     def __resolve_page(self, page):
         return getattr(settings, page.upper())
 
-    def __do_page(self, page, data=None, headers=None, terms=None):
+    def __do_page(self, page, data=None, headers=None, terms=None,
+                  stream=False):
         """ Loads a page out of the settings and request it using `requests`.
             Returns the `requests.Response` instance.
         """
-        return self.__do_url(self.__resolve_page(page), data, headers, terms)
+        return self.__do_url(self.__resolve_page(page), data, headers, terms,
+                             stream)
 
-    def __do_url(self, url, data=None, headers=None, terms=None):
+    def __do_url(self, url, data=None, headers=None, terms=None,
+                 stream=False):
         log.debug('url is %s', url)
         log.debug('data is %s', data)
         method = 'POST' if data else 'GET'
-        return self.session.request(
-            method, url, data=data, params=terms or None, headers=headers)
+        with phase('network'):
+            return self.session.request(
+                method, url, data=data, params=terms or None,
+                headers=headers, stream=stream)
 
     def __validate_special_page(self, page, data={}, **kwargs):
         """ Validates a given special page, looking for an 'ok' response """
@@ -287,14 +553,17 @@ class Voice(object):
 
     _Phone__validate_special_page = __validate_special_page
 
-    def __do_special_page(self, page, data=None, headers={}, terms={}):
+    def __do_special_page(self, page, data=None, headers={}, terms={},
+                          stream=False):
         """ Add self.special to the outbound request data """
         assert self.special, 'You must login before using this page'
         if isinstance(data, tuple):
             data += ('_rnr_se', self.special)
+        elif isinstance(data, list):
+            data = data + [('_rnr_se', self.special)]
         elif isinstance(data, dict):
             data.update({'_rnr_se': self.special})
-        return self.__do_page(page, data, headers, terms)
+        return self.__do_page(page, data, headers, terms, stream)
 
     _Phone__do_special_page = __do_special_page
 
@@ -303,16 +572,40 @@ class Voice(object):
         def getter():
             page_name = 'XML_%s' % page.upper()
             return self.__do_special_page(page_name, data, headers, terms).text
-        return util.XMLParser(self, page, getter)
+        key = (page,) + tuple(
+            repr(sorted(dict(each or {}).items()))
+            for each in (terms, data, headers))
+        return util.XMLParser(self, page, getter, key)
 
     def __messages_post(self, page, *msgs, **data):
-        """ Performs message operations, e.g. deleting, staring, moving, etc. """
-        if len(msgs) != 1:
-            raise NotImplementedError("Only supports one message")
+        """ Performs message operations, e.g. deleting, staring, moving, etc.
+            The change is applied optimistically to any local ``Message`` –
+            and, with ``write_behind()`` enabled, queued rather than posted.
+        """
+        value = data[util.Message.operations[page][1]]
+        messages = []
         for msg in msgs:
             if isinstance(msg, util.Message):
-                msg = msg.id
-            data['messages'] = msg
+                messages.append((msg.id, msg))
+            else:
+                messages.append((msg, self.identity_map.get(msg)))
+        if self.mutations is not None:
+            return self.mutations.add(page, messages, value)
+        response = self.__post_messages(page, [msgid for msgid, _ in messages],
+                                        value)
+        for _, message in messages:
+            if message is not None:
+                message.apply(page, value)
+        return response
+
+    def __post_messages(self, page, ids, value):
+        """ Post one message operation, with its parameter at ``value``,
+            for every message id in ``ids`` at once.
+        """
+        data = [('messages', msgid) for msgid in ids]
+        data.append((util.Message.operations[page][1], value))
         return self.__do_special_page(page, data)
 
+    _MutationQueue__post_messages = __post_messages
+
     _Message__messages_post = __messages_post
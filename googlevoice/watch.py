@@ -0,0 +1,178 @@
+# encoding: utf-8
+""" Polling watcher that reports new and changed messages.
+
+    A ``Watcher`` polls one or more feeds on a background thread, with an
+    interval that tightens after activity and backs off while idle. Each
+    poll first probes the account’s unread counts with
+    ``Voice.unread_counts()`` – which parses no messages – and only
+    fetches the feeds when those moved, or when a feed was last fetched
+    ``refresh`` seconds ago, since starring, labelling or adding a note
+    leaves the counts alone. Every page fetched is diffed against the
+    messages seen before. Callbacks run on a worker pool, so slow
+    handlers never delay polling.
+"""
+from __future__ import print_function
+
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+log = logging.getLogger(__name__)
+
+NEW = 'new'
+CHANGED = 'changed'
+
+
+def fingerprint(data):
+    """ The mutable state of a raw message, for change detection. """
+    return (data.get('isRead'), data.get('star'), data.get('isSpam'),
+            data.get('isTrash'), tuple(data.get('labels') or ()),
+            data.get('note'))
+
+
+class Watcher(object):
+
+    """ Watches ``feeds`` of a logged-in ``Voice`` instance, calling
+        ``callback(event, message)`` for every message not seen before
+        (``event`` is ``'new'``) or whose state has since changed
+        (``'changed'``).
+
+        The poll interval starts at ``min_interval`` seconds, is
+        multiplied by ``backoff`` after every idle poll up to
+        ``max_interval``, and drops back to ``min_interval`` as soon as
+        anything happens. Messages present at the first poll are taken
+        as already seen, unless ``emit_existing`` is set.
+        
+        Feeds are fetched whenever the unread counts move, and otherwise
+        at least every ``refresh`` seconds. Messages are forgotten once
+        they are on none of the pages watched, so a message coming back
+        into view is reported as new again.
+    """
+
+    def __init__(self, voice, feeds=('inbox',), callback=None,
+                 min_interval=5., max_interval=300., backoff=2.,
+                 workers=4, emit_existing=False, refresh=60.):
+        self.voice = voice
+        self.feeds = tuple(feeds)
+        self.callbacks = [callback] if callback else []
+        self.min_interval = self.interval = min_interval
+        self.max_interval = max_interval
+        self.backoff = backoff
+        self.refresh = refresh
+        self.seen = {}
+        self.pages = {}
+        self.fetched = {}
+        self.counts = None
+        self.primed = emit_existing
+        self.workers = workers
+        self.executor = ThreadPoolExecutor(max_workers=workers)
+        self.stopped = threading.Event()
+        self.thread = None
+
+    def add_callback(self, callback):
+        """ Register another ``callback(event, message)``. """
+        self.callbacks.append(callback)
+
+    def poll(self):
+        """ Poll every feed once, dispatch callbacks for any events, and
+            adapt the interval; returns the `list` of ``(event, message)``
+            pairs found.
+        """
+        events = []
+        now = time.time()
+        counts = self.probe()
+        moved = counts is None or counts != self.counts
+        self.counts = counts
+        for feed in self.feeds:
+            if not moved and now - self.fetched.get(feed, 0) < self.refresh:
+                continue
+            folder = getattr(self.voice, feed)()
+            self.fetched[feed] = now
+            self.pages[feed] = set(folder['messages'])
+            events.extend(self.diff(folder))
+        # Forget messages no longer on any page watched:
+        current = set().union(*self.pages.values())
+        for msgid in set(self.seen) - current:
+            del self.seen[msgid]
+        if not self.primed:
+            self.primed = True
+            del events[:]
+        # Stopped, callbacks wait until started again:
+        executor = self.executor
+        for event in events if executor is not None else ():
+            for callback in self.callbacks:
+                executor.submit(self.dispatch, callback, *event)
+        if events:
+            self.interval = self.min_interval
+        else:
+            self.interval = min(self.interval * self.backoff,
+                                self.max_interval)
+        return events
+
+    def probe(self):
+        """ The account’s unread counts, shared with other callers for
+            up to half the shortest interval – or ``None``, for a
+            ``voice`` that can’t report them.
+        """
+        unread_counts = getattr(self.voice, 'unread_counts', None)
+        if unread_counts is None:
+            return None
+        return dict(unread_counts(max_age=self.min_interval / 2.))
+
+    def diff(self, folder):
+        """ Update the seen-id index from a feed page, yielding events
+            for new or changed messages.
+        """
+        for msgid, data in folder['messages'].items():
+            state = fingerprint(data)
+            previous = self.seen.get(msgid)
+            if previous == state:
+                continue
+            self.seen[msgid] = state
+            event = NEW if previous is None else CHANGED
+            yield event, folder.message(msgid, data)
+
+    def dispatch(self, callback, event, message):
+        try:
+            callback(event, message)
+        except Exception:
+            log.exception('Watcher callback %r failed', callback)
+
+    def run(self, stopped=None):
+        """ Poll until ``stopped`` (by default, until ``stop()``); errors
+            are logged, and count as idle.
+        """
+        stopped = stopped or self.stopped
+        while not stopped.is_set():
+            try:
+                self.poll()
+            except Exception:
+                log.exception('Watcher poll failed')
+                self.interval = min(self.interval * self.backoff,
+                                    self.max_interval)
+            stopped.wait(self.interval)
+
+    def start(self):
+        """ Start polling on a daemon thread; returns ``self``. A stopped
+            watcher can be started again.
+        """
+        if self.executor is None:
+            self.executor = ThreadPoolExecutor(max_workers=self.workers)
+        # A fresh event, so a thread left finishing by stop(wait=False)
+        # still stops:
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.run, args=(self.stopped,),
+                                       name='googlevoice-watcher')
+        self.thread.daemon = True
+        self.thread.start()
+        return self
+
+    def stop(self, wait=True):
+        """ Stop polling, and (with ``wait``) let pending callbacks finish. """
+        self.stopped.set()
+        if self.thread is not None and wait:
+            self.thread.join()
+        executor, self.executor = self.executor, None
+        if executor is not None:
+            executor.shutdown(wait=wait)
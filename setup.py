@@ -27,8 +27,9 @@ params = dict(
     ),
     python_requires='>=2.7',
     install_requires=[
-        'six',
+        'six>=1.13',
         'requests',
+        'futures; python_version=="2.7"',
     ],
     extras_require={
         'testing': [
@@ -51,6 +52,9 @@ params = dict(
 
             # local
         ],
+        'yaml': [
+            'PyYAML',
+        ],
     },
     setup_requires=[
         'setuptools_scm>=1.15.0',